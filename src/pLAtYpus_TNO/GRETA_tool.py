@@ -38,9 +38,19 @@ with the change value of a given slider. It has two arguments:
 The function then calls the relevant updating function
 (update_survey_topic_values, update_initial_yes, update_intention_weights)
 
+The update_from_sliders function does the same for several sliders at once
+(for example for a preset), with a dictionary with the slider names as keys
+and the slider values as values. All the changes are written in one
+transaction, and the function returns the set of (product, country)
+systems whose evolutions need to be recomputed (with make_outputs).
+
 
 The reset_to_survey function resets the values to the ones from the survey
-(that is before the sliders are used). It uses the parameters as arguments.
+(that is before the sliders are used). It restores the baseline that
+save_baseline stores when the outputs are first computed from the survey
+(see pLAtYpus.py, or the first reset without a baseline),
+so it does not need to solve or plot anything.
+It uses the parameters as arguments.
 You can get them with the following two lines of code:
     parameters_file_name = 'pLAtYpus.toml'
     parameters = cook.parameters_from_TOML(parameters_file_name)
@@ -65,13 +75,23 @@ The make_outputs function makes the plots/figures for a given product
 and country (you can also use EU if you want to change them all,
 which you should do if you change the weights,
 as they apply to all countries).
+
+
+The get_slider_gradients function gives how much each slider of a given
+product and country would move the long-term averages of the engagement
+levels (from a single integration, with forward sensitivities). It takes
+the product, the country, and the parameters as arguments and returns a
+DataFrame with the slider names (as in update_from_slider) as index and
+the stakeholders as columns.
 '''
 
+import collections
 import datetime
-import sqlite3
+import hashlib
+import json
+import os
 import shutil
 
-import pandas as pd
 import numpy as np
 
 from ETS_CookBook import ETS_CookBook as cook
@@ -86,12 +106,372 @@ try:
 except ModuleNotFoundError:
     import maps
 
+try:
+    from pLAtYpus_TNO import scores
+except ModuleNotFoundError:
+    import scores
+
+try:
+    from pLAtYpus_TNO import model_store as model_store_module
+except ModuleNotFoundError:
+    import model_store as model_store_module
+
+
+class SolveCache:
+    '''
+    A cache of yes evolutions (and of their threshold crossings, if
+    they are detected), with the hashes of the solver inputs
+    (see get_solve_key) as keys, so that slider moves that come back to
+    earlier values do not need a new integration.
+    When the cache has more entries (or uses more memory) than its
+    maximum, we remove the least recently used entries.
+    '''
+
+    def __init__(self, maximum_entries, maximum_size):
+        self.maximum_entries = maximum_entries
+        self.maximum_size = maximum_size
+        self.entries = collections.OrderedDict()
+        self.entry_sizes = {}
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, solve_key):
+        if solve_key not in self.entries:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries.move_to_end(solve_key)
+        return self.entries[solve_key]
+
+    def put(self, solve_key, yes_evolution, threshold_crossings=None):
+        if solve_key in self.entries:
+            self.entries.move_to_end(solve_key)
+            return
+        self.entries[solve_key] = yes_evolution, threshold_crossings
+        self.entry_sizes[solve_key] = int(
+            yes_evolution.memory_usage(deep=True).sum()
+        )
+        if threshold_crossings is not None:
+            self.entry_sizes[solve_key] += int(
+                threshold_crossings.memory_usage(deep=True).sum()
+            )
+        self.size += self.entry_sizes[solve_key]
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.maximum_entries
+            or self.size > self.maximum_size
+        ):
+            oldest_solve_key, oldest_solve = self.entries.popitem(last=False)
+            self.size -= self.entry_sizes.pop(oldest_solve_key)
+
+    def clear(self):
+        self.entries.clear()
+        self.entry_sizes.clear()
+        self.size = 0
+
+
+# The cache lives as long as the tool runs
+solve_cache = None
+
+
+def get_solve_cache(parameters):
+    global solve_cache
+    if solve_cache is None:
+        dashboard_parameters = parameters['dashboard']
+        solve_cache = SolveCache(
+            dashboard_parameters['solve_cache_maximum_entries'],
+            dashboard_parameters['solve_cache_maximum_size'],
+        )
+    return solve_cache
+
+
+def get_solve_key(initial_yes, compiled_coefficients, parameters):
+    '''
+    Makes a key that identifies a solve: a hash of the initial yes values,
+    the compiled coefficients (which contain the category weights and
+    the survey scores of the product and country), and the
+    model and solver settings (which need to be the ones of the system,
+    see solver.get_system_solver_parameters).
+    '''
+    solve_hash = hashlib.sha256()
+    solve_hash.update(np.ascontiguousarray(initial_yes, dtype=float).tobytes())
+    for coefficient_name in sorted(compiled_coefficients):
+        solve_hash.update(coefficient_name.encode())
+        solve_hash.update(
+            np.ascontiguousarray(
+                compiled_coefficients[coefficient_name]
+            ).tobytes()
+        )
+    solve_hash.update(
+        json.dumps(
+            parameters['pLAtYpus'], sort_keys=True, default=str
+        ).encode()
+    )
+
+    return solve_hash.hexdigest()
+
+
+def get_cached_evolution_and_plots(
+    product, country, parameters, model_store=None
+):
+    '''
+    Does the same as solver.get_evolutions_and_plots, but takes the
+    evolution from the solve cache if it has been computed before,
+    and does not write the outputs if they are already the ones
+    for these inputs (i.e. the solve key stored in the database,
+    see solver.save_solve_keys, is the one of these inputs).
+    If threshold crossings are detected, we also replace the rows of
+    the system in the threshold crossings table.
+    '''
+    detect_threshold_crossings = parameters['pLAtYpus'][
+        'detect_threshold_crossings'
+    ]
+    system_parameters = solver.get_system_solver_parameters(
+        product, country, parameters, model_store
+    )
+    model_coefficients = solver.get_model_coefficients(
+        product, country, parameters, model_store=model_store
+    )
+    initial_yes = solver.get_initial_yes(
+        product, country, parameters, model_store
+    )
+    compiled_coefficients = scores.compile_model_coefficients(
+        model_coefficients
+    )
+    solve_key = get_solve_key(
+        initial_yes, compiled_coefficients, system_parameters
+    )
+    if (
+        solver.read_solve_key(product, country, parameters, model_store)
+        == solve_key
+    ):
+        return
+
+    yes_evolution_cache = get_solve_cache(parameters)
+    cached_solve = yes_evolution_cache.get(solve_key)
+    if cached_solve is not None:
+        yes_evolution, threshold_crossings = cached_solve
+    elif detect_threshold_crossings:
+        yes_evolution, threshold_crossings = solver.get_yes_evolution(
+            initial_yes,
+            model_coefficients,
+            parameters,
+            save_dataframe=False,
+            threshold_crossings=True,
+            model_store=model_store,
+        )
+        yes_evolution_cache.put(solve_key, yes_evolution, threshold_crossings)
+    else:
+        yes_evolution = solver.get_yes_evolution(
+            initial_yes,
+            model_coefficients,
+            parameters,
+            save_dataframe=False,
+            model_store=model_store,
+        )
+        threshold_crossings = None
+        yes_evolution_cache.put(solve_key, yes_evolution)
+
+    solver.save_yes_evolutions(
+        {(product, country): yes_evolution}, parameters, model_store
+    )
+    if threshold_crossings is not None:
+        solver.replace_threshold_crossings(
+            threshold_crossings, parameters, model_store
+        )
+    solver.plot_evolution(product, country, yes_evolution, parameters)
+    # We save the key once the outputs are written (saving the
+    # evolution removes the key that was there before)
+    solver.save_solve_keys(
+        {(product, country): solve_key}, parameters, model_store
+    )
+
+
+def get_slider_gradients(product, country, parameters, model_store=None):
+    '''
+    Gets the gradients of the long-term averages of a given product
+    and country with respect to all its sliders (see
+    solver.get_yes_evolution with forward sensitivities).
+    The intention weight sliders are named with the country, but the
+    weights are pan-european, so moving them also changes the
+    other countries.
+    '''
+    model_coefficients = solver.get_model_coefficients(
+        product, country, parameters, model_store=model_store
+    )
+    initial_yes = solver.get_initial_yes(
+        product, country, parameters, model_store
+    )
+    yes_evolution, slider_gradients = solver.get_yes_evolution(
+        initial_yes,
+        model_coefficients,
+        parameters,
+        save_dataframe=False,
+        forward_sensitivities=True,
+        model_store=model_store,
+    )
+
+    return slider_gradients
+
+
+def get_baseline_output_names(parameters):
+    '''
+    Gets the names (without extensions) of the output files that the
+    sliders change: the yes evolutions (tables and plots), the threshold
+    crossings, the long-term average tables, and the maps of the products.
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    stakeholders = pLAtYpus_parameters['stakeholders']
+    interpolant_table_suffix = pLAtYpus_parameters['interpolant_table_suffix']
+    long_term_averages_table_name_prefix = pLAtYpus_parameters[
+        'long_term_averages_table_name_prefix'
+    ]
+    countries = parameters['survey']['countries']
+    products = list(parameters['products'].keys())
+
+    baseline_output_names = {
+        pLAtYpus_parameters['threshold_crossings_table_name']
+    }
+    for product in products:
+        for country in countries:
+            baseline_output_names.add(f'{product}_{country}')
+            baseline_output_names.add(
+                f'{product}_{country}_{interpolant_table_suffix}'
+            )
+        baseline_output_names.add(
+            f'{long_term_averages_table_name_prefix}_{product}'
+        )
+        baseline_output_names.add(
+            f'Long-term average engagement for {product}'
+        )
+        for stakeholder in stakeholders:
+            baseline_output_names.add(
+                f'Long-term average engagement of {stakeholder} for {product}'
+            )
+
+    return baseline_output_names
+
+
+# The sections of the parameters that change the outputs of the baseline
+baseline_parameter_sections = [
+    'files',
+    'colors',
+    'color_bars',
+    'plots',
+    'pLAtYpus',
+    'survey',
+    'products',
+    'maps',
+    'intention',
+    'attention',
+]
+
+
+def get_baseline_key(parameters):
+    '''
+    Makes a key that identifies the settings with which the baseline
+    outputs were made: a hash of the sections of the parameters that
+    change them (for example the time span and solver method of the
+    model, or the plot settings).
+    '''
+    baseline_parameters = {
+        section: parameters[section] for section in baseline_parameter_sections
+    }
+
+    return hashlib.sha256(
+        json.dumps(baseline_parameters, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def get_baseline_files(parameters):
+    '''
+    Gets the database file, the folder for the output files, and the
+    key file (see get_baseline_key) of the baseline.
+    '''
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name_baseline = file_parameters['groupfile_name_baseline']
+    baseline_database_file = (
+        f'{output_folder}/{groupfile_name_baseline}.sqlite3'
+    )
+    baseline_folder = f'{output_folder}/{groupfile_name_baseline}'
+    baseline_key_file = f'{output_folder}/{groupfile_name_baseline}_key.txt'
+
+    return baseline_database_file, baseline_folder, baseline_key_file
+
+
+def remove_baseline(parameters):
+    '''
+    Removes the baseline, for example when the inputs in the database
+    no longer are the ones it was made with, so that reset_to_survey
+    computes the outputs again.
+    '''
+    (
+        baseline_database_file,
+        baseline_folder,
+        baseline_key_file,
+    ) = get_baseline_files(parameters)
+    # We remove the key first, so that a partly removed baseline
+    # is not used
+    for baseline_file in [baseline_key_file, baseline_database_file]:
+        if os.path.exists(baseline_file):
+            os.remove(baseline_file)
+    if os.path.exists(baseline_folder):
+        shutil.rmtree(baseline_folder)
+
+
+def save_baseline(parameters, model_store=None):
+    '''
+    Saves the baseline that reset_to_survey restores: a copy of the
+    database and of the output files that the sliders change
+    (see get_baseline_output_names), in a folder next to the database,
+    and the key of the parameters they were made with
+    (see get_baseline_key).
+    This needs to be done when the outputs have just been computed
+    from the survey data (see pLAtYpus.py and reset_to_survey), as the
+    database would otherwise contain the values of the sliders.
+    '''
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    database_file = f'{output_folder}/{groupfile_name}.sqlite3'
+    (
+        baseline_database_file,
+        baseline_folder,
+        baseline_key_file,
+    ) = get_baseline_files(parameters)
+
+    # We remove the earlier baseline (starting with its key, see
+    # remove_baseline), and write the key of the new one last,
+    # so that a baseline that was not fully saved is not used
+    remove_baseline(parameters)
+
+    # The write-ahead log needs to be in the database file before we copy it
+    model_store_module.get_model_store(parameters, model_store).checkpoint()
+    shutil.copy(database_file, baseline_database_file)
+
+    cook.check_if_folder_exists(baseline_folder)
+    baseline_output_names = get_baseline_output_names(parameters)
+    for output_file in os.listdir(output_folder):
+        if os.path.splitext(output_file)[0] in baseline_output_names:
+            shutil.copy(
+                f'{output_folder}/{output_file}',
+                f'{baseline_folder}/{output_file}',
+            )
+    with open(baseline_key_file, 'w') as key_file:
+        key_file.write(get_baseline_key(parameters))
+
 
 def reset_to_survey(parameters):
     '''
     The reset_to_survey function resets the values to the ones from the survey
     (that is before the sliders are used).
-    It does so by copying a copy of the database fwith only the survey data.
+    It does so by restoring the baseline (see save_baseline), i.e. a copy of
+    the database and of the outputs as computed from the survey.
+    If there is no (complete) baseline, or if it was made with other
+    parameters (see get_baseline_key), we copy the database with only
+    the survey data, make the outputs again (evolutions, long-term averages,
+    and maps), and save them as the baseline for the next resets.
     It uses the parameters as arguments.
     You can get them with the following two lines of code:
         parameters_file_name = 'pLAtYpus.toml'
@@ -105,9 +485,38 @@ def reset_to_survey(parameters):
     database_file_for_resets = (
         f'{output_folder}/{groupfile_name_only_survey}.sqlite3'
     )
+    (
+        baseline_database_file,
+        baseline_folder,
+        baseline_key_file,
+    ) = get_baseline_files(parameters)
+    # The connection to the database (and its write-ahead log)
+    # needs to be closed before we replace the file
+    model_store_module.close_model_store(parameters)
+    baseline_key = None
+    if (
+        os.path.exists(baseline_database_file)
+        and os.path.isdir(baseline_folder)
+        and os.path.exists(baseline_key_file)
+    ):
+        with open(baseline_key_file, 'r') as key_file:
+            baseline_key = key_file.read()
+    if baseline_key == get_baseline_key(parameters):
+        shutil.copy(baseline_database_file, database_file)
+        for baseline_file in os.listdir(baseline_folder):
+            shutil.copy(
+                f'{baseline_folder}/{baseline_file}',
+                f'{output_folder}/{baseline_file}',
+            )
+        return
+
     shutil.copy(database_file_for_resets, database_file)
     solver.get_all_evolutions(parameters)
     maps.make_long_term_average_tables(parameters)
+    # The maps are part of the baseline, so they need to be the ones
+    # of the survey data as well
+    maps.make_area_maps(parameters)
+    save_baseline(parameters)
 
 
 def update_survey_topic_values(
@@ -118,6 +527,7 @@ def update_survey_topic_values(
     adopt_leave,
     new_value,
     parameters,
+    model_store=None,
 ):
     '''
     This updates the survey topic values in the database.
@@ -129,24 +539,23 @@ def update_survey_topic_values(
     '''
     new_value = np.float64(new_value)
     # In case strings are entered, for example
-    file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
-    model_database = f'{output_folder}/{groupfile_name}.sqlite3'
-    table_to_update = f'"survey_topics"'
-    cook.update_database_table(
-        model_database,
-        table_to_update,
+    survey_topics_table_name = parameters['files']['survey_topics_table_name']
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    model_store.update_values(
+        survey_topics_table_name,
         [adopt_leave],
-        [new_value],
         ['Product', 'Country', 'Stakeholder', 'Component'],
-        ['=', '=', '=', '='],
-        [f'"{product}"', f'"{country}"', f'"{stakeholder}"', f'"{component}"'],
+        [(new_value, product, country, stakeholder, component)],
     )
 
 
 def update_intention_weights(
-    product, stakeholder, changed_intention_category, new_weight, parameters
+    product,
+    stakeholder,
+    changed_intention_category,
+    new_weight,
+    parameters,
+    model_store=None,
 ):
     '''
     This updates the Intention weights in the database.
@@ -155,80 +564,40 @@ def update_intention_weights(
     and its new weight. The other weights will be updated accordingly, so that
     their sum is still one.
     If there are more changes, you can iterate.
+    The new weights of all the categories are written in one transaction.
     '''
     new_weight = np.float64(new_weight)
     # In case strings are entered, for example
-    file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
-    model_database = f'{output_folder}/{groupfile_name}.sqlite3'
-    weights_table_name = f'"Intention Weights {product}"'
-    old_weights_query = cook.read_query_generator(
-        f'Category, {stakeholder}', weights_table_name, [], [], []
-    )
-    with sqlite3.connect(model_database) as database_connection:
-        old_weights = pd.read_sql(
-            old_weights_query, database_connection
-        ).set_index('Category')
-    old_weight_of_changed_category = old_weights.loc[
-        changed_intention_category
-    ].values[0]
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    weights_table_name = f'Intention Weights {product}'
+    old_weights = model_store.read_table(
+        weights_table_name, ['Category', stakeholder]
+    ).set_index('Category')
     intention_categories = old_weights.index
-    weights_for_weight_shift_split = [
-        old_weights.loc[intention_category].values[0]
-        if intention_category != changed_intention_category
-        else 0
-        for intention_category in intention_categories
-    ]
-    weights_for_weight_shift_split = np.array(
-        [
-            weight / sum(weights_for_weight_shift_split)
-            for weight in weights_for_weight_shift_split
-        ]
-    )
-    # This needs to be normalised, np.array so we can multiply it by a float
-    weight_shift_of_changed_category = (
-        new_weight - old_weight_of_changed_category
+    new_weights = scores.shift_category_weights(
+        old_weights[stakeholder].values,
+        intention_categories.get_loc(changed_intention_category),
+        new_weight,
     )
 
-    weight_shifts_other_categories = -(
-        weight_shift_of_changed_category * weights_for_weight_shift_split
+    model_store.update_values(
+        weights_table_name,
+        [stakeholder],
+        ['Category'],
+        zip(new_weights, intention_categories),
     )
-    # To keep the total at one
-
-    new_weights = [
-        new_weight
-        if intention_category == changed_intention_category
-        else max(
-            old_weights.loc[intention_category].values[0]
-            + weight_shifts_other_categories[intention_index],
-            0,
-        )  # To avoid negative weights
-        for intention_index, intention_category in enumerate(
-            intention_categories
-        )
-    ]
-
-    new_weights = [new_weight / sum(new_weights) for new_weight in new_weights]
-    # To ensure that the weights are normalised
-
-    for intention_category, weight in zip(intention_categories, new_weights):
-        cook.update_database_table(
-            model_database,
-            weights_table_name,
-            [stakeholder],
-            [weight],
-            ['Category'],
-            ['='],
-            [f'"{intention_category}"'],
-        )
     print(
         'Update all sliders (without running the solver in an infinite loop!)'
     )
 
 
 def update_initial_yes(
-    product, updated_country, stakeholder, new_initial_yes_value, parameters
+    product,
+    updated_country,
+    stakeholder,
+    new_initial_yes_value,
+    parameters,
+    model_store=None,
 ):
     '''
     This updates the Inital Yes values in the database.
@@ -238,23 +607,18 @@ def update_initial_yes(
     '''
     new_initial_yes_value = np.float64(new_initial_yes_value)
     # In case strings are entered, for example
-    file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
-    model_database = f'{output_folder}/{groupfile_name}.sqlite3'
-    table_to_update = f'"Initial Yes {product}"'
-    cook.update_database_table(
-        model_database,
-        table_to_update,
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    model_store.update_values(
+        f'Initial Yes {product}',
         [stakeholder],
-        [new_initial_yes_value],
         ['Country'],
-        ['='],
-        [f'"{updated_country}"'],
+        [(new_initial_yes_value, updated_country)],
     )
 
 
-def update_from_slider(slider_name, slider_value, parameters):
+def update_from_slider(
+    slider_name, slider_value, parameters, model_store=None
+):
     '''
     The update_from_slider function updates the pLAtYpus.sqlite3 database
     with the change value of a given slider. It has two arguments:
@@ -308,6 +672,7 @@ def update_from_slider(slider_name, slider_value, parameters):
             slider_stakeholder,
             slider_value,
             parameters,
+            model_store,
         )
     elif slider_type == 'intention_weight':
         changed_intention_category = slider_split_values[4]
@@ -317,6 +682,7 @@ def update_from_slider(slider_name, slider_value, parameters):
             changed_intention_category,
             slider_value,
             parameters,
+            model_store,
         )
     elif slider_type == 'survey_topic':
         slider_topic = slider_split_values[4]
@@ -329,10 +695,155 @@ def update_from_slider(slider_name, slider_value, parameters):
             slider_adopt_leave,
             slider_value,
             parameters,
+            model_store,
         )
 
 
-def make_outputs(product, changed_country, parameters):
+def update_from_sliders(slider_values, parameters, model_store=None):
+    '''
+    Updates the database with the values of several sliders at once.
+    The slider values are a dictionary with the slider names (see
+    update_from_slider) as keys, and the result is the same as calling
+    update_from_slider for each of them (in the order of the dictionary).
+    The intention weights of all the changed products and stakeholders
+    are shifted together (see scores.shift_category_weights), and all
+    the changes are written in one transaction.
+    Returns the set of (product, country) systems that are stale (i.e.
+    whose evolutions need to be recomputed). The intention weights are
+    pan-european, so changing them makes all the countries
+    of the product stale.
+    '''
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    countries = parameters['survey']['countries']
+    survey_topics_table_name = parameters['files']['survey_topics_table_name']
+
+    stale_systems = set()
+    # The updates of each table and updated column, with the values
+    # of the rows to update
+    table_updates = collections.defaultdict(list)
+    # The changed categories and their new weights, in order,
+    # for each (product, stakeholder)
+    weight_changes = collections.defaultdict(list)
+    for slider_name, slider_value in slider_values.items():
+        slider_split_values = slider_name.split('__')
+        slider_type = slider_split_values[0]
+        slider_product = slider_split_values[1]
+        slider_stakeholder = slider_split_values[2]
+        slider_country = slider_split_values[3]
+        slider_value = np.float64(slider_value)
+        # In case strings are entered, for example
+        if slider_type == 'initial_yes':
+            table_updates[
+                (
+                    f'Initial Yes {slider_product}',
+                    (slider_stakeholder,),
+                    ('Country',),
+                )
+            ].append((slider_value, slider_country))
+            stale_systems.add((slider_product, slider_country))
+        elif slider_type == 'intention_weight':
+            changed_intention_category = slider_split_values[4]
+            weight_changes[(slider_product, slider_stakeholder)].append(
+                (changed_intention_category, slider_value)
+            )
+            stale_systems.update(
+                (slider_product, country) for country in countries
+            )
+        elif slider_type == 'survey_topic':
+            slider_topic = slider_split_values[4]
+            slider_adopt_leave = slider_split_values[5]
+            table_updates[
+                (
+                    survey_topics_table_name,
+                    (slider_adopt_leave,),
+                    ('Product', 'Country', 'Stakeholder', 'Component'),
+                )
+            ].append(
+                (
+                    slider_value,
+                    slider_product,
+                    slider_country,
+                    slider_stakeholder,
+                    slider_topic,
+                )
+            )
+            stale_systems.add((slider_product, slider_country))
+        else:
+            raise ValueError(f'Unknown slider type: {slider_type}')
+
+    if len(weight_changes) > 0:
+        weight_products = list(
+            dict.fromkeys(product for product, stakeholder in weight_changes)
+        )
+        old_weights = {
+            product: model_store.read_table(
+                f'Intention Weights {product}'
+            ).set_index('Category')
+            for product in weight_products
+        }
+        weight_systems = list(weight_changes.keys())
+        category_weights = np.array(
+            [
+                old_weights[product][stakeholder].values
+                for product, stakeholder in weight_systems
+            ]
+        )
+        # We shift the first change of each (product, stakeholder)
+        # at once, then the second ones, and so on, so that the changes
+        # of a given (product, stakeholder) are applied in order
+        change_amount = max(
+            len(system_weight_changes)
+            for system_weight_changes in weight_changes.values()
+        )
+        for change_index in range(change_amount):
+            changed_systems = [
+                system_index
+                for system_index, weight_system in enumerate(weight_systems)
+                if len(weight_changes[weight_system]) > change_index
+            ]
+            changed_category_indices = []
+            new_weights = []
+            for system_index in changed_systems:
+                product, stakeholder = weight_systems[system_index]
+                (
+                    changed_intention_category,
+                    new_weight,
+                ) = weight_changes[
+                    (product, stakeholder)
+                ][change_index]
+                changed_category_indices.append(
+                    old_weights[product].index.get_loc(
+                        changed_intention_category
+                    )
+                )
+                new_weights.append(new_weight)
+            category_weights[changed_systems] = scores.shift_category_weights(
+                category_weights[changed_systems],
+                changed_category_indices,
+                new_weights,
+            )
+        for system_index, (product, stakeholder) in enumerate(weight_systems):
+            table_updates[
+                (f'Intention Weights {product}', (stakeholder,), ('Category',))
+            ].extend(
+                zip(category_weights[system_index], old_weights[product].index)
+            )
+
+    model_store.update_tables(
+        [
+            (table_name, updated_quantities, filter_quantities, rows)
+            for (
+                table_name,
+                updated_quantities,
+                filter_quantities,
+            ), rows in table_updates.items()
+        ]
+    )
+
+    return stale_systems
+
+
+def make_outputs(product, changed_country, parameters, model_store=None):
     '''
     The make_outputs function makes the plots/figures for a given product
     and country (you can also use EU if you want to change them all,
@@ -344,22 +855,24 @@ def make_outputs(product, changed_country, parameters):
         countries = [changed_country]
     start = datetime.datetime.now()
     for country in countries:
-        solver.get_evolutions_and_plots(product, country, parameters)
+        get_cached_evolution_and_plots(
+            product, country, parameters, model_store
+        )
     end = datetime.datetime.now()
     print((end - start).total_seconds())
 
     start = datetime.datetime.now()
-    maps.make_long_term_average_tables(parameters)
+    maps.make_long_term_average_tables(parameters, model_store)
     end = datetime.datetime.now()
     print((end - start).total_seconds())
 
     start = datetime.datetime.now()
-    maps.make_product_area_map(product, parameters)
+    maps.make_product_area_map(product, parameters, model_store)
     end = datetime.datetime.now()
     print((end - start).total_seconds())
 
 
-def get_output_tables(product, parameters):
+def get_output_tables(product, parameters, model_store=None):
     '''
     The get_output_tables produces Dataframes that can be used to produce plots
     for a given product. It takes the product name (autonomous_cars,
@@ -376,30 +889,17 @@ def get_output_tables(product, parameters):
     of all three stakeholders in that country for the product at hand.
     '''
     start = datetime.datetime.now()
-    file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
-    model_database = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
 
     countries = parameters['survey']['countries']
 
     adoption_curves = {}
-    with sqlite3.connect(model_database) as database_connection:
-        long_term_averages_table = f'long_term_averages_{product}'
-        long_term_averages_query = cook.read_query_generator(
-            '*', long_term_averages_table, [], [], []
-        )
-        data_for_maps = pd.read_sql(
-            long_term_averages_query, database_connection
-        )
-        for country in countries:
-            adoption_table = f'{product}_{country}'
-            adoption_query = cook.read_query_generator(
-                '*', adoption_table, [], [], []
-            )
-            adoption_curves[country] = pd.read_sql(
-                adoption_query, database_connection
-            )
+    long_term_averages_table = f'long_term_averages_{product}'
+    data_for_maps = model_store.read_table(long_term_averages_table)
+    for country in countries:
+        adoption_curves[country] = solver.read_yes_evolution(
+            product, country, parameters, model_store=model_store
+        ).reset_index()
     end = datetime.datetime.now()
     print((end - start).total_seconds())
     return data_for_maps, adoption_curves
@@ -0,0 +1,339 @@
+'''
+This module benchmarks the solver methods and tolerances on all the
+(product, country) systems and recommends a solver configuration for each.
+Each system is solved with all the methods and tolerance settings of the
+[benchmark] section of the parameters file, and we record the number of
+evaluations of the model (and of its Jacobian and LU decompositions),
+the wall time, and the largest deviation from a reference solution
+(with tight tolerances).
+As the sliders of the GRETA tool change the systems, we also solve
+variants of each system with the sliders at extreme values (see
+get_slider_variants), and the configurations need to succeed
+and meet the accuracy target on all of them.
+The recommended configuration of a system is the fastest one that meets
+the accuracy target (or the reference configuration if none does).
+These configurations are written to a table that get_yes_evolution uses
+when use_solver_configurations is set in the [pLAtYpus] section.
+'''
+
+import concurrent.futures
+import datetime
+import itertools
+import time
+
+import numpy as np
+import pandas as pd
+import scipy.integrate as spi
+from ETS_CookBook import ETS_CookBook as cook
+
+try:
+    from pLAtYpus_TNO import solver
+except ModuleNotFoundError:
+    import solver
+
+try:
+    from pLAtYpus_TNO import scores
+except ModuleNotFoundError:
+    import scores
+
+
+def get_benchmark_solution(
+    initial_yes,
+    compiled_coefficients,
+    time_range,
+    solver_method,
+    relative_tolerance,
+    absolute_tolerance,
+    parameters,
+):
+    '''
+    Solves a system with a given method and tolerances (and the other
+    solver options of the parameters file, see solver.get_solver_options).
+    Returns the yes values at the times of the time range and the
+    solution of solve_ivp (which contains the evaluation counts).
+    '''
+    benchmark_parameters = dict(parameters)
+    benchmark_parameters['pLAtYpus'] = dict(parameters['pLAtYpus'])
+    benchmark_parameters['pLAtYpus']['solver_method'] = solver_method
+    benchmark_parameters['pLAtYpus']['relative_tolerance'] = relative_tolerance
+    benchmark_parameters['pLAtYpus']['absolute_tolerance'] = absolute_tolerance
+
+    yes_solutions = spi.solve_ivp(
+        solver.compiled_pLAtYpus_model,
+        t_span=[time_range[0], time_range[-1]],
+        y0=initial_yes,
+        args=(compiled_coefficients,),
+        dense_output=True,
+        **solver.get_solver_options(
+            benchmark_parameters, compiled_coefficients
+        ),
+    )
+
+    return yes_solutions.sol(time_range).T, yes_solutions
+
+
+def get_slider_variants(initial_yes, compiled_coefficients, parameters):
+    '''
+    Gets variants of a system with the sliders at the values of the
+    [benchmark] section of the parameters file: all the initial yes values
+    at each of the slider initial yes values, and each intention category
+    (of all the stakeholders) at each of the slider weight values, with
+    the other weights shifted as in the GRETA tool
+    (see scores.shift_category_weights).
+    Returns a list of initial yes values and compiled coefficients.
+    '''
+    benchmark_parameters = parameters['benchmark']
+    slider_initial_yes_values = benchmark_parameters[
+        'slider_initial_yes_values'
+    ]
+    slider_weight_values = benchmark_parameters['slider_weight_values']
+    category_weights = compiled_coefficients['category_weights']
+
+    slider_variants = [
+        (
+            np.full(np.shape(initial_yes), slider_initial_yes, dtype=float),
+            compiled_coefficients,
+        )
+        for slider_initial_yes in slider_initial_yes_values
+    ]
+    for slider_weight, category_index in itertools.product(
+        slider_weight_values, range(np.shape(category_weights)[-1])
+    ):
+        variant_coefficients = dict(compiled_coefficients)
+        variant_coefficients[
+            'category_weights'
+        ] = scores.shift_category_weights(
+            category_weights, category_index, slider_weight
+        )
+        slider_variants.append((initial_yes, variant_coefficients))
+
+    return slider_variants
+
+
+def get_system_benchmark(system, initial_yes, model_coefficients, parameters):
+    '''
+    Benchmarks all the methods and tolerance settings on one
+    (product, country) system.
+    This is a function of the module so that processes can run it.
+    Returns a DataFrame with the method and tolerances as index and
+    the evaluation counts, wall time (the shortest of the repeats),
+    success, and largest deviation from the reference as columns.
+    The counts and wall time are those of the system itself, while
+    the success and deviation also cover its slider variants
+    (see get_slider_variants).
+    '''
+    benchmark_parameters = parameters['benchmark']
+    solver_methods = benchmark_parameters['solver_methods']
+    tolerance_settings = benchmark_parameters['tolerance_settings']
+    reference_method = benchmark_parameters['reference_method']
+    reference_relative_tolerance = benchmark_parameters[
+        'reference_relative_tolerance'
+    ]
+    reference_absolute_tolerance = benchmark_parameters[
+        'reference_absolute_tolerance'
+    ]
+    repeat_amount = benchmark_parameters['repeat_amount']
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    time_span = pLAtYpus_parameters['time_span']
+    time_steps = pLAtYpus_parameters['time_steps']
+
+    compiled_coefficients = scores.compile_model_coefficients(
+        model_coefficients
+    )
+    time_range = np.linspace(time_span[0], time_span[1], time_steps)
+    reference_yes_values, reference_solutions = get_benchmark_solution(
+        initial_yes,
+        compiled_coefficients,
+        time_range,
+        reference_method,
+        reference_relative_tolerance,
+        reference_absolute_tolerance,
+        parameters,
+    )
+    slider_variants = get_slider_variants(
+        initial_yes, compiled_coefficients, parameters
+    )
+    variants_reference_yes_values = [
+        get_benchmark_solution(
+            variant_initial_yes,
+            variant_coefficients,
+            time_range,
+            reference_method,
+            reference_relative_tolerance,
+            reference_absolute_tolerance,
+            parameters,
+        )[0]
+        for variant_initial_yes, variant_coefficients in slider_variants
+    ]
+
+    benchmark_rows = []
+    for solver_method, (
+        relative_tolerance,
+        absolute_tolerance,
+    ) in itertools.product(solver_methods, tolerance_settings):
+        wall_times = []
+        for repeat in range(repeat_amount):
+            start = time.perf_counter()
+            yes_values, yes_solutions = get_benchmark_solution(
+                initial_yes,
+                compiled_coefficients,
+                time_range,
+                solver_method,
+                relative_tolerance,
+                absolute_tolerance,
+                parameters,
+            )
+            wall_times.append(time.perf_counter() - start)
+        success = yes_solutions.success
+        deviation = np.max(np.abs(yes_values - reference_yes_values))
+        for (variant_initial_yes, variant_coefficients), (
+            variant_reference_yes_values
+        ) in zip(slider_variants, variants_reference_yes_values):
+            variant_yes_values, variant_yes_solutions = get_benchmark_solution(
+                variant_initial_yes,
+                variant_coefficients,
+                time_range,
+                solver_method,
+                relative_tolerance,
+                absolute_tolerance,
+                parameters,
+            )
+            success = success and variant_yes_solutions.success
+            deviation = max(
+                deviation,
+                np.max(
+                    np.abs(variant_yes_values - variant_reference_yes_values)
+                ),
+            )
+        benchmark_rows.append(
+            [
+                solver_method,
+                relative_tolerance,
+                absolute_tolerance,
+                success,
+                yes_solutions.nfev,
+                yes_solutions.njev,
+                yes_solutions.nlu,
+                min(wall_times),
+                deviation,
+            ]
+        )
+
+    system_benchmark = pd.DataFrame(
+        benchmark_rows,
+        columns=[
+            'Method',
+            'Relative tolerance',
+            'Absolute tolerance',
+            'Success',
+            'Model evaluations',
+            'Jacobian evaluations',
+            'LU decompositions',
+            'Wall time',
+            'Deviation',
+        ],
+    ).set_index(['Method', 'Relative tolerance', 'Absolute tolerance'])
+
+    return system_benchmark
+
+
+def get_recommended_configuration(system_benchmark, parameters):
+    '''
+    Gets the fastest configuration of a system benchmark (see
+    get_system_benchmark) that meets the accuracy target, or the
+    reference configuration if none does.
+    Returns the method and the relative and absolute tolerances.
+    '''
+    benchmark_parameters = parameters['benchmark']
+    accuracy_target = benchmark_parameters['accuracy_target']
+
+    accurate_configurations = system_benchmark[
+        system_benchmark['Success']
+        & (system_benchmark['Deviation'] <= accuracy_target)
+    ]
+    if len(accurate_configurations) == 0:
+        return (
+            benchmark_parameters['reference_method'],
+            benchmark_parameters['reference_relative_tolerance'],
+            benchmark_parameters['reference_absolute_tolerance'],
+        )
+
+    return accurate_configurations['Wall time'].idxmin()
+
+
+def run_solver_benchmark(parameters, jobs=None):
+    '''
+    Benchmarks all the (product, country) systems (spread over a pool
+    of processes, see solver.get_job_amount, which you might want to keep
+    at one for the most reliable wall times), and saves the benchmark
+    results and the recommended configuration of each system.
+    '''
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    benchmark_parameters = parameters['benchmark']
+    benchmark_table_name = benchmark_parameters['benchmark_table_name']
+    solver_configurations_table_name = parameters['pLAtYpus'][
+        'solver_configurations_table_name'
+    ]
+    jobs = solver.get_job_amount(parameters, jobs)
+
+    (
+        systems_initial_yes,
+        systems_model_coefficients,
+    ) = solver.get_all_systems_inputs(parameters)
+    systems = list(systems_model_coefficients.keys())
+    systems_arguments = (
+        systems,
+        [systems_initial_yes[system] for system in systems],
+        [systems_model_coefficients[system] for system in systems],
+        itertools.repeat(parameters),
+    )
+
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs
+        ) as executor:
+            systems_benchmarks = list(
+                executor.map(get_system_benchmark, *systems_arguments)
+            )
+    else:
+        systems_benchmarks = list(
+            map(get_system_benchmark, *systems_arguments)
+        )
+
+    solver_benchmark = pd.concat(
+        systems_benchmarks, keys=systems, names=['Product', 'Country']
+    )
+    cook.save_dataframe(
+        solver_benchmark,
+        benchmark_table_name,
+        groupfile_name,
+        output_folder,
+        parameters,
+    )
+
+    solver_configurations = pd.DataFrame(
+        [
+            get_recommended_configuration(system_benchmark, parameters)
+            for system_benchmark in systems_benchmarks
+        ],
+        index=pd.MultiIndex.from_tuples(systems, names=['Product', 'Country']),
+        columns=['Method', 'Relative tolerance', 'Absolute tolerance'],
+    )
+    cook.save_dataframe(
+        solver_configurations,
+        solver_configurations_table_name,
+        groupfile_name,
+        output_folder,
+        parameters,
+    )
+
+
+if __name__ == '__main__':
+    start = datetime.datetime.now()
+    parameters_file_name = 'pLAtYpus.toml'
+    parameters = cook.parameters_from_TOML(parameters_file_name)
+    run_solver_benchmark(parameters)
+    end = datetime.datetime.now()
+    print((end - start).total_seconds())
@@ -0,0 +1,552 @@
+'''
+This module calibrates the intention weights and the initial yes values
+of the model against observed engagement levels.
+The observed engagement levels are in a file (see the [calibration]
+section of the parameters file) with Product, Country, and Time columns,
+and a column per stakeholder (with empty values where a stakeholder
+was not observed).
+We fit the parameters of each product by (bounded) least squares.
+The weights are pan-european, so we fit them for all the countries
+of the product at once, while the initial yes values are fitted per
+country. We solve all the countries of a product together (as stacked
+systems) and get the exact gradients of the residuals from the forward
+sensitivities of the yes values, which we integrate alongside them.
+The weights are written as the softmax of free values, so that they stay
+positive and add up to one.
+The calibrated values are written to the Intention Weights and Initial Yes
+tables of the database.
+'''
+
+import concurrent.futures
+import datetime
+import itertools
+
+import numpy as np
+import pandas as pd
+import scipy.integrate as spi
+import scipy.optimize as spo
+from ETS_CookBook import ETS_CookBook as cook
+
+try:
+    from pLAtYpus_TNO import solver
+except ModuleNotFoundError:
+    import solver
+
+try:
+    from pLAtYpus_TNO import scores
+except ModuleNotFoundError:
+    import scores
+
+try:
+    from pLAtYpus_TNO import GRETA_tool
+except ModuleNotFoundError:
+    import GRETA_tool
+
+try:
+    from pLAtYpus_TNO import model_store as model_store_module
+except ModuleNotFoundError:
+    import model_store as model_store_module
+
+
+def get_observed_engagement(parameters):
+    '''
+    Reads the observed engagement levels and returns them in a DataFrame
+    with Product, Country, and Time as index and the stakeholders
+    as columns.
+    '''
+    calibration_parameters = parameters['calibration']
+    observed_data_file = calibration_parameters['observed_data_file']
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    stakeholders = pLAtYpus_parameters['stakeholders']
+    time_header = pLAtYpus_parameters['time_header']
+
+    observed_engagement = pd.read_csv(observed_data_file)
+    observed_engagement = observed_engagement.set_index(
+        ['Product', 'Country', time_header]
+    )[stakeholders].sort_index()
+
+    return observed_engagement
+
+
+def compiled_calibration_model(
+    time,
+    augmented_yes,
+    compiled_coefficients,
+    weight_stakeholders,
+    weight_categories,
+):
+    '''
+    This is the pLAtYpus model of stacked systems, augmented with the
+    sensitivities of their yes values to their own initial yes values and
+    to the (shared) category weights, with
+    (system, stakeholder, parameter) dimensions. The parameters are the
+    initial yes values, followed by the weights at the given positions
+    (stakeholder and category) in the compiled weights.
+    '''
+    system_amount = compiled_coefficients['system_amount']
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    weight_amount = len(weight_stakeholders)
+    yes_values = np.reshape(
+        augmented_yes[: system_amount * stakeholder_amount],
+        (system_amount, stakeholder_amount),
+    )
+    yes_sensitivities = np.reshape(
+        augmented_yes[system_amount * stakeholder_amount :],
+        (
+            system_amount,
+            stakeholder_amount,
+            stakeholder_amount + weight_amount,
+        ),
+    )
+
+    yes_change = solver.compiled_pLAtYpus_model(
+        time, np.ravel(yes_values), compiled_coefficients
+    )
+    jacobian_blocks = solver.compiled_jacobian_blocks(
+        yes_values, compiled_coefficients
+    )
+    weight_derivatives = solver.compiled_weight_derivatives(
+        yes_values, compiled_coefficients
+    )
+    sensitivity_change = np.einsum(
+        'nij,njp->nip', jacobian_blocks, yes_sensitivities
+    )
+    sensitivity_change[
+        :,
+        weight_stakeholders,
+        stakeholder_amount + np.arange(weight_amount),
+    ] += weight_derivatives[:, weight_stakeholders, weight_categories]
+
+    return np.concatenate((yes_change, np.ravel(sensitivity_change)))
+
+
+def get_calibration_weights(weight_values, calibration_inputs):
+    '''
+    Gets the category weights (at the weight positions) that correspond
+    to free weight values, which are the logarithms of the weights
+    of each stakeholder relative to its last category
+    (which is therefore not free).
+    Returns the weights and their derivatives with respect to the free
+    values (in a (weight, free value) array).
+    '''
+    weight_stakeholders = calibration_inputs['weight_stakeholders']
+    free_weights = calibration_inputs['free_weights']
+
+    weight_exponents = np.zeros(len(weight_stakeholders))
+    weight_exponents[free_weights] = weight_values
+    same_stakeholder = (
+        weight_stakeholders[:, np.newaxis] == weight_stakeholders
+    )
+    # We subtract the maximum of each stakeholder for numerical stability
+    exponentials = np.exp(
+        weight_exponents
+        - np.max(
+            np.where(same_stakeholder, weight_exponents, -np.inf), axis=-1
+        )
+    )
+    weights = exponentials / (same_stakeholder @ exponentials)
+
+    weight_derivatives = same_stakeholder * (
+        np.diag(weights) - weights[:, np.newaxis] * weights
+    )
+
+    return weights, weight_derivatives[:, free_weights]
+
+
+def get_calibration_solution(fitted_values, calibration_inputs):
+    '''
+    Solves the stacked systems of a product (with their sensitivities)
+    for given values of the fitted calibration values (which are
+    the free weight values, followed by the initial yes values
+    of the systems, with the ones that we do not fit kept
+    at their initial values), and gets the residuals against the observed
+    engagement levels and their Jacobian with respect to
+    the fitted values.
+    We keep the last solution, as the optimizer asks for the residuals
+    and the Jacobian of the same values one after the other.
+    '''
+    last_solution = calibration_inputs['last_solution']
+    if last_solution is not None and np.array_equal(
+        last_solution[0], fitted_values
+    ):
+        return last_solution[1], last_solution[2]
+    is_fitted = calibration_inputs['is_fitted']
+    calibration_values = np.array(
+        calibration_inputs['initial_calibration_values']
+    )
+    calibration_values[is_fitted] = fitted_values
+
+    compiled_coefficients = dict(calibration_inputs['compiled_coefficients'])
+    weight_stakeholders = calibration_inputs['weight_stakeholders']
+    weight_categories = calibration_inputs['weight_categories']
+    free_weights = calibration_inputs['free_weights']
+    observation_times = calibration_inputs['observation_times']
+    observed_values = calibration_inputs['observed_values']
+    is_observed = calibration_inputs['is_observed']
+    parameters = calibration_inputs['parameters']
+    time_span = parameters['pLAtYpus']['time_span']
+    system_amount = compiled_coefficients['system_amount']
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    weight_amount = len(weight_stakeholders)
+    free_weight_amount = len(free_weights)
+
+    weights, weight_derivatives = get_calibration_weights(
+        calibration_values[:free_weight_amount], calibration_inputs
+    )
+    category_weights = np.zeros(
+        compiled_coefficients['category_weights'].shape
+    )
+    category_weights[:, weight_stakeholders, weight_categories] = weights
+    compiled_coefficients['category_weights'] = category_weights
+    initial_yes = calibration_values[free_weight_amount:]
+
+    initial_sensitivities = np.zeros(
+        (system_amount, stakeholder_amount, stakeholder_amount + weight_amount)
+    )
+    initial_sensitivities[:, :, :stakeholder_amount] = np.eye(
+        stakeholder_amount
+    )
+    # The model Jacobian is not the one of the augmented system and the
+    # augmented model is not vectorized, so we leave these options out
+    solver_options = solver.get_solver_options(
+        parameters, compiled_coefficients
+    )
+    solver_options.pop('jac', None)
+    solver_options['vectorized'] = False
+    calibration_solutions = spi.solve_ivp(
+        compiled_calibration_model,
+        t_span=[time_span[0], observation_times[-1]],
+        y0=np.concatenate((initial_yes, np.ravel(initial_sensitivities))),
+        args=(compiled_coefficients, weight_stakeholders, weight_categories),
+        dense_output=True,
+        **solver_options,
+    )
+    augmented_yes_values = calibration_solutions.sol(observation_times).T
+    yes_values = np.reshape(
+        augmented_yes_values[:, : system_amount * stakeholder_amount],
+        (len(observation_times), system_amount, stakeholder_amount),
+    )
+    yes_sensitivities = np.reshape(
+        augmented_yes_values[:, system_amount * stakeholder_amount :],
+        (
+            len(observation_times),
+            system_amount,
+            stakeholder_amount,
+            stakeholder_amount + weight_amount,
+        ),
+    )
+
+    residuals = (yes_values - observed_values)[is_observed]
+
+    residual_jacobian = np.zeros(
+        yes_values.shape + (free_weight_amount + len(initial_yes),)
+    )
+    residual_jacobian[..., :free_weight_amount] = (
+        yes_sensitivities[..., stakeholder_amount:] @ weight_derivatives
+    )
+    # Each system only depends on its own initial yes values
+    for system_index in range(system_amount):
+        initial_yes_start = (
+            free_weight_amount + system_index * stakeholder_amount
+        )
+        residual_jacobian[
+            :,
+            system_index,
+            :,
+            initial_yes_start : initial_yes_start + stakeholder_amount,
+        ] = yes_sensitivities[:, system_index, :, :stakeholder_amount]
+    residual_jacobian = residual_jacobian[is_observed][:, is_fitted]
+
+    calibration_inputs['last_solution'] = (
+        np.array(fitted_values),
+        residuals,
+        residual_jacobian,
+    )
+
+    return residuals, residual_jacobian
+
+
+def get_calibration_residuals(fitted_values, calibration_inputs):
+    '''
+    Returns the residuals of the fitted values
+    (see get_calibration_solution).
+    '''
+    residuals, residual_jacobian = get_calibration_solution(
+        fitted_values, calibration_inputs
+    )
+
+    return residuals
+
+
+def get_calibration_jacobian(fitted_values, calibration_inputs):
+    '''
+    Returns the Jacobian of the residuals of the fitted values
+    (see get_calibration_solution).
+    '''
+    residuals, residual_jacobian = get_calibration_solution(
+        fitted_values, calibration_inputs
+    )
+
+    return residual_jacobian
+
+
+def get_product_calibration(
+    product,
+    countries,
+    countries_initial_yes,
+    countries_model_coefficients,
+    product_observed_engagement,
+    parameters,
+):
+    '''
+    Calibrates the intention weights of a product and the initial yes
+    values of its countries (that have observations) against the
+    observed engagement levels.
+    This is a function of the module so that processes can run it.
+    Returns the calibrated weights (with (stakeholder, category)
+    dimensions, as in the compiled coefficients) and initial yes values
+    (with (country, stakeholder) dimensions).
+    '''
+    calibration_parameters = parameters['calibration']
+    fit_intention_weights = calibration_parameters['fit_intention_weights']
+    fit_initial_yes = calibration_parameters['fit_initial_yes']
+    maximum_function_evaluations = calibration_parameters[
+        'maximum_function_evaluations'
+    ]
+    calibration_tolerance = calibration_parameters['calibration_tolerance']
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    time_header = parameters['pLAtYpus']['time_header']
+
+    compiled_coefficients = scores.stack_compiled_coefficients(
+        [
+            scores.compile_model_coefficients(model_coefficients)
+            for model_coefficients in countries_model_coefficients
+        ]
+    )
+    intention_categories = countries_model_coefficients[0][
+        'intention_categories'
+    ]
+    weight_positions = [
+        (stakeholder_index, category_index)
+        for stakeholder_index, stakeholder in enumerate(stakeholders)
+        for category_index, category in enumerate(
+            intention_categories[stakeholder]
+        )
+    ]
+    weight_stakeholders, weight_categories = np.transpose(weight_positions)
+    # The last category of each stakeholder is the reference
+    # of its free weight values
+    last_weights = np.append(
+        weight_stakeholders[1:] != weight_stakeholders[:-1], True
+    )
+    free_weights = np.flatnonzero(~last_weights)
+
+    observation_times = np.unique(
+        product_observed_engagement.index.get_level_values(time_header)
+    )
+    observed_values = np.full(
+        (len(observation_times), len(countries), len(stakeholders)), np.nan
+    )
+    for country_index, country in enumerate(countries):
+        if country in product_observed_engagement.index.get_level_values(
+            'Country'
+        ):
+            country_observed_engagement = product_observed_engagement.loc[
+                country
+            ]
+            observed_values[
+                np.searchsorted(
+                    observation_times, country_observed_engagement.index
+                ),
+                country_index,
+            ] = country_observed_engagement.values
+    is_observed = ~np.isnan(observed_values)
+
+    current_weights = compiled_coefficients['category_weights'][
+        0, weight_stakeholders, weight_categories
+    ]
+    # The free values are the logarithms of the weights relative
+    # to the last weight of their stakeholder
+    reference_weights = current_weights[last_weights][weight_stakeholders]
+    initial_weight_values = np.log(
+        np.maximum(current_weights, np.finfo(float).tiny)
+        / np.maximum(reference_weights, np.finfo(float).tiny)
+    )[free_weights]
+    initial_calibration_values = np.concatenate(
+        (
+            initial_weight_values,
+            np.clip(np.ravel(countries_initial_yes), 0, 1),
+        )
+    )
+    is_fitted = np.concatenate(
+        (
+            np.full(len(free_weights), fit_intention_weights),
+            np.repeat(np.any(is_observed, axis=(0, 2)), len(stakeholders))
+            & fit_initial_yes,
+        )
+    )
+    lower_bounds = np.concatenate(
+        (
+            np.full(len(free_weights), -np.inf),
+            np.zeros(len(stakeholders) * len(countries)),
+        )
+    )
+    upper_bounds = np.concatenate(
+        (
+            np.full(len(free_weights), np.inf),
+            np.ones(len(stakeholders) * len(countries)),
+        )
+    )
+
+    calibration_inputs = {}
+    calibration_inputs['compiled_coefficients'] = compiled_coefficients
+    calibration_inputs['weight_stakeholders'] = weight_stakeholders
+    calibration_inputs['weight_categories'] = weight_categories
+    calibration_inputs['free_weights'] = free_weights
+    calibration_inputs['observation_times'] = observation_times
+    calibration_inputs['observed_values'] = observed_values
+    calibration_inputs['is_observed'] = is_observed
+    calibration_inputs['is_fitted'] = is_fitted
+    calibration_inputs[
+        'initial_calibration_values'
+    ] = initial_calibration_values
+    calibration_inputs['parameters'] = parameters
+    calibration_inputs['last_solution'] = None
+
+    calibration_values = np.array(initial_calibration_values)
+    if np.any(is_fitted):
+        calibration_results = spo.least_squares(
+            get_calibration_residuals,
+            initial_calibration_values[is_fitted],
+            jac=get_calibration_jacobian,
+            bounds=(lower_bounds[is_fitted], upper_bounds[is_fitted]),
+            method='trf',
+            ftol=calibration_tolerance,
+            xtol=calibration_tolerance,
+            gtol=calibration_tolerance,
+            max_nfev=maximum_function_evaluations,
+            args=(calibration_inputs,),
+        )
+        calibration_values[is_fitted] = calibration_results.x
+
+    weights, weight_derivatives = get_calibration_weights(
+        calibration_values[: len(free_weights)], calibration_inputs
+    )
+    calibrated_weights = np.zeros(
+        compiled_coefficients['category_weights'].shape[1:]
+    )
+    calibrated_weights[weight_stakeholders, weight_categories] = weights
+    calibrated_initial_yes = np.reshape(
+        calibration_values[len(free_weights) :],
+        (len(countries), len(stakeholders)),
+    )
+
+    return calibrated_weights, calibrated_initial_yes
+
+
+def calibrate_all_products(parameters, jobs=None, model_store=None):
+    '''
+    Calibrates the intention weights and initial yes values of all
+    the products that have observed engagement levels (spread over a pool
+    of processes, see solver.get_job_amount) and writes them to
+    the Intention Weights and Initial Yes tables of these products.
+    The outputs need to be made again after that (see
+    make_all_outputs), and we remove the baseline of the GRETA tool, which
+    was made with the values from before the calibration.
+    The tables are read and written with a model store (see the
+    model_store module).
+    '''
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    countries = parameters['survey']['countries']
+    jobs = solver.get_job_amount(parameters, jobs)
+
+    observed_engagement = get_observed_engagement(parameters)
+    products = [
+        product
+        for product in parameters['products']
+        if product in observed_engagement.index.get_level_values('Product')
+    ]
+    (
+        systems_initial_yes,
+        systems_model_coefficients,
+    ) = solver.get_all_systems_inputs(parameters, model_store)
+    products_arguments = (
+        products,
+        itertools.repeat(countries),
+        [
+            [systems_initial_yes[(product, country)] for country in countries]
+            for product in products
+        ],
+        [
+            [
+                systems_model_coefficients[(product, country)]
+                for country in countries
+            ]
+            for product in products
+        ],
+        [observed_engagement.loc[product] for product in products],
+        itertools.repeat(parameters),
+    )
+
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs
+        ) as executor:
+            products_calibration = list(
+                executor.map(get_product_calibration, *products_arguments)
+            )
+    else:
+        products_calibration = list(
+            map(get_product_calibration, *products_arguments)
+        )
+
+    for product, (calibrated_weights, calibrated_initial_yes) in zip(
+        products, products_calibration
+    ):
+        intention_categories = systems_model_coefficients[
+            (product, countries[0])
+        ]['intention_categories']
+        intention_weights = model_store.read_table(
+            f'Intention Weights {product}'
+        ).set_index('Category')
+        for stakeholder_index, stakeholder in enumerate(stakeholders):
+            for category_index, category in enumerate(
+                intention_categories[stakeholder]
+            ):
+                intention_weights.loc[
+                    category, stakeholder
+                ] = calibrated_weights[stakeholder_index, category_index]
+        model_store.save_dataframe(
+            intention_weights,
+            f'Intention Weights {product}',
+            groupfile_name,
+            output_folder,
+            parameters,
+        )
+
+        initial_yes = pd.DataFrame(
+            calibrated_initial_yes, index=countries, columns=stakeholders
+        )
+        initial_yes.index.name = 'Country'
+        model_store.save_dataframe(
+            initial_yes,
+            f'Initial Yes {product}',
+            groupfile_name,
+            output_folder,
+            parameters,
+        )
+
+    GRETA_tool.remove_baseline(parameters)
+
+
+if __name__ == '__main__':
+    start = datetime.datetime.now()
+    parameters_file_name = 'pLAtYpus.toml'
+    parameters = cook.parameters_from_TOML(parameters_file_name)
+    calibrate_all_products(parameters)
+    end = datetime.datetime.now()
+    print((end - start).total_seconds())
@@ -11,8 +11,8 @@ except ModuleNotFoundError:
     import maps
 
 
-def make_all_outputs(parameters):
-    solver.get_all_evolutions_and_plots(parameters)
+def make_all_outputs(parameters, jobs=None):
+    solver.get_all_evolutions_and_plots(parameters, jobs)
     maps.make_long_term_average_tables(parameters)
     maps.make_area_maps(parameters)
 
@@ -2,7 +2,6 @@ import datetime
 
 import pandas as pd
 import numpy as np
-import sqlite3
 import matplotlib.pyplot as plt
 import matplotlib as mpl
 
@@ -10,14 +9,76 @@ import matplotlib as mpl
 import matplotlib
 from ETS_CookBook import ETS_CookBook as cook
 
+try:
+    from pLAtYpus_TNO import solver
+except ModuleNotFoundError:
+    import solver
+
+try:
+    from pLAtYpus_TNO import scores
+except ModuleNotFoundError:
+    import scores
+
+try:
+    from pLAtYpus_TNO import model_store as model_store_module
+except ModuleNotFoundError:
+    import model_store as model_store_module
+
+
+def get_model_long_term_averages(
+    product, countries, parameters, model_store=None
+):
+    '''
+    Computes the long-term averages of a given product for a list of
+    countries directly from the model (see
+    solver.get_long_term_average_values), instead of reading them from
+    the yes evolutions. All the countries are solved together.
+    Returns a DataFrame with the countries as index and the stakeholders
+    as columns.
+    '''
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    survey_scores_all = solver.get_survey_scores(parameters, model_store)
+    compiled_coefficients = scores.stack_compiled_coefficients(
+        [
+            scores.compile_model_coefficients(
+                solver.get_model_coefficients(
+                    product,
+                    country,
+                    parameters,
+                    survey_scores_all,
+                    model_store,
+                )
+            )
+            for country in countries
+        ]
+    )
+    initial_yes = np.concatenate(
+        [
+            solver.get_initial_yes(product, country, parameters, model_store)
+            for country in countries
+        ]
+    )
+    long_term_average_values = solver.get_long_term_average_values(
+        initial_yes, compiled_coefficients, parameters
+    )
+    long_term_averages_dataframe = pd.DataFrame(
+        long_term_average_values, columns=stakeholders, index=countries
+    )
+    long_term_averages_dataframe.index.name = 'Country'
+
+    return long_term_averages_dataframe
+
 
-def get_long_term_averages(product, country, parameters):
+def get_long_term_averages(product, country, parameters, model_store=None):
     pLAtYpus_parameters = parameters['pLAtYpus']
     stakeholders = pLAtYpus_parameters['stakeholders']
-    stakeholders_with_quotes = [
-        f'"{stakeholder}"' for stakeholder in stakeholders
-    ]
-    stakeholders_string = ', '.join(stakeholders_with_quotes)
+    long_term_average_method = pLAtYpus_parameters['long_term_average_method']
+    if long_term_average_method == 'steady_state':
+        long_term_averages_dataframe = get_model_long_term_averages(
+            product, [country], parameters, model_store
+        )
+        return long_term_averages_dataframe.loc[country].to_dict()
+
     time_span = pLAtYpus_parameters['time_span']
     percentage_time_span_end_average = pLAtYpus_parameters[
         'percentage_time_span_end_average'
@@ -26,21 +87,29 @@ def get_long_term_averages(product, country, parameters):
     end_average_time_start = (
         1 - percentage_time_span_end_average
     ) * run_duration
-    file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
-    database_file = f'{output_folder}/{groupfile_name}.sqlite3'
+    trajectory_storage = pLAtYpus_parameters['trajectory_storage']
+    if trajectory_storage == 'interpolant':
+        # We rebuild the evolution on the time steps of the model,
+        # so that we average the same values as with the full tables
+        yes_evolution = solver.read_yes_evolution(
+            product, country, parameters, model_store=model_store
+        )
+        end_average_data = yes_evolution[
+            yes_evolution.index >= end_average_time_start
+        ]
+        return {
+            stakeholder: np.average(end_average_data[stakeholder].values)
+            for stakeholder in stakeholders
+        }
+    model_store = model_store_module.get_model_store(parameters, model_store)
     source_table = f'{product}_{country}'
-    average_data_query = cook.read_query_generator(
-        stakeholders_string,
+    end_average_data = model_store.read_table(
         source_table,
+        stakeholders,
         ['Time'],
         ['>='],
         [end_average_time_start],
     )
-
-    with sqlite3.connect(database_file) as database_connection:
-        end_average_data = pd.read_sql(average_data_query, database_connection)
     long_term_average_values = [
         np.average(end_average_data[stakeholder].values)
         for stakeholder in stakeholders
@@ -51,7 +120,8 @@ def get_long_term_averages(product, country, parameters):
     return long_term_averages
 
 
-def make_long_term_average_tables(parameters):
+def make_long_term_average_tables(parameters, model_store=None):
+    model_store = model_store_module.get_model_store(parameters, model_store)
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
@@ -60,22 +130,34 @@ def make_long_term_average_tables(parameters):
     long_term_averages_table_name_prefix = pLAtYpus_parameters[
         'long_term_averages_table_name_prefix'
     ]
+    long_term_average_method = pLAtYpus_parameters['long_term_average_method']
     countries = parameters['survey']['countries']
     products = list(parameters['products'].keys())
     for product in products:
+        if long_term_average_method == 'steady_state':
+            model_store.save_dataframe(
+                get_model_long_term_averages(
+                    product, countries, parameters, model_store
+                ),
+                f'{long_term_averages_table_name_prefix}_{product}',
+                groupfile_name,
+                output_folder,
+                parameters,
+            )
+            continue
         long_term_averages_dataframe = pd.DataFrame(
             columns=stakeholders, index=countries
         )
         long_term_averages_dataframe.index.name = 'Country'
         for country in countries:
             long_term_averages = get_long_term_averages(
-                product, country, parameters
+                product, country, parameters, model_store
             )
             for stakeholder in stakeholders:
                 long_term_averages_dataframe.loc[country][
                     stakeholder
                 ] = long_term_averages[stakeholder]
-        cook.save_dataframe(
+        model_store.save_dataframe(
             long_term_averages_dataframe,
             f'{long_term_averages_table_name_prefix}_{product}',
             groupfile_name,
@@ -84,14 +166,14 @@ def make_long_term_average_tables(parameters):
         )
 
 
-def make_product_area_map(product, parameters):
+def make_product_area_map(product, parameters, model_store=None):
     cook.register_color_bars(parameters)
     golden = (1 + 5**0.5) / 2
 
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    database_file = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     pLAtYpus_parameters = parameters['pLAtYpus']
     stakeholders = pLAtYpus_parameters['stakeholders']
     long_term_averages_table_name_prefix = pLAtYpus_parameters[
@@ -111,11 +193,7 @@ def make_product_area_map(product, parameters):
 
     product_timer = datetime.datetime.now()
     source_table = f'{long_term_averages_table_name_prefix}_{product}'
-    source_table_query = cook.read_query_generator(
-        '*', source_table, '', '', ''
-    )
-    with sqlite3.connect(database_file) as database_connection:
-        product_data = pd.read_sql(source_table_query, database_connection)
+    product_data = model_store.read_table(source_table)
     product_data[country_code_header] = product_data['Country'].map(
         country_code_dictionary
     )
@@ -293,14 +371,14 @@ def make_product_area_map(product, parameters):
     )
 
 
-def make_relationships_maps(parameters):
+def make_relationships_maps(parameters, model_store=None):
     cook.register_color_bars(parameters)
     golden = (1 + 5**0.5) / 2
 
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    database_file = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     pLAtYpus_parameters = parameters['pLAtYpus']
     stakeholders = pLAtYpus_parameters['stakeholders']
     long_term_averages_table_name_prefix = pLAtYpus_parameters[
@@ -320,13 +398,7 @@ def make_relationships_maps(parameters):
     product_deviations_table = parameters['survey']['relation_definitions'][
         'product_deviations_table'
     ]
-    product_relations_score_query = cook.read_query_generator(
-        '*', product_deviations_table, '', '', ''
-    )
-    with sqlite3.connect(database_file) as database_connection:
-        product_relations_score = pd.read_sql(
-            product_relations_score_query, database_connection
-        )
+    product_relations_score = model_store.read_table(product_deviations_table)
 
     product_relations_score[country_code_header] = product_relations_score[
         'Country'
@@ -488,14 +560,14 @@ def make_relationships_maps(parameters):
     )
 
 
-def make_relationships_overlap_maps(parameters):
+def make_relationships_overlap_maps(parameters, model_store=None):
     cook.register_color_bars(parameters)
     golden = (1 + 5**0.5) / 2
 
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    database_file = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     pLAtYpus_parameters = parameters['pLAtYpus']
     stakeholders = pLAtYpus_parameters['stakeholders']
     long_term_averages_table_name_prefix = pLAtYpus_parameters[
@@ -515,13 +587,7 @@ def make_relationships_overlap_maps(parameters):
     product_overlap_table = parameters['survey']['relation_definitions'][
         'product_overlap_table'
     ]
-    product_overlap_score_query = cook.read_query_generator(
-        '*', product_overlap_table, '', '', ''
-    )
-    with sqlite3.connect(database_file) as database_connection:
-        product_overlap_score = pd.read_sql(
-            product_overlap_score_query, database_connection
-        )
+    product_overlap_score = model_store.read_table(product_overlap_table)
 
     product_overlap_score[country_code_header] = product_overlap_score[
         'Country'
@@ -686,14 +752,14 @@ def make_relationships_overlap_maps(parameters):
     )
 
 
-def make_area_maps(parameters):
+def make_area_maps(parameters, model_store=None):
     print('Making maps')
-    make_relationships_maps(parameters)
-    make_relationships_overlap_maps(parameters)
+    make_relationships_maps(parameters, model_store)
+    make_relationships_overlap_maps(parameters, model_store)
     products = list(parameters['products'].keys())
     for product in products:
         product_timer = datetime.datetime.now()
-        make_product_area_map(product, parameters)
+        make_product_area_map(product, parameters, model_store)
         print(
             product, (datetime.datetime.now() - product_timer).total_seconds()
         )
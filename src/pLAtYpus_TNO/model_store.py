@@ -0,0 +1,312 @@
+'''
+This module contains the model store, which keeps a connection to the
+model database (pLAtYpus.sqlite3) open, so that the functions of the other
+modules do not need to open a new connection each time they read or write
+something (for example for each country in a loop).
+The connection uses the pragmas of the [files.model_store] section
+of the parameters file. By default, the database uses a write-ahead log,
+so that reading it is not blocked by writes (for example when the dashboard
+reads the outputs during a recompute).
+The queries of the store are parameterised, so that SQLite can reuse
+their prepared statements (the connection keeps a cache of them).
+
+The functions of the other modules that use the database take an optional
+model_store argument. If it is None, they use the store that
+get_model_store keeps for the database file (one per process).
+The threads of a process (for example the requests of the dashboard)
+share that store. It has one connection for writing, which only one
+thread uses at a time, and a pool of read-only connections for reading,
+with one for each thread that reads at the same time, so that (with the
+write-ahead log) reads do not wait for writes.
+Before copying the database file, you need to checkpoint that store
+(or close it with close_model_store, if the file is replaced), so that
+the content of the write-ahead log is in the database file.
+'''
+
+import atexit
+import contextlib
+import os
+import sqlite3
+import threading
+
+import pandas as pd
+from ETS_CookBook import ETS_CookBook as cook
+
+
+class ModelStore:
+    '''
+    Connections to a database file, with the pragmas of the
+    parameters file, and methods to read, save, and update tables
+    with parameterised queries.
+    The store can be used from any thread. The writes use one
+    connection, and hold a lock while they use it, so that the threads
+    do not write at the same time. The reads use read-only connections
+    from a pool (see read_connection), so that they do not wait for
+    the lock of the writes.
+    '''
+
+    def __init__(self, database_file, parameters):
+        self.store_parameters = parameters['files']['model_store']
+        self.database_file = database_file
+        database_folder = os.path.dirname(database_file)
+        if database_folder != '':
+            cook.check_if_folder_exists(database_folder)
+        self.connection = self.open_connection()
+        # A reentrant lock, as some methods call others
+        self.lock = threading.RLock()
+        # The read connections that are open, and those of them
+        # that no thread is using
+        self.read_connections = []
+        self.idle_read_connections = []
+        self.read_connections_lock = threading.Lock()
+
+    def open_connection(self):
+        connection = sqlite3.connect(
+            self.database_file,
+            timeout=self.store_parameters['busy_timeout'],
+            cached_statements=self.store_parameters['cached_statements'],
+            check_same_thread=False,
+        )
+        for pragma, pragma_value in self.store_parameters['pragmas'].items():
+            connection.execute(f'PRAGMA {pragma} = {pragma_value}')
+
+        return connection
+
+    @contextlib.contextmanager
+    def read_connection(self):
+        '''
+        Gives a read-only connection from the pool (and opens a new one
+        if all of them are in use by other threads), which goes back to
+        the pool when the reading is done.
+        '''
+        with self.read_connections_lock:
+            if len(self.idle_read_connections) > 0:
+                connection = self.idle_read_connections.pop()
+            else:
+                connection = self.open_connection()
+                connection.execute('PRAGMA query_only = 1')
+                self.read_connections.append(connection)
+        try:
+            yield connection
+        finally:
+            with self.read_connections_lock:
+                self.idle_read_connections.append(connection)
+
+    def read_sql(self, query, query_parameters=()):
+        with self.read_connection() as connection:
+            return pd.read_sql(query, connection, params=query_parameters)
+
+    def read_table(
+        self,
+        table_name,
+        quantities_to_display='*',
+        filter_quantities=(),
+        filter_types=(),
+        filter_values=(),
+    ):
+        '''
+        Reads a table (or some of its columns, given as a list), with
+        optional filters (column names, comparison operators such as
+        '=' or '>=', and values), as in cook.read_query_generator,
+        but with the values as query parameters.
+        '''
+        if quantities_to_display != '*':
+            quantities_to_display = ', '.join(
+                f'"{quantity}"' for quantity in quantities_to_display
+            )
+        query = f'SELECT {quantities_to_display} FROM "{table_name}"'
+        if len(filter_quantities) > 0:
+            query_filter = ' AND '.join(
+                f'"{filter_quantity}" {filter_type} ?'
+                for filter_quantity, filter_type in zip(
+                    filter_quantities, filter_types
+                )
+            )
+            query = f'{query} WHERE {query_filter}'
+
+        return self.read_sql(query, list(filter_values))
+
+    def execute(self, query, query_parameters=()):
+        '''
+        Executes a (parameterised) query in its own transaction.
+        '''
+        self.executemany(query, [query_parameters])
+
+    def executemany(self, query, rows):
+        '''
+        Executes a (parameterised) query for several rows,
+        in one transaction.
+        '''
+        with self.lock, self.connection:
+            self.connection.executemany(query, rows)
+
+    def has_table(self, table_name):
+        with self.read_connection() as connection:
+            return (
+                connection.execute(
+                    'SELECT name FROM sqlite_master '
+                    "WHERE type='table' AND name=?",
+                    (table_name,),
+                ).fetchone()
+                is not None
+            )
+
+    def save_dataframe(
+        self,
+        dataframe,
+        dataframe_name,
+        groupfile_name,
+        output_folder,
+        parameters,
+    ):
+        '''
+        Saves a DataFrame like cook.save_dataframe, but writes the SQL table
+        with the connection of the store.
+        '''
+        file_parameters = parameters['files']
+        dataframe_outputs = file_parameters['dataframe_outputs']
+
+        # We write the other formats with parameters that
+        # have the SQL output turned off
+        other_outputs_parameters = dict(parameters)
+        other_outputs_parameters['files'] = dict(file_parameters)
+        other_outputs_parameters['files']['dataframe_outputs'] = dict(
+            dataframe_outputs
+        )
+        other_outputs_parameters['files']['dataframe_outputs']['sql'] = False
+        cook.save_dataframe(
+            dataframe,
+            dataframe_name,
+            groupfile_name,
+            output_folder,
+            other_outputs_parameters,
+        )
+
+        if dataframe_outputs['sql']:
+            with self.lock:
+                dataframe.to_sql(
+                    dataframe_name, con=self.connection, if_exists='replace'
+                )
+
+    def update_values(
+        self, table_name, updated_quantities, filter_quantities, rows
+    ):
+        '''
+        Updates some columns of a table for several rows, in one
+        transaction. Each row gives the new values of the updated
+        quantities, followed by the values of the filter quantities
+        (columns) that identify the row(s) to update.
+        '''
+        self.update_tables(
+            [(table_name, updated_quantities, filter_quantities, rows)]
+        )
+
+    def update_tables(self, table_updates):
+        '''
+        Does several updates (each with the arguments of update_values)
+        in one transaction, so that either all or none of them
+        are written.
+        '''
+        with self.lock, self.connection:
+            for (
+                table_name,
+                updated_quantities,
+                filter_quantities,
+                rows,
+            ) in table_updates:
+                updated_string = ', '.join(
+                    f'"{updated_quantity}" = ?'
+                    for updated_quantity in updated_quantities
+                )
+                filter_string = ' AND '.join(
+                    f'"{filter_quantity}" = ?'
+                    for filter_quantity in filter_quantities
+                )
+                self.connection.executemany(
+                    f'UPDATE "{table_name}" SET {updated_string} '
+                    f'WHERE {filter_string}',
+                    rows,
+                )
+
+    def checkpoint(self):
+        '''
+        Writes the content of the write-ahead log to the database file.
+        '''
+        with self.lock:
+            self.connection.execute('PRAGMA wal_checkpoint(TRUNCATE)')
+
+    def close(self):
+        with self.read_connections_lock:
+            for connection in self.read_connections:
+                connection.close()
+            self.read_connections.clear()
+            self.idle_read_connections.clear()
+        with self.lock:
+            self.checkpoint()
+            self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
+
+
+# The stores of the database files, with the process ID and the
+# database file as keys (so that processes that are forked from one that
+# has a store do not use its connection), and a lock so that two threads
+# do not open a store for the same file
+model_stores = {}
+model_stores_lock = threading.Lock()
+
+
+def get_model_database_file(parameters):
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+
+    return f'{output_folder}/{groupfile_name}.sqlite3'
+
+
+def get_model_store(parameters, model_store=None, database_file=None):
+    '''
+    Returns the model store if one is given, and otherwise the
+    store of the database file (by default the model database,
+    see get_model_database_file), which we open if needed.
+    '''
+    if model_store is not None:
+        return model_store
+    if database_file is None:
+        database_file = get_model_database_file(parameters)
+    store_key = (os.getpid(), os.path.abspath(database_file))
+    with model_stores_lock:
+        if store_key not in model_stores:
+            model_stores[store_key] = ModelStore(database_file, parameters)
+
+        return model_stores[store_key]
+
+
+def close_model_store(parameters, database_file=None):
+    '''
+    Closes the store of a database file (by default the model database),
+    if it is open, for example before the file is copied.
+    '''
+    if database_file is None:
+        database_file = get_model_database_file(parameters)
+    store_key = (os.getpid(), os.path.abspath(database_file))
+    with model_stores_lock:
+        if store_key in model_stores:
+            model_stores.pop(store_key).close()
+
+
+def close_model_stores():
+    '''
+    Closes all the stores of this process.
+    '''
+    with model_stores_lock:
+        for store_key in list(model_stores.keys()):
+            if store_key[0] == os.getpid():
+                model_stores.pop(store_key).close()
+
+
+atexit.register(close_model_stores)
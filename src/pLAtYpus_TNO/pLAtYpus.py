@@ -22,6 +22,11 @@ try:
 except ModuleNotFoundError:
     import process_survey_data
 
+try:
+    from pLAtYpus_TNO import GRETA_tool
+except ModuleNotFoundError:
+    import GRETA_tool
+
 
 if __name__ == '__main__':
     parameters_file_name = 'pLAtYpus.toml'
@@ -30,15 +35,9 @@ if __name__ == '__main__':
     cook.check_if_folder_exists('input')
 
     start = datetime.datetime.now()
-    stakeholders = parameters['pLAtYpus']['stakeholders']
-    for stakeholder in stakeholders:
-        topic_answers, topic_dataframe = process_survey_data.read_source_sheet(
-            stakeholder, parameters
-        )
-        print(stakeholder)
-        process_survey_data.write_full_processed_data(
-            parameters, topic_answers, topic_dataframe, stakeholder
-        )
+    process_survey_data.ingest_survey_data(parameters)
+    if parameters['survey']['data']['output']['export_processed_excel']:
+        process_survey_data.export_processed_excel(parameters)
     end = datetime.datetime.now()
     print((end - start).total_seconds())
 
@@ -57,3 +56,10 @@ if __name__ == '__main__':
     maps.make_area_maps(parameters)
     end = datetime.datetime.now()
     print((end - start).total_seconds())
+
+    # These are the outputs from the survey, to which
+    # the GRETA tool resets
+    start = datetime.datetime.now()
+    GRETA_tool.save_baseline(parameters)
+    end = datetime.datetime.now()
+    print((end - start).total_seconds())
@@ -1,3 +1,7 @@
+import concurrent.futures
+import hashlib
+import itertools
+import json
 import os
 import tomllib
 import sqlite3
@@ -9,14 +13,10 @@ import numpy as np
 from ETS_CookBook import ETS_CookBook as cook
 
 
-def read_source_sheet(stakeholder, parameters):
+def get_source_sheet(stakeholder, parameters):
     '''
-    This function reads the raw data and cleans it up.
-    It returns a dictionary with the cleaned up values.
-    This dictionary has the topics/question codes as keys.
-    It does so for a given stakeholder
+    Gets the source file and sheet of the raw data of a given stakeholder.
     '''
-
     stakeholders = parameters['pLAtYpus']['stakeholders']
     survey_data_source_parameters = parameters['survey']['data']['source']
     source_sheets = survey_data_source_parameters['source_sheets']
@@ -28,15 +28,6 @@ def read_source_sheet(stakeholder, parameters):
     )
     stakeholder_label = stakeholder_label_dictionary[stakeholder]
 
-    country_names = parameters['survey']['countries']
-    # Tomli reads the keys as strings, but we need integers (as the columns
-    # are integers)
-    # We need to shift this by 4 because teh data starts in the 4th column
-    country_names = {
-        int(country_number + 4): country
-        for country_number, country in enumerate(country_names)
-    }
-
     source_prefix = survey_data_source_parameters['source_prefix']
     source_suffix = survey_data_source_parameters['source_suffix']
     source_extension = survey_data_source_parameters['source_extension']
@@ -48,6 +39,30 @@ def read_source_sheet(stakeholder, parameters):
     source_sheet_dictionary = dict(zip(stakeholders, source_sheets))
     source_sheet = source_sheet_dictionary[stakeholder]
 
+    return source_file, source_sheet
+
+
+def read_source_sheet(stakeholder, parameters):
+    '''
+    This function reads the raw data and cleans it up.
+    It returns a dictionary with the cleaned up values.
+    This dictionary has the topics/question codes as keys.
+    It does so for a given stakeholder
+    '''
+
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    survey_data_source_parameters = parameters['survey']['data']['source']
+    source_file, source_sheet = get_source_sheet(stakeholder, parameters)
+
+    country_names = parameters['survey']['countries']
+    # Tomli reads the keys as strings, but we need integers (as the columns
+    # are integers)
+    # We need to shift this by 4 because teh data starts in the 4th column
+    country_names = {
+        int(country_number + 4): country
+        for country_number, country in enumerate(country_names)
+    }
+
     # This gives the number of merged rows for topic headers
     topic_merged_rows_list = survey_data_source_parameters['topic_merged_rows']
     topic_merged_rows_dicttionary = dict(
@@ -55,66 +70,76 @@ def read_source_sheet(stakeholder, parameters):
     )
     topic_merged_rows = topic_merged_rows_dicttionary[stakeholder]
 
-    # This is the raw data we want to process (we dont use its headers)
-    raw_data = pd.read_excel(source_file, sheet_name=source_sheet, header=None)
-    # The topics and questions are in the first column
-    question_headers = raw_data[0]
-    # We want a list of topics, questions, and their rows
-    topics = []
-    topic_rows = []
-    questions = []
-    question_rows = []
-    # We also need to know the question sizes (i.e. the size of the
-    # corresponding arrays)
-    array_sizes = []
-
-    # We iterate through the question headers
-    for row_index, question_header in enumerate(question_headers):
-        # Questions and topics are not empty/nan
-        if question_header == question_header:
-            # To avoid issues with going further than the last entry
-            if row_index < (len(question_headers) - 2):
-                # We check if the next two  values are empty/nan for citizens
-                # For others, it is the next value only (less celle merged)
-                # Was two for citizens, but does not seem to work for
-                # business and government
-                if stakeholder == 'citizens':
-                    if (
-                        question_headers[row_index + 1]
-                        != question_headers[row_index + 1]
-                    ) and (
-                        question_headers[row_index + 2]
-                        != question_headers[row_index + 2]
-                    ):
-                        # If the topic_merged_rows-th next is not empty,
-                        # then it's a topic
-                        if (
-                            question_headers[row_index + topic_merged_rows]
-                            == question_headers[row_index + topic_merged_rows]
-                        ):
-                            topics.append(question_header)
-                            topic_rows.append(row_index)
-                        # Otherwise, it's a question
-                        else:
-                            questions.append(question_header)
-                            question_rows.append(row_index)
-                else:
-                    if (
-                        question_headers[row_index + 1]
-                        != question_headers[row_index + 1]
-                    ):
-                        # If the topic_merged_rows-th next is not empty,
-                        # then it's a topic
-                        if (
-                            question_headers[row_index + topic_merged_rows]
-                            == question_headers[row_index + topic_merged_rows]
-                        ):
-                            topics.append(question_header)
-                            topic_rows.append(row_index)
-                        # Otherwise, it's a question
-                        else:
-                            questions.append(question_header)
-                            question_rows.append(row_index)
+    # We stream the sheet (in read-only mode, which does not load the
+    # whole workbook in memory) and only keep the columns we need:
+    # the topics and questions (first column), the answers (second column),
+    # and the counts of each country (which start in the fifth column)
+    country_columns = list(country_names.keys())
+    source_workbook = openpyxl.load_workbook(
+        source_file, read_only=True, data_only=True
+    )
+    question_headers = []
+    answer_labels = []
+    count_rows = []
+    for row_values in source_workbook[source_sheet].iter_rows(
+        max_col=country_columns[-1] + 1, values_only=True
+    ):
+        # Rows can be shorter than the columns we want if their last
+        # cells are empty
+        row_values = row_values + (None,) * (
+            country_columns[-1] + 1 - len(row_values)
+        )
+        question_headers.append(row_values[0])
+        answer_labels.append(row_values[1])
+        count_rows.append(row_values[country_columns[0] :])
+    source_workbook.close()
+    # We drop the empty rows at the end of the sheet (as pandas does)
+    filled_rows = [
+        row_index
+        for row_index, count_row in enumerate(count_rows)
+        if question_headers[row_index] is not None
+        or answer_labels[row_index] is not None
+        or any(count is not None for count in count_row)
+    ]
+    row_amount = filled_rows[-1] + 1 if filled_rows else 0
+    question_headers = question_headers[0:row_amount]
+    answer_labels = answer_labels[0:row_amount]
+    count_rows = count_rows[0:row_amount]
+
+    # Topics and questions are headers (i.e. not empty) followed by
+    # merged (i.e. empty) cells (two for citizens, but only one
+    # for business and government).
+    # If the topic_merged_rows-th next is not empty, then it's a topic,
+    # otherwise, it's a question.
+    # We pad the empty headers mask so that we can look past the last row.
+    empty_headers = np.array(
+        [question_header is None for question_header in question_headers],
+        dtype=bool,
+    )
+    if stakeholder == 'citizens':
+        merged_rows = 2
+    else:
+        merged_rows = 1
+    padded_empty_headers = np.concatenate(
+        (
+            empty_headers,
+            np.ones(max(merged_rows, topic_merged_rows), dtype=bool),
+        )
+    )
+    row_indices = np.arange(row_amount)
+    header_rows = ~empty_headers & (row_indices < row_amount - 2)
+    for merged_row in range(1, merged_rows + 1):
+        header_rows &= padded_empty_headers[row_indices + merged_row]
+    topic_row_mask = header_rows & ~(
+        padded_empty_headers[row_indices + topic_merged_rows]
+    )
+    question_row_mask = header_rows & (
+        padded_empty_headers[row_indices + topic_merged_rows]
+    )
+    topic_rows = np.flatnonzero(topic_row_mask)
+    question_rows = np.flatnonzero(question_row_mask)
+    topics = [question_headers[row_index] for row_index in topic_rows]
+    questions = [question_headers[row_index] for row_index in question_rows]
 
     topic_dataframe = pd.DataFrame.from_dict(
         dict(zip(topics, questions)), orient='index'
@@ -125,61 +150,219 @@ def read_source_sheet(stakeholder, parameters):
     for topic_index, topic in enumerate(topic_dataframe.index.values):
         topic_dataframe.at[topic, 'Sheet name'] = f'Sheet_{topic_index}'
 
-    # We can look at the size of each array
-    for row_index in question_rows:
-        array_size = 0
-        count_index = 1
-        # We count the empty values, which give us the array size
-        while (
-            question_headers[row_index + count_index]
-            != question_headers[row_index + count_index]
-        ):
-            array_size += 1
-            count_index += 1
-        array_sizes.append(array_size)
+    # The array of a question runs until the next non-empty header,
+    # so the empty headers give us its size
+    filled_header_rows = np.append(np.flatnonzero(~empty_headers), row_amount)
+    next_filled_header_rows = filled_header_rows[
+        np.searchsorted(filled_header_rows, question_rows, side='right')
+    ]
+    array_sizes = next_filled_header_rows - question_rows - 1
+
+    # We extract the rows of all the arrays (without the ones without
+    # answers) and clean their counts all at once.
+    # We need to remove annotations, so we need to convert the
+    # counts to strings (and then back to integers).
+    # Integer counts can be read as floats, so we convert them first.
+    array_row_groups = [
+        [
+            row_index
+            for row_index in range(row_index, row_index + array_size + 1)
+            if answer_labels[row_index] is not None
+        ]
+        for row_index, array_size in zip(question_rows, array_sizes)
+    ]
+    array_rows = [
+        row_index
+        for array_row_group in array_row_groups
+        for row_index in array_row_group
+    ]
+    raw_counts = pd.DataFrame(
+        [
+            [
+                int(count)
+                if isinstance(count, float) and count.is_integer()
+                else count
+                for count in count_rows[row_index]
+            ]
+            for row_index in array_rows
+        ],
+        columns=list(country_names.values()),
+    ).astype(str)
+    # We remove letters (used to annotate) from the answers
+    clean_counts = raw_counts.replace(r'\D', '', regex=True)
+    # We have some zeroes that are annotated with numbers
+    # So we find them and replace the value with zero
+    clean_counts = clean_counts.replace(r'^0.*$', '0', regex=True)
+    # We convert the values to integers
+    clean_counts = clean_counts.astype(int)
 
-    # We now can extract the arrays that will be stored in a dictionary
+    # We now can split the arrays that will be stored in a dictionary
     topic_answers = {}
-    for row_index, array_size, question, topic in zip(
-        question_rows, array_sizes, questions, topics
+    array_start = 0
+    for array_row_group, question, topic in zip(
+        array_row_groups, questions, topics
     ):
-        raw_array = raw_data.iloc[row_index : row_index + array_size + 1]
-        count_array = raw_array.dropna(subset=1)
-        count_array = count_array.set_index(1)
-        count_array.index.name = question
-        count_array = count_array.iloc[:, 3:19]
-        count_array.rename(columns=country_names, inplace=True)
-        # We will need to remove annotations, so we need to convert the
-        # array to strings (and then back to integers)
-        count_array = count_array.astype(str)
-
-        for column in count_array.columns:
-            # count_array[column] = (
-            #     count_array[column].str.extract(pat='(\d+)', expand=False)
-            # )
-            # We remove letters (used to annotate) from the answers
-            count_array[column] = count_array[column].str.replace(
-                '\D', '', regex=True
-            )
-            # We have some zeroes that are annotated with numbers
-            # So we find them and replace the value with zero
+        array_end = array_start + len(array_row_group)
+        count_array = clean_counts.iloc[array_start:array_end]
+        count_array.index = pd.Index(
+            [answer_labels[row_index] for row_index in array_row_group],
+            dtype=object,
+            name=question,
+        )
+        topic_answers[topic] = count_array
+        array_start = array_end
 
-            zeroes_with_annotations = count_array[column].str.startswith('0')
-            count_array.loc[zeroes_with_annotations, column] = 0
+    return topic_answers, topic_dataframe
 
-        # We convert the values to integers
-        count_array = count_array.astype(int)
 
-        topic_answers[topic] = count_array
+def get_clean_topic(topic):
+    '''
+    Cleans up a topic so that we can use it in table names (and as a
+    survey code).
+    '''
+    topic_clean = topic.replace(' ', '_')
+    topic_clean = topic_clean.replace('’', '_')
+    topic_clean = topic_clean.replace('?', '_')
+    topic_clean = topic_clean.replace("'", '_')
 
-    return topic_answers, topic_dataframe
+    return topic_clean
 
 
-def write_full_processed_data(
+def drop_table_or_view(name, database_connection):
+    '''
+    Drops a table or view (if it exists). SQLite does not let
+    DROP TABLE remove a view (or DROP VIEW a table), and the per-topic
+    tables are views with the long survey storage, so we need to check
+    which of the two we have.
+    '''
+    existing_object = database_connection.execute(
+        'SELECT type FROM sqlite_master '
+        "WHERE name = ? AND type IN ('table', 'view')",
+        (name,),
+    ).fetchone()
+    if existing_object is not None:
+        database_connection.execute(
+            f'DROP {existing_object[0].upper()} "{name}"'
+        )
+
+
+def write_long_survey_data(
+    parameters, topic_answers, stakeholder, database_connection
+):
+    '''
+    This function writes the answers of all the topics of a stakeholder
+    to a single long-format table, with one row per stakeholder, topic,
+    answer, and country (and the answer count), indexed on these columns.
+    Rows are written with executemany (replacing the previous rows of the
+    stakeholder), within the transaction of the database connection.
+    For the readers that expect one table per topic, we create a view
+    for each topic, with the same name and layout as these tables.
+    '''
+    output_parameters = parameters['survey']['data']['output']
+    long_table_name = output_parameters['long_table_name']
+
+    database_connection.execute(
+        f'CREATE TABLE IF NOT EXISTS "{long_table_name}" ('
+        'Stakeholder TEXT, Topic TEXT, Answer_index INTEGER, '
+        'Answer TEXT, Country TEXT, Count INTEGER)'
+    )
+    database_connection.execute(
+        f'CREATE INDEX IF NOT EXISTS "{long_table_name}_index" '
+        f'ON "{long_table_name}" '
+        '(Stakeholder, Topic, Country, Answer_index)'
+    )
+    database_connection.execute(
+        f'DELETE FROM "{long_table_name}" WHERE Stakeholder = ?',
+        (stakeholder,),
+    )
+
+    answer_rows = []
+    for topic, count_array in topic_answers.items():
+        topic_clean = get_clean_topic(topic)
+        for answer_index, (answer, answer_counts) in enumerate(
+            zip(count_array.index.tolist(), count_array.values.tolist())
+        ):
+            for country, count in zip(count_array.columns, answer_counts):
+                answer_rows.append(
+                    (
+                        stakeholder,
+                        topic_clean,
+                        answer_index,
+                        answer,
+                        country,
+                        count,
+                    )
+                )
+    database_connection.executemany(
+        f'INSERT INTO "{long_table_name}" VALUES (?, ?, ?, ?, ?, ?)',
+        answer_rows,
+    )
+
+    for topic, count_array in topic_answers.items():
+        topic_clean = get_clean_topic(topic)
+        view_name = f'{stakeholder}_{topic_clean}'
+        question = str(count_array.index.name).replace('"', '""')
+        country_columns = ', '.join(
+            f'MAX(CASE WHEN Country = \'{country}\' THEN Count END) '
+            f'AS "{country}"'
+            for country in count_array.columns
+        )
+        drop_table_or_view(view_name, database_connection)
+        database_connection.execute(
+            f'CREATE VIEW "{view_name}" AS '
+            f'SELECT Answer AS "{question}", {country_columns} '
+            f'FROM "{long_table_name}" '
+            f'WHERE Stakeholder = \'{stakeholder}\' '
+            f'AND Topic = \'{topic_clean}\' '
+            'GROUP BY Answer_index ORDER BY Answer_index'
+        )
+
+
+def read_survey_answers(
+    parameters, stakeholders=None, topics=None, countries=None
+):
+    '''
+    Reads any subset of the long-format survey table (see
+    write_long_survey_data) in one query. The stakeholders, topics
+    (i.e. survey codes), and countries are lists, and None means all of
+    them.
+    Returns a DataFrame with one row per stakeholder, topic, answer,
+    and country, sorted by stakeholder, topic, answer index, and country.
+    '''
+    output_parameters = parameters['survey']['data']['output']
+    output_folder = output_parameters['output_folder']
+    database_file_name = output_parameters['database_file_name']
+    long_table_name = output_parameters['long_table_name']
+    database_file = f'{output_folder}/{database_file_name}'
+
+    conditions = []
+    condition_values = []
+    for column, values in zip(
+        ['Stakeholder', 'Topic', 'Country'], [stakeholders, topics, countries]
+    ):
+        if values is not None:
+            placeholders = ', '.join('?' for value in values)
+            conditions.append(f'{column} IN ({placeholders})')
+            condition_values.extend(values)
+    sql_query = f'SELECT * FROM "{long_table_name}"'
+    if conditions:
+        sql_query += ' WHERE ' + ' AND '.join(conditions)
+    sql_query += ' ORDER BY Stakeholder, Topic, Answer_index, Country'
+
+    with sqlite3.connect(database_file) as database_connection:
+        survey_answers = pd.read_sql(
+            sql_query, con=database_connection, params=condition_values
+        )
+
+    return survey_answers
+
+
+def write_processed_excel(
     parameters, topic_answers, topic_dataframe, stakeholder
 ):
     '''
-    This function writes all the topics to an Excel file
+    This function writes all the topics to an Excel file.
+    The file is written in one pass (replacing it if it exists).
     '''
     survey_data_parameters = parameters['survey']['data']
 
@@ -195,16 +378,8 @@ def write_full_processed_data(
     )
     writing_engine = output_parameters['writing_engine']
 
-    if not os.path.isfile(full_output_file):
-        topic_dataframe.to_excel(
-            full_output_file, sheet_name=f'{stakeholder}_Topics'
-        )
-
     my_writer = pd.ExcelWriter(
-        full_output_file,
-        engine=writing_engine,
-        mode='a',
-        if_sheet_exists='replace',
+        full_output_file, engine=writing_engine, mode='w'
     )
 
     with my_writer:
@@ -214,38 +389,418 @@ def write_full_processed_data(
         ):
             topic_answers[topic].to_excel(my_writer, sheet_name=topic_sheet)
 
+
+def read_processed_database(stakeholder, parameters):
+    '''
+    Reads the topics of a stakeholder from the survey database
+    (with either survey storage, as the long storage has views
+    with the layout of the topic tables).
+    Returns the topic answers and topic dataframe (as read_source_sheet).
+    '''
+    output_parameters = parameters['survey']['data']['output']
+    output_folder = output_parameters['output_folder']
     database_file_name = output_parameters['database_file_name']
     database_file = f'{output_folder}/{database_file_name}'
+
+    topic_answers = {}
     with sqlite3.connect(database_file) as database_connection:
+        topic_dataframe = pd.read_sql(
+            f'SELECT * FROM "{stakeholder}_Topics"',
+            con=database_connection,
+            index_col='Topic',
+        )
+        for topic in topic_dataframe.index:
+            topic_clean = get_clean_topic(topic)
+            count_array = pd.read_sql(
+                f'SELECT * FROM "{stakeholder}_{topic_clean}"',
+                con=database_connection,
+            )
+            topic_answers[topic] = count_array.set_index(
+                count_array.columns[0]
+            )
+
+    return topic_answers, topic_dataframe
+
+
+def export_processed_excel(parameters):
+    '''
+    Writes the processed survey data of all stakeholders from the survey
+    database to their Excel files.
+    This is a separate stage of the ingestion (see ingest_survey_data),
+    which we run if export_processed_excel is set in the parameters file
+    (or on demand).
+    '''
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    for stakeholder in stakeholders:
+        topic_answers, topic_dataframe = read_processed_database(
+            stakeholder, parameters
+        )
+        write_processed_excel(
+            parameters, topic_answers, topic_dataframe, stakeholder
+        )
+
+
+def write_dataframe_table(dataframe, table_name, database_connection):
+    '''
+    Writes a DataFrame (with its index) to a table of a database (replacing
+    it if it exists), like to_sql, but without committing, so that
+    we can write many tables in a single transaction.
+    '''
+    table_dataframe = dataframe.reset_index()
+    drop_table_or_view(table_name, database_connection)
+    database_connection.execute(
+        pd.io.sql.get_schema(
+            table_dataframe, table_name, con=database_connection
+        )
+    )
+    placeholders = ', '.join('?' for column in table_dataframe.columns)
+    database_connection.executemany(
+        f'INSERT INTO "{table_name}" VALUES ({placeholders})',
+        table_dataframe.itertuples(index=False, name=None),
+    )
+
+
+def write_processed_database(
+    parameters, stakeholders_processed_data, ingestion_keys=None
+):
+    '''
+    This function writes all the topics of some stakeholders
+    (given in a dictionary with the stakeholders as keys and their
+    topic answers and topic dataframe as values) to the survey database
+    (with the survey storage of the parameters file).
+    All the stakeholders are written in a single transaction, together
+    with their ingestion keys (see ingest_survey_data), which are
+    a dictionary with the stakeholders as keys (None removes the keys of
+    all the stakeholders, for data that does not come from the ingestion).
+    '''
+    output_parameters = parameters['survey']['data']['output']
+    output_folder = output_parameters['output_folder']
+    database_file_name = output_parameters['database_file_name']
+    survey_storage = output_parameters['survey_storage']
+    database_file = f'{output_folder}/{database_file_name}'
+    long_table_name = output_parameters['long_table_name']
+    if ingestion_keys is None:
+        ingestion_keys = {}
+
+    with sqlite3.connect(database_file) as database_connection:
+        database_connection.execute('BEGIN')
+        if survey_storage == 'tables':
+            # The long table (and its index) of an earlier ingestion
+            # with the long storage would otherwise be read as a topic
+            database_connection.execute(
+                f'DROP TABLE IF EXISTS "{long_table_name}"'
+            )
+        for stakeholder, (
+            topic_answers,
+            topic_dataframe,
+        ) in stakeholders_processed_data.items():
+            write_dataframe_table(
+                topic_dataframe, f'{stakeholder}_Topics', database_connection
+            )
+
+            if survey_storage == 'long':
+                write_long_survey_data(
+                    parameters, topic_answers, stakeholder, database_connection
+                )
+            elif survey_storage == 'tables':
+                for topic in topic_answers:
+                    topic_clean = get_clean_topic(topic)
+
+                    write_dataframe_table(
+                        topic_answers[topic],
+                        f'{stakeholder}_{topic_clean}',
+                        database_connection,
+                    )
+            else:
+                raise ValueError(f'Unknown survey storage: {survey_storage}')
+
+            database_connection.execute(
+                'CREATE TABLE IF NOT EXISTS ingestion_keys '
+                '(Stakeholder TEXT PRIMARY KEY, Key TEXT)'
+            )
+            database_connection.execute(
+                'DELETE FROM ingestion_keys WHERE Stakeholder = ?',
+                (stakeholder,),
+            )
+            if ingestion_keys.get(stakeholder) is not None:
+                database_connection.execute(
+                    'INSERT INTO ingestion_keys VALUES (?, ?)',
+                    (stakeholder, ingestion_keys[stakeholder]),
+                )
+
+
+def write_full_processed_data(
+    parameters, topic_answers, topic_dataframe, stakeholder
+):
+    '''
+    This function writes all the topics to the survey database
+    (and to an Excel file if export_processed_excel is set in the
+    parameters file).
+    '''
+    export_processed_excel = parameters['survey']['data']['output'][
+        'export_processed_excel'
+    ]
+    if export_processed_excel:
+        write_processed_excel(
+            parameters, topic_answers, topic_dataframe, stakeholder
+        )
+    write_processed_database(
+        parameters, {stakeholder: (topic_answers, topic_dataframe)}
+    )
+
+
+def get_ingestion_key(stakeholder, parameters):
+    '''
+    Gets the key of the ingestion cache for a given stakeholder.
+    This is a hash of the contents of the source file, the source sheet,
+    and the settings that change how we read and store it.
+    '''
+    survey_data_source_parameters = parameters['survey']['data']['source']
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    source_file, source_sheet = get_source_sheet(stakeholder, parameters)
+    topic_merged_rows = dict(
+        zip(stakeholders, survey_data_source_parameters['topic_merged_rows'])
+    )[stakeholder]
+
+    ingestion_hash = hashlib.sha256()
+    with open(source_file, 'rb') as source:
+        for source_chunk in iter(lambda: source.read(1 << 20), b''):
+            ingestion_hash.update(source_chunk)
+    ingestion_settings = {
+        'stakeholder': stakeholder,
+        'source_sheet': source_sheet,
+        'topic_merged_rows': topic_merged_rows,
+        'countries': parameters['survey']['countries'],
+        'survey_storage': parameters['survey']['data']['output'][
+            'survey_storage'
+        ],
+    }
+    ingestion_hash.update(
+        json.dumps(ingestion_settings, sort_keys=True).encode()
+    )
+
+    return ingestion_hash.hexdigest()
+
+
+def save_ingestion_cache(
+    parameters, topic_answers, topic_dataframe, stakeholder, ingestion_key
+):
+    '''
+    Saves the processed data of a stakeholder to the ingestion cache
+    (an SQLite file in the survey output folder), with its ingestion key.
+    The answers of all topics are stored in one table, with their topic
+    and answer index (the question of each topic is in the topics table).
+    '''
+    output_parameters = parameters['survey']['data']['output']
+    output_folder = output_parameters['output_folder']
+    ingestion_cache_file_name = output_parameters['ingestion_cache_file_name']
+    ingestion_cache_file = f'{output_folder}/{ingestion_cache_file_name}'
+
+    cached_answers = pd.concat(
+        [
+            count_array.reset_index(names='Answer').assign(
+                Topic=topic,
+                Answer_index=range(len(count_array)),
+            )
+            for topic, count_array in topic_answers.items()
+        ]
+    )
+
+    with sqlite3.connect(ingestion_cache_file) as database_connection:
+        database_connection.execute(
+            'CREATE TABLE IF NOT EXISTS ingestion_keys '
+            '(Stakeholder TEXT PRIMARY KEY, Key TEXT)'
+        )
+        database_connection.execute(
+            'DELETE FROM ingestion_keys WHERE Stakeholder = ?', (stakeholder,)
+        )
         topic_dataframe.to_sql(
             f'{stakeholder}_Topics',
             con=database_connection,
             if_exists='replace',
         )
+        # The answers can be numbers, so we keep their types
+        cached_answers.to_sql(
+            f'{stakeholder}_answers',
+            con=database_connection,
+            if_exists='replace',
+            index=False,
+            dtype={'Answer': ''},
+        )
+        database_connection.execute(
+            'INSERT INTO ingestion_keys VALUES (?, ?)',
+            (stakeholder, ingestion_key),
+        )
 
-        for topic in topic_answers:
-            topic_clean = topic.replace(' ', '_')
-            topic_clean = topic_clean.replace('’', '_')
-            topic_clean = topic_clean.replace('?', '_')
-            topic_clean = topic_clean.replace("'", '_')
 
-            topic_answers[topic].to_sql(
-                f'{stakeholder}_{topic_clean}',
-                con=database_connection,
-                if_exists='replace',
-            )
+def read_ingestion_cache(stakeholder, ingestion_key, parameters):
+    '''
+    Reads the processed data of a stakeholder from the ingestion cache.
+    Returns the topic answers and topic dataframe (as read_source_sheet),
+    or None if the cache does not have data with this ingestion key.
+    '''
+    output_parameters = parameters['survey']['data']['output']
+    output_folder = output_parameters['output_folder']
+    ingestion_cache_file_name = output_parameters['ingestion_cache_file_name']
+    ingestion_cache_file = f'{output_folder}/{ingestion_cache_file_name}'
+    countries = parameters['survey']['countries']
 
+    if not os.path.isfile(ingestion_cache_file):
+        return None
 
-if __name__ == '__main__':
-    parameters_file_name = 'pLAtYpus.toml'
-    parameters = cook.parameters_from_TOML(parameters_file_name)
+    with sqlite3.connect(ingestion_cache_file) as database_connection:
+        cached_keys = database_connection.execute(
+            'SELECT Key FROM ingestion_keys WHERE Stakeholder = ?',
+            (stakeholder,),
+        ).fetchall()
+        if cached_keys != [(ingestion_key,)]:
+            return None
+        topic_dataframe = pd.read_sql(
+            f'SELECT * FROM "{stakeholder}_Topics"',
+            con=database_connection,
+            index_col='Topic',
+        )
+        cached_answers = pd.read_sql(
+            f'SELECT * FROM "{stakeholder}_answers"',
+            con=database_connection,
+        )
+
+    # Some topics can have no answers, so we go through the topics table
+    # (which is in the same order as the topic answers)
+    cached_count_arrays = dict(
+        list(cached_answers.sort_values('Answer_index').groupby('Topic'))
+    )
+    topic_answers = {}
+    for topic, question in topic_dataframe['Question'].items():
+        cached_count_array = cached_count_arrays.get(
+            topic, cached_answers.iloc[0:0]
+        )
+        count_array = cached_count_array[countries].astype(int)
+        count_array.index = pd.Index(
+            cached_count_array['Answer'].tolist(), dtype=object, name=question
+        )
+        topic_answers[topic] = count_array
+
+    return topic_answers, topic_dataframe
+
+
+def get_database_ingestion_key(stakeholder, parameters):
+    '''
+    Gets the ingestion key of the data of a stakeholder in the survey
+    database (or None if there is none).
+    '''
+    output_parameters = parameters['survey']['data']['output']
+    output_folder = output_parameters['output_folder']
+    database_file_name = output_parameters['database_file_name']
+    database_file = f'{output_folder}/{database_file_name}'
+
+    if not os.path.isfile(database_file):
+        return None
+    with sqlite3.connect(database_file) as database_connection:
+        # The table is made when the database is written (see
+        # write_processed_database), so we only read it if it is there
+        if (
+            database_connection.execute(
+                "SELECT name FROM sqlite_master "
+                "WHERE type='table' AND name='ingestion_keys'"
+            ).fetchone()
+            is None
+        ):
+            return None
+        database_keys = database_connection.execute(
+            'SELECT Key FROM ingestion_keys WHERE Stakeholder = ?',
+            (stakeholder,),
+        ).fetchall()
+    if len(database_keys) == 0:
+        return None
+
+    return database_keys[0][0]
+
+
+def ingest_survey_data(parameters, jobs=None):
+    '''
+    Reads and writes the processed survey data of all stakeholders
+    to the survey database.
+    If use_ingestion_cache is set, we skip the stakeholders
+    whose source file and settings are unchanged (see get_ingestion_key),
+    and restore their tables in the survey database from the cache instead
+    (unless the survey database already has them).
+    The stakeholders we need to read are read by a pool of processes
+    (with the number of processes given as an argument or by
+    the ingestion_jobs value in the parameters file, where zero means that
+    we use all the available cores).
+    The survey database is then written by this process only, in a single
+    transaction.
+    The Excel files are written separately (see export_processed_excel).
+    '''
+    output_parameters = parameters['survey']['data']['output']
+    use_ingestion_cache = output_parameters['use_ingestion_cache']
     stakeholders = parameters['pLAtYpus']['stakeholders']
+    if jobs is None:
+        jobs = output_parameters['ingestion_jobs']
+    if jobs == 0:
+        jobs = os.cpu_count()
+
+    ingestion_keys = {}
+    restored_processed_data = {}
+    stakeholders_to_read = []
     for stakeholder in stakeholders:
-        topic_answers, topic_dataframe = read_source_sheet(
-            stakeholder, parameters
-        )
+        ingestion_keys[stakeholder] = None
+        if use_ingestion_cache:
+            ingestion_key = get_ingestion_key(stakeholder, parameters)
+            ingestion_keys[stakeholder] = ingestion_key
+            if (
+                get_database_ingestion_key(stakeholder, parameters)
+                == ingestion_key
+            ):
+                continue
+            cached_data = read_ingestion_cache(
+                stakeholder, ingestion_key, parameters
+            )
+            if cached_data is not None:
+                restored_processed_data[stakeholder] = cached_data
+                continue
         print(stakeholder)
+        stakeholders_to_read.append(stakeholder)
 
-        write_full_processed_data(
-            parameters, topic_answers, topic_dataframe, stakeholder
+    read_arguments = (stakeholders_to_read, itertools.repeat(parameters))
+    if jobs > 1 and len(stakeholders_to_read) > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(jobs, len(stakeholders_to_read))
+        ) as executor:
+            read_processed_data = list(
+                executor.map(read_source_sheet, *read_arguments)
+            )
+    else:
+        read_processed_data = list(map(read_source_sheet, *read_arguments))
+    read_processed_data = dict(zip(stakeholders_to_read, read_processed_data))
+
+    stakeholders_processed_data = {
+        **restored_processed_data,
+        **read_processed_data,
+    }
+    if len(stakeholders_processed_data) > 0:
+        write_processed_database(
+            parameters, stakeholders_processed_data, ingestion_keys
         )
+
+    if use_ingestion_cache:
+        for stakeholder, (
+            topic_answers,
+            topic_dataframe,
+        ) in read_processed_data.items():
+            save_ingestion_cache(
+                parameters,
+                topic_answers,
+                topic_dataframe,
+                stakeholder,
+                ingestion_keys[stakeholder],
+            )
+
+
+if __name__ == '__main__':
+    parameters_file_name = 'pLAtYpus.toml'
+    parameters = cook.parameters_from_TOML(parameters_file_name)
+    ingest_survey_data(parameters)
+    if parameters['survey']['data']['output']['export_processed_excel']:
+        export_processed_excel(parameters)
@@ -161,6 +161,321 @@ def yes_factor(yes_code, yes, stakeholders):
     return yes_factor
 
 
+def compile_model_coefficients(model_coefficients):
+    '''
+    Compiles the model coefficients into dense NumPy arrays, so that
+    the right-hand side of the model can be computed with a few array
+    operations instead of pandas lookups and yes code parsing
+    at every call.
+    All the arrays that depend on the (product, country) system have a
+    leading system axis (of length one here), so that several systems
+    can be stacked.
+    The intention terms are stored per action, stakeholder, category,
+    and term (padded with zero scores), together with selectors that point
+    to a vector of yes factors that contains the yes values, the no values,
+    and a constant of one (in that order).
+    '''
+    stakeholders = model_coefficients['stakeholders']
+    survey_scores_actions = model_coefficients['survey_scores_actions']
+    intention_categories = model_coefficients['intention_categories']
+    category_weights = model_coefficients['category_weights']
+    categories_intention_scores = model_coefficients[
+        'categories_intention_scores'
+    ]
+    categories_yes_codes = model_coefficients['categories_yes_codes']
+    attention_inputs = model_coefficients['attention_inputs']
+
+    stakeholder_amount = len(stakeholders)
+    action_amount = len(survey_scores_actions)
+    category_amount = max(
+        len(intention_categories[stakeholder]) for stakeholder in stakeholders
+    )
+    term_amount = max(
+        len(categories_yes_codes[stakeholder][category][action])
+        for stakeholder in stakeholders
+        for category in intention_categories[stakeholder]
+        for action in survey_scores_actions
+    )
+    # The yes factors vector is made of the yes values, the no values,
+    # and ones, so each yes function has an offset in that vector
+    yes_factor_offsets = {
+        'yes': 0,
+        'no': stakeholder_amount,
+        'constant': 2 * stakeholder_amount,
+    }
+
+    attention = np.array(
+        [
+            [
+                attention_inputs[action][stakeholder_index]
+                for stakeholder_index, stakeholder in enumerate(stakeholders)
+            ]
+            for action in survey_scores_actions
+        ],
+        dtype=float,
+    )
+
+    # The enable phase only depends on the yes values for citizens,
+    # through the availability (i.e. the yes values of business)
+    survey_scores = model_coefficients['survey_scores']
+    survey_enable_parameters = model_coefficients['survey_enable_parameters']
+    enable = np.ones((action_amount, stakeholder_amount))
+    availability_stakeholders = np.array(
+        [stakeholder == 'citizens' for stakeholder in stakeholders]
+    )
+    availability_index = 1
+    adopt_index = survey_scores_actions.index('Adopt')
+    leave_index = survey_scores_actions.index('Leave')
+    enable[adopt_index, availability_stakeholders] = np.prod(
+        [
+            survey_scores.loc[f'{survey_enable_parameter}']['Adopt']
+            for survey_enable_parameter in survey_enable_parameters
+        ]
+    )
+    availability_thresholds = np.zeros(action_amount)
+    availability_thresholds[adopt_index] = model_coefficients[
+        'availability_threshold_adopt'
+    ]
+    availability_thresholds[leave_index] = model_coefficients[
+        'availability_threshold_leave'
+    ]
+    # Adopting depends on the availability (yes) and
+    # leaving on the non-availability (no)
+    availability_selectors = np.zeros(action_amount, dtype=int)
+    availability_selectors[adopt_index] = (
+        yes_factor_offsets['yes'] + availability_index
+    )
+    availability_selectors[leave_index] = (
+        yes_factor_offsets['no'] + availability_index
+    )
+
+    intention_scores = np.zeros(
+        (action_amount, stakeholder_amount, category_amount, term_amount)
+    )
+    # Padding terms point to the constant (and have a zero score)
+    intention_selectors = np.full(
+        (action_amount, stakeholder_amount, category_amount, term_amount),
+        yes_factor_offsets['constant'],
+    )
+    compiled_category_weights = np.zeros((stakeholder_amount, category_amount))
+    for stakeholder_index, stakeholder in enumerate(stakeholders):
+        for category_index, (category, weight) in enumerate(
+            zip(
+                intention_categories[stakeholder],
+                category_weights[stakeholder],
+            )
+        ):
+            compiled_category_weights[
+                stakeholder_index, category_index
+            ] = weight
+            for action_index, action in enumerate(survey_scores_actions):
+                category_scores = categories_intention_scores[stakeholder][
+                    category
+                ][action]
+                yes_codes = categories_yes_codes[stakeholder][category][action]
+                for term_index, (category_score, yes_code) in enumerate(
+                    zip(category_scores, yes_codes)
+                ):
+                    yes_type = yes_code.split('_')[0]
+                    yes_stakeholder = yes_code.split('_')[1]
+                    intention_scores[
+                        action_index,
+                        stakeholder_index,
+                        category_index,
+                        term_index,
+                    ] = category_score
+                    intention_selectors[
+                        action_index,
+                        stakeholder_index,
+                        category_index,
+                        term_index,
+                    ] = yes_factor_offsets[yes_type] + stakeholders.index(
+                        yes_stakeholder
+                    )
+
+    compiled_coefficients = {}
+    compiled_coefficients['stakeholder_amount'] = stakeholder_amount
+    compiled_coefficients['system_amount'] = 1
+    compiled_coefficients['adopt_index'] = adopt_index
+    compiled_coefficients['leave_index'] = leave_index
+    compiled_coefficients['attention'] = attention[np.newaxis]
+    compiled_coefficients['enable'] = enable[np.newaxis]
+    compiled_coefficients[
+        'availability_stakeholders'
+    ] = availability_stakeholders
+    compiled_coefficients['availability_selectors'] = availability_selectors
+    compiled_coefficients['availability_thresholds'] = availability_thresholds[
+        np.newaxis
+    ]
+    compiled_coefficients['intention_scores'] = intention_scores[np.newaxis]
+    compiled_coefficients['intention_selectors'] = intention_selectors
+    compiled_coefficients['category_weights'] = compiled_category_weights[
+        np.newaxis
+    ]
+
+    return compiled_coefficients
+
+
+def compile_intention_score_map(model_coefficients):
+    '''
+    Compiles how the intention scores of compile_model_coefficients
+    depend on the survey scores. Each intention score is the survey score
+    of a stakeholder, component, and action multiplied by a component
+    weight. We return the list of the (stakeholder, component, action)
+    survey score keys, the index (in that list) of the survey score of each
+    intention score, and the component weights (zero for padding terms).
+    This lets us build the intention scores of many sets of survey
+    scores at once.
+    '''
+    stakeholders = model_coefficients['stakeholders']
+    survey_scores_actions = model_coefficients['survey_scores_actions']
+    intention_categories = model_coefficients['intention_categories']
+    categories_yes_codes = model_coefficients['categories_yes_codes']
+
+    stakeholder_amount = len(stakeholders)
+    action_amount = len(survey_scores_actions)
+    category_amount = max(
+        len(intention_categories[stakeholder]) for stakeholder in stakeholders
+    )
+    term_amount = max(
+        len(categories_yes_codes[stakeholder][category][action])
+        for stakeholder in stakeholders
+        for category in intention_categories[stakeholder]
+        for action in survey_scores_actions
+    )
+
+    survey_score_keys = []
+    survey_score_indices = np.zeros(
+        (action_amount, stakeholder_amount, category_amount, term_amount),
+        dtype=int,
+    )
+    component_weights = np.zeros(
+        (action_amount, stakeholder_amount, category_amount, term_amount)
+    )
+    for stakeholder_index, stakeholder in enumerate(stakeholders):
+        for category_index, category in enumerate(
+            intention_categories[stakeholder]
+        ):
+            category_parameters = intention_categories[stakeholder][category]
+            for action_index, action in enumerate(survey_scores_actions):
+                for term_index, (component, component_weight) in enumerate(
+                    zip(
+                        category_parameters['survey_components'],
+                        category_parameters['survey_component_weights'],
+                    )
+                ):
+                    survey_score_key = (stakeholder, component, action)
+                    if survey_score_key not in survey_score_keys:
+                        survey_score_keys.append(survey_score_key)
+                    survey_score_indices[
+                        action_index,
+                        stakeholder_index,
+                        category_index,
+                        term_index,
+                    ] = survey_score_keys.index(survey_score_key)
+                    component_weights[
+                        action_index,
+                        stakeholder_index,
+                        category_index,
+                        term_index,
+                    ] = component_weight
+
+    return survey_score_keys, survey_score_indices, component_weights
+
+
+def shift_category_weights(
+    category_weights, changed_category_index, new_weight
+):
+    '''
+    Changes the weight of an intention category and shifts the other
+    weights (in proportion to their values) so that the weights still
+    add up to one, as the GRETA tool does when a weight slider moves.
+    The categories are the last dimension of the weights array, so we
+    can shift the weights of several systems at once. The changed
+    category and the new weight can be the same for all systems, or
+    be given for each of them (as arrays with the other dimensions of the
+    weights array).
+    '''
+    category_weights = np.asarray(category_weights, dtype=float)
+    changed_categories = (
+        np.arange(category_weights.shape[-1])
+        == np.asarray(changed_category_index)[..., np.newaxis]
+    )
+    other_weights = np.where(changed_categories, 0, category_weights)
+    weight_shift_split = other_weights / np.sum(
+        other_weights, axis=-1, keepdims=True
+    )
+    weight_shift = new_weight - np.sum(
+        np.where(changed_categories, category_weights, 0), axis=-1
+    )
+    # We avoid negative weights
+    new_weights = np.maximum(
+        category_weights - weight_shift[..., np.newaxis] * weight_shift_split,
+        0,
+    )
+    new_weights = np.where(
+        changed_categories,
+        np.asarray(new_weight, dtype=float)[..., np.newaxis],
+        new_weights,
+    )
+
+    return new_weights / np.sum(new_weights, axis=-1, keepdims=True)
+
+
+def stack_compiled_coefficients(compiled_coefficients_list):
+    '''
+    Stacks the compiled coefficients of several (product, country) systems
+    (see compile_model_coefficients) along their system axis, so that
+    they can be solved together as one state.
+    The selectors are the same for all systems, as they only depend
+    on the intention categories of the stakeholders.
+    '''
+    system_arrays = [
+        'attention',
+        'enable',
+        'availability_thresholds',
+        'intention_scores',
+        'category_weights',
+    ]
+    stacked_coefficients = dict(compiled_coefficients_list[0])
+    for system_array in system_arrays:
+        stacked_coefficients[system_array] = np.concatenate(
+            [
+                compiled_coefficients[system_array]
+                for compiled_coefficients in compiled_coefficients_list
+            ]
+        )
+    stacked_coefficients['system_amount'] = sum(
+        compiled_coefficients['system_amount']
+        for compiled_coefficients in compiled_coefficients_list
+    )
+
+    return stacked_coefficients
+
+
+def select_compiled_systems(compiled_coefficients, system_indices):
+    '''
+    Selects some of the systems of (stacked) compiled coefficients
+    (see stack_compiled_coefficients), for example to solve them again
+    with another method.
+    '''
+    system_arrays = [
+        'attention',
+        'enable',
+        'availability_thresholds',
+        'intention_scores',
+        'category_weights',
+    ]
+    selected_coefficients = dict(compiled_coefficients)
+    for system_array in system_arrays:
+        selected_coefficients[system_array] = compiled_coefficients[
+            system_array
+        ][system_indices]
+    selected_coefficients['system_amount'] = len(system_indices)
+
+    return selected_coefficients
+
+
 if __name__ == '__main__':
     time_start = datetime.datetime.now()
     print((datetime.datetime.now() - time_start).total_seconds())
@@ -0,0 +1,345 @@
+'''
+This module computes the global (Sobol) sensitivity indices of the
+long-term averages to the intention weights and the survey topic values.
+We use Saltelli sampling (with a Sobol sequence) and the Saltelli
+(first-order) and Jansen (total) estimators.
+The factors vary around their values in the database: the intention
+weights by a relative range (and are then normalised again, as in the
+GRETA tool), and the survey topic values by an absolute range
+(within zero and one).
+The settings are in the [sensitivity] section of the parameters file.
+'''
+
+import concurrent.futures
+import datetime
+import itertools
+
+import numpy as np
+import pandas as pd
+import scipy.stats.qmc as qmc
+from ETS_CookBook import ETS_CookBook as cook
+
+try:
+    from pLAtYpus_TNO import solver
+except ModuleNotFoundError:
+    import solver
+
+try:
+    from pLAtYpus_TNO import scores
+except ModuleNotFoundError:
+    import scores
+
+
+def get_sensitivity_factors(
+    model_coefficients, compiled_coefficients, parameters
+):
+    '''
+    Gets the factors of the sensitivity analysis of a (product, country)
+    system, with their names (which follow the slider names of the
+    GRETA tool), values, and lower and upper bounds.
+    Returns the factor names, an array with values and bounds (in rows),
+    and the positions of the factors in the compiled category weights
+    (for the weights) or in the survey score keys of
+    scores.compile_intention_score_map (for the survey topics).
+    '''
+    sensitivity_parameters = parameters['sensitivity']
+    weight_relative_range = sensitivity_parameters['weight_relative_range']
+    survey_topic_range = sensitivity_parameters['survey_topic_range']
+    stakeholders = model_coefficients['stakeholders']
+    intention_categories = model_coefficients['intention_categories']
+    survey_scores = model_coefficients['survey_scores']
+    (
+        survey_score_keys,
+        survey_score_indices,
+        component_weights,
+    ) = scores.compile_intention_score_map(model_coefficients)
+
+    factor_names = []
+    factor_values = []
+    weight_positions = []
+    for stakeholder_index, stakeholder in enumerate(stakeholders):
+        for category_index, category in enumerate(
+            intention_categories[stakeholder]
+        ):
+            factor_names.append(f'intention_weight__{stakeholder}__{category}')
+            factor_values.append(
+                compiled_coefficients['category_weights'][
+                    0, stakeholder_index, category_index
+                ]
+            )
+            weight_positions.append((stakeholder_index, category_index))
+    weight_values = np.array(factor_values)
+    weight_bounds = [
+        weight_values * (1 - weight_relative_range),
+        weight_values * (1 + weight_relative_range),
+    ]
+
+    survey_topic_positions = []
+    survey_topic_values = []
+    for survey_score_index, (stakeholder, component, action) in enumerate(
+        survey_score_keys
+    ):
+        # The constant (one) components are not survey topics
+        if component == 'one':
+            continue
+        factor_names.append(
+            f'survey_topic__{stakeholder}__{component}__{action}'
+        )
+        survey_topic_values.append(
+            float(survey_scores.loc[stakeholder, component][action])
+        )
+        survey_topic_positions.append(survey_score_index)
+    survey_topic_values = np.array(survey_topic_values)
+    survey_topic_bounds = [
+        np.maximum(survey_topic_values - survey_topic_range, 0),
+        np.minimum(survey_topic_values + survey_topic_range, 1),
+    ]
+
+    factors = np.array(
+        [
+            np.concatenate((weight_values, survey_topic_values)),
+            np.concatenate((weight_bounds[0], survey_topic_bounds[0])),
+            np.concatenate((weight_bounds[1], survey_topic_bounds[1])),
+        ]
+    )
+
+    return factor_names, factors, weight_positions, survey_topic_positions
+
+
+def get_saltelli_samples(factors, parameters):
+    '''
+    Makes the Saltelli sample matrices: two independent matrices A and B
+    (from one scrambled Sobol sequence of twice the number of factors),
+    and, for each factor, the matrix A with the column of that factor
+    taken from B. Returns all these samples stacked (A, B, and then
+    the mixed matrices), scaled to the bounds of the factors.
+    '''
+    sensitivity_parameters = parameters['sensitivity']
+    base_sample_exponent = sensitivity_parameters['base_sample_exponent']
+    seed = sensitivity_parameters['seed']
+    factor_amount = factors.shape[1]
+
+    sobol_sampler = qmc.Sobol(d=2 * factor_amount, scramble=True, seed=seed)
+    base_samples = sobol_sampler.random_base2(m=base_sample_exponent)
+    samples_A = base_samples[:, :factor_amount]
+    samples_B = base_samples[:, factor_amount:]
+    samples_AB = np.repeat(samples_A[np.newaxis], factor_amount, axis=0)
+    factor_indices = np.arange(factor_amount)
+    samples_AB[factor_indices, :, factor_indices] = samples_B[
+        :, factor_indices
+    ].T
+
+    unit_samples = np.concatenate(
+        (samples_A, samples_B, np.reshape(samples_AB, (-1, factor_amount)))
+    )
+
+    return factors[1] + unit_samples * (factors[2] - factors[1])
+
+
+def get_sample_long_term_averages(
+    initial_yes,
+    model_coefficients,
+    compiled_coefficients,
+    factor_samples,
+    weight_positions,
+    survey_topic_positions,
+    parameters,
+):
+    '''
+    Computes the long-term averages of all the factor samples
+    (with solver.get_long_term_average_values), with the samples
+    stacked as systems, in chunks. The samples only change the category
+    weights and intention scores of the compiled coefficients.
+    Returns an array with (sample, stakeholder) dimensions.
+    '''
+    sensitivity_parameters = parameters['sensitivity']
+    chunk_size = sensitivity_parameters['chunk_size']
+    sample_parameters = dict(parameters)
+    sample_parameters['pLAtYpus'] = dict(parameters['pLAtYpus'])
+    sample_parameters['pLAtYpus'][
+        'long_term_average_method'
+    ] = sensitivity_parameters['long_term_average_method']
+    survey_scores = model_coefficients['survey_scores']
+    (
+        survey_score_keys,
+        survey_score_indices,
+        component_weights,
+    ) = scores.compile_intention_score_map(model_coefficients)
+    survey_score_values = np.array(
+        [
+            float(survey_scores.loc[stakeholder, component][action])
+            for (stakeholder, component, action) in survey_score_keys
+        ]
+    )
+    weight_amount = len(weight_positions)
+    weight_stakeholders, weight_categories = np.transpose(weight_positions)
+
+    sample_amount = len(factor_samples)
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    long_term_averages = np.zeros((sample_amount, stakeholder_amount))
+    for chunk_start in range(0, sample_amount, chunk_size):
+        chunk_samples = factor_samples[chunk_start : chunk_start + chunk_size]
+        chunk_coefficients = scores.stack_compiled_coefficients(
+            [compiled_coefficients] * len(chunk_samples)
+        )
+
+        category_weights = np.zeros(
+            chunk_coefficients['category_weights'].shape
+        )
+        category_weights[
+            :, weight_stakeholders, weight_categories
+        ] = chunk_samples[:, :weight_amount]
+        # The weights of each stakeholder need to stay normalised
+        category_weights /= np.sum(category_weights, axis=-1, keepdims=True)
+        chunk_coefficients['category_weights'] = category_weights
+
+        survey_score_samples = np.repeat(
+            survey_score_values[np.newaxis], len(chunk_samples), axis=0
+        )
+        survey_score_samples[:, survey_topic_positions] = chunk_samples[
+            :, weight_amount:
+        ]
+        chunk_coefficients['intention_scores'] = (
+            survey_score_samples[:, survey_score_indices] * component_weights
+        )
+
+        long_term_averages[
+            chunk_start : chunk_start + chunk_size
+        ] = solver.get_long_term_average_values(
+            np.tile(initial_yes, len(chunk_samples)),
+            chunk_coefficients,
+            sample_parameters,
+        )
+
+    return long_term_averages
+
+
+def get_system_sensitivity_indices(
+    system, initial_yes, model_coefficients, parameters
+):
+    '''
+    Computes the first-order and total Sobol indices of the long-term
+    averages of a (product, country) system.
+    This is a function of the module so that processes can run it.
+    Returns a DataFrame with the stakeholders and factors as index.
+    '''
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    compiled_coefficients = scores.compile_model_coefficients(
+        model_coefficients
+    )
+    (
+        factor_names,
+        factors,
+        weight_positions,
+        survey_topic_positions,
+    ) = get_sensitivity_factors(
+        model_coefficients, compiled_coefficients, parameters
+    )
+    factor_amount = len(factor_names)
+
+    factor_samples = get_saltelli_samples(factors, parameters)
+    long_term_averages = get_sample_long_term_averages(
+        initial_yes,
+        model_coefficients,
+        compiled_coefficients,
+        factor_samples,
+        weight_positions,
+        survey_topic_positions,
+        parameters,
+    )
+
+    base_sample_amount = len(factor_samples) // (factor_amount + 2)
+    outputs_A = long_term_averages[:base_sample_amount]
+    outputs_B = long_term_averages[base_sample_amount : 2 * base_sample_amount]
+    outputs_AB = np.reshape(
+        long_term_averages[2 * base_sample_amount :],
+        (factor_amount, base_sample_amount, len(stakeholders)),
+    )
+    output_variances = np.var(np.concatenate((outputs_A, outputs_B)), axis=0)
+    # We avoid dividing by zero for outputs that do not change
+    output_variances[output_variances == 0] = np.nan
+
+    first_order_indices = (
+        np.mean(outputs_B * (outputs_AB - outputs_A), axis=1)
+        / output_variances
+    )
+    total_indices = (
+        0.5 * np.mean((outputs_A - outputs_AB) ** 2, axis=1) / output_variances
+    )
+
+    sensitivity_index = pd.MultiIndex.from_product(
+        [stakeholders, factor_names], names=['Stakeholder', 'Parameter']
+    )
+    sensitivity_indices = pd.DataFrame(
+        {
+            'First order': np.ravel(first_order_indices.T),
+            'Total': np.ravel(total_indices.T),
+        },
+        index=sensitivity_index,
+    )
+
+    return sensitivity_indices
+
+
+def get_all_sensitivity_indices(parameters, jobs=None):
+    '''
+    Computes the Sobol indices of all (product, country) systems
+    (spread over a pool of processes, see solver.get_job_amount) and
+    saves them in one table (with product, country, stakeholder, and
+    parameter as index).
+    '''
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    sensitivity_table_name = parameters['sensitivity'][
+        'sensitivity_table_name'
+    ]
+    jobs = solver.get_job_amount(parameters, jobs)
+
+    (
+        systems_initial_yes,
+        systems_model_coefficients,
+    ) = solver.get_all_systems_inputs(parameters)
+    systems = list(systems_model_coefficients.keys())
+    systems_arguments = (
+        systems,
+        [systems_initial_yes[system] for system in systems],
+        [systems_model_coefficients[system] for system in systems],
+        itertools.repeat(parameters),
+    )
+
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs
+        ) as executor:
+            systems_sensitivity_indices = list(
+                executor.map(
+                    get_system_sensitivity_indices, *systems_arguments
+                )
+            )
+    else:
+        systems_sensitivity_indices = list(
+            map(get_system_sensitivity_indices, *systems_arguments)
+        )
+
+    sensitivity_indices = pd.concat(
+        systems_sensitivity_indices,
+        keys=systems,
+        names=['Product', 'Country'],
+    )
+    cook.save_dataframe(
+        sensitivity_indices,
+        sensitivity_table_name,
+        groupfile_name,
+        output_folder,
+        parameters,
+    )
+
+
+if __name__ == '__main__':
+    start = datetime.datetime.now()
+    parameters_file_name = 'pLAtYpus.toml'
+    parameters = cook.parameters_from_TOML(parameters_file_name)
+    get_all_sensitivity_indices(parameters)
+    end = datetime.datetime.now()
+    print((end - start).total_seconds())
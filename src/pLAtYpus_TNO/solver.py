@@ -1,7 +1,11 @@
+import concurrent.futures
+import itertools
+import os
 import scipy.integrate as spi
+import scipy.interpolate as spin
+import scipy.sparse as sps
 import math
 import datetime
-import sqlite3
 import matplotlib.pyplot as plt
 import numpy as np
 from ETS_CookBook import ETS_CookBook as cook
@@ -13,6 +17,11 @@ try:
 except ModuleNotFoundError:
     import scores
 
+try:
+    from pLAtYpus_TNO import model_store as model_store_module
+except ModuleNotFoundError:
+    import model_store as model_store_module
+
 
 def phase_values(time, yes, model_coefficients):
     '''
@@ -51,8 +60,859 @@ def pLAtYpus_model(time, yes, model_coefficients):
     return (1 - yes) * adopt - yes * leave
 
 
+def compiled_phase_values(yes_values, compiled_coefficients):
+    '''
+    Computes the phase values from compiled coefficients (see
+    scores.compile_model_coefficients).
+    The yes values have a shape of (..., systems, stakeholders) and the
+    phase values that are returned have a shape of
+    (..., systems, actions, stakeholders).
+    '''
+    intention_selectors = compiled_coefficients['intention_selectors']
+    availability_selectors = compiled_coefficients['availability_selectors']
+    availability_stakeholders = compiled_coefficients[
+        'availability_stakeholders'
+    ]
+
+    yes_factors = np.concatenate(
+        (yes_values, 1 - yes_values, np.ones_like(yes_values)), axis=-1
+    )
+
+    attention = compiled_coefficients['attention']
+
+    availability_values = yes_factors[..., availability_selectors]
+    availability_factors = np.where(
+        availability_values < compiled_coefficients['availability_thresholds'],
+        availability_values,
+        1,
+    )
+    enable = compiled_coefficients['enable'] * np.where(
+        availability_stakeholders, availability_factors[..., np.newaxis], 1
+    )
+
+    term_values = (
+        compiled_coefficients['intention_scores']
+        * yes_factors[..., intention_selectors]
+    )
+    # We use cumulative sums (and take the last one) because they add
+    # the terms in the same order as the original loops, which
+    # keeps the results identical to the non-compiled model
+    category_values = np.cumsum(term_values, axis=-1)[..., -1]
+    weighted_category_values = (
+        category_values
+        * compiled_coefficients['category_weights'][:, np.newaxis]
+    )
+    intention = np.cumsum(weighted_category_values, axis=-1)[..., -1]
+
+    return attention, enable, intention
+
+
+def compiled_pLAtYpus_model(time, yes, compiled_coefficients):
+    '''
+    This is the pLAtYpus model, computed from compiled coefficients.
+    The yes values contain the stakeholders of all the stacked systems
+    (one after the other). They can also have a second axis (for
+    vectorized calls of the solver).
+    '''
+    system_amount = compiled_coefficients['system_amount']
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    adopt_index = compiled_coefficients['adopt_index']
+    leave_index = compiled_coefficients['leave_index']
+
+    yes_values = np.reshape(
+        np.transpose(yes), (-1, system_amount, stakeholder_amount)
+    )
+    attention, enable, intention = compiled_phase_values(
+        yes_values, compiled_coefficients
+    )
+    adopt = (
+        attention[..., adopt_index, :]
+        * enable[..., adopt_index, :]
+        * intention[..., adopt_index, :]
+    )
+    leave = (
+        attention[..., leave_index, :]
+        * enable[..., leave_index, :]
+        * intention[..., leave_index, :]
+    )
+    yes_change = (1 - yes_values) * adopt - yes_values * leave
+
+    return np.reshape(
+        np.transpose(np.reshape(yes_change, (len(yes_values), -1))),
+        np.shape(yes),
+    )
+
+
+def compiled_jacobian_blocks(yes_values, compiled_coefficients):
+    '''
+    Computes the Jacobian blocks of the pLAtYpus model (one block per
+    system, so the yes values have a (system, stakeholder) shape).
+    The model is a polynomial in the yes values (the intention is linear
+    in the yes factors, and the enable phase is piecewise linear in the
+    availability), so we can derive its Jacobian in closed form.
+    '''
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    adopt_index = compiled_coefficients['adopt_index']
+    leave_index = compiled_coefficients['leave_index']
+    intention_selectors = compiled_coefficients['intention_selectors']
+    availability_selectors = compiled_coefficients['availability_selectors']
+    availability_stakeholders = compiled_coefficients[
+        'availability_stakeholders'
+    ]
+
+    attention, enable, intention = compiled_phase_values(
+        yes_values, compiled_coefficients
+    )
+
+    # The yes factors are the yes values, the no values, and ones,
+    # so their gradients are the identity, minus the identity, and zeros
+    yes_factor_gradients = np.concatenate(
+        (
+            np.eye(stakeholder_amount),
+            -np.eye(stakeholder_amount),
+            np.zeros((stakeholder_amount, stakeholder_amount)),
+        )
+    )
+
+    intention_gradients = np.einsum(
+        'naick,aickj,nic->naij',
+        compiled_coefficients['intention_scores'],
+        yes_factor_gradients[intention_selectors],
+        compiled_coefficients['category_weights'],
+    )
+
+    yes_factors = np.concatenate(
+        (yes_values, 1 - yes_values, np.ones_like(yes_values)), axis=-1
+    )
+    availability_values = yes_factors[..., availability_selectors]
+    availability_is_active = (
+        availability_values < compiled_coefficients['availability_thresholds']
+    )
+    availability_gradients = (
+        availability_is_active[..., np.newaxis]
+        * yes_factor_gradients[availability_selectors]
+    )
+    enable_gradients = (
+        compiled_coefficients['enable'][..., np.newaxis]
+        * availability_stakeholders[:, np.newaxis]
+        * availability_gradients[:, :, np.newaxis, :]
+    )
+
+    phase_products = attention * enable * intention
+    phase_product_gradients = attention[..., np.newaxis] * (
+        enable_gradients * intention[..., np.newaxis]
+        + enable[..., np.newaxis] * intention_gradients
+    )
+
+    jacobian_blocks = (
+        1 - yes_values[..., np.newaxis]
+    ) * phase_product_gradients[:, adopt_index] - yes_values[
+        ..., np.newaxis
+    ] * phase_product_gradients[
+        :, leave_index
+    ]
+    jacobian_blocks -= (
+        phase_products[:, adopt_index] + phase_products[:, leave_index]
+    )[..., np.newaxis] * np.eye(stakeholder_amount)
+
+    return jacobian_blocks
+
+
+def compiled_pLAtYpus_jacobian(time, yes, compiled_coefficients):
+    '''
+    This is the analytic Jacobian of the pLAtYpus model (computed from
+    compiled coefficients, see compiled_jacobian_blocks).
+    Since the stacked systems are independent, the Jacobian is
+    block-diagonal. We return a dense array for one system and a sparse
+    block matrix for several systems.
+    '''
+    system_amount = compiled_coefficients['system_amount']
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+
+    yes_values = np.reshape(yes, (system_amount, stakeholder_amount))
+    jacobian_blocks = compiled_jacobian_blocks(
+        yes_values, compiled_coefficients
+    )
+
+    if system_amount == 1:
+        return jacobian_blocks[0]
+
+    return sps.bsr_matrix(
+        (
+            jacobian_blocks,
+            np.arange(system_amount),
+            np.arange(system_amount + 1),
+        ),
+        shape=(
+            system_amount * stakeholder_amount,
+            system_amount * stakeholder_amount,
+        ),
+    )
+
+
+def compiled_pLAtYpus_dense_jacobian(time, yes, compiled_coefficients):
+    '''
+    Returns the analytic Jacobian as a dense array
+    (for solvers that do not support sparse Jacobians, such as LSODA).
+    '''
+    jacobian = compiled_pLAtYpus_jacobian(time, yes, compiled_coefficients)
+    if sps.issparse(jacobian):
+        jacobian = jacobian.toarray()
+
+    return jacobian
+
+
+def get_solver_options(parameters, compiled_coefficients):
+    '''
+    Returns the options that we give to solve_ivp (method, tolerances,
+    Jacobian, and vectorization), which are set in the [pLAtYpus] section
+    of the parameters file.
+    The analytic Jacobian is only given to the implicit methods
+    (Radau, BDF, and LSODA), as the explicit ones do not use it.
+    When several systems are stacked, we divide the tolerances by
+    the square root of the number of systems, since the solver uses
+    one (root mean square) error norm for the whole state.
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    solver_method = pLAtYpus_parameters['solver_method']
+    relative_tolerance = pLAtYpus_parameters['relative_tolerance']
+    absolute_tolerance = pLAtYpus_parameters['absolute_tolerance']
+    use_analytic_jacobian = pLAtYpus_parameters['use_analytic_jacobian']
+    vectorized_model = pLAtYpus_parameters['vectorized_model']
+
+    tolerance_scaling = 1 / math.sqrt(compiled_coefficients['system_amount'])
+
+    solver_options = {}
+    solver_options['method'] = solver_method
+    solver_options['rtol'] = relative_tolerance * tolerance_scaling
+    solver_options['atol'] = absolute_tolerance * tolerance_scaling
+    solver_options['vectorized'] = vectorized_model
+    if use_analytic_jacobian:
+        if solver_method == 'LSODA':
+            solver_options['jac'] = compiled_pLAtYpus_dense_jacobian
+        elif solver_method in ['Radau', 'BDF']:
+            solver_options['jac'] = compiled_pLAtYpus_jacobian
+
+    return solver_options
+
+
+def get_system_solver_parameters(
+    product, country, parameters, model_store=None
+):
+    '''
+    Gets the parameters with the solver method and tolerances that are
+    recommended for a given product and country (see
+    benchmark.run_solver_benchmark), if use_solver_configurations is set
+    and the system has a configuration. Otherwise, the parameters
+    are returned as they are.
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    use_solver_configurations = pLAtYpus_parameters[
+        'use_solver_configurations'
+    ]
+    solver_configurations_table_name = pLAtYpus_parameters[
+        'solver_configurations_table_name'
+    ]
+
+    if not use_solver_configurations:
+        return parameters
+
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    if not model_store.has_table(solver_configurations_table_name):
+        return parameters
+    solver_configuration = model_store.read_table(
+        solver_configurations_table_name,
+        filter_quantities=['Product', 'Country'],
+        filter_types=['=', '='],
+        filter_values=[product, country],
+    )
+    if len(solver_configuration) == 0:
+        return parameters
+
+    system_parameters = dict(parameters)
+    system_parameters['pLAtYpus'] = dict(pLAtYpus_parameters)
+    system_parameters['pLAtYpus']['solver_method'] = solver_configuration[
+        'Method'
+    ].values[0]
+    system_parameters['pLAtYpus']['relative_tolerance'] = float(
+        solver_configuration['Relative tolerance'].values[0]
+    )
+    system_parameters['pLAtYpus']['absolute_tolerance'] = float(
+        solver_configuration['Absolute tolerance'].values[0]
+    )
+
+    return system_parameters
+
+
+def get_steady_states(initial_yes, compiled_coefficients, parameters):
+    '''
+    Finds the fixed points of the pLAtYpus model (for all the stacked
+    systems at once) with a Newton iteration that starts from the
+    initial yes values and uses the analytic Jacobian blocks.
+    We keep the yes values between zero and one at each step.
+    Returns the steady states (with a (system, stakeholder) shape) and
+    which of them are stable equilibria, i.e. the iteration converged
+    and all the eigenvalues of their Jacobian have negative real parts.
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    steady_state_tolerance = pLAtYpus_parameters['steady_state_tolerance']
+    steady_state_maximum_iterations = pLAtYpus_parameters[
+        'steady_state_maximum_iterations'
+    ]
+    system_amount = compiled_coefficients['system_amount']
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+
+    steady_states = np.reshape(
+        np.array(initial_yes, dtype=float),
+        (system_amount, stakeholder_amount),
+    )
+    for iteration in range(steady_state_maximum_iterations):
+        rates = compiled_pLAtYpus_model(
+            0, steady_states.ravel(), compiled_coefficients
+        ).reshape(system_amount, stakeholder_amount)
+        if np.max(np.abs(rates)) < steady_state_tolerance:
+            break
+        jacobian_blocks = compiled_jacobian_blocks(
+            steady_states, compiled_coefficients
+        )
+        # We use the pseudo-inverse so that a singular block
+        # does not stop the iteration for the other systems
+        newton_steps = np.einsum(
+            'nij,nj->ni', np.linalg.pinv(jacobian_blocks), rates
+        )
+        steady_states = np.clip(steady_states - newton_steps, 0, 1)
+
+    rates = compiled_pLAtYpus_model(
+        0, steady_states.ravel(), compiled_coefficients
+    ).reshape(system_amount, stakeholder_amount)
+    jacobian_blocks = compiled_jacobian_blocks(
+        steady_states, compiled_coefficients
+    )
+    has_converged = np.max(np.abs(rates), axis=-1) < steady_state_tolerance
+    is_stable = has_converged & (
+        np.max(np.linalg.eigvals(jacobian_blocks).real, axis=-1) < 0
+    )
+
+    return steady_states, is_stable
+
+
+def get_integrated_long_term_averages(
+    initial_yes, compiled_coefficients, parameters
+):
+    '''
+    Computes the long-term averages of the yes values (for all the
+    stacked systems) by integrating the model and averaging over the end
+    of the time span (given by percentage_time_span_end_average).
+    This is the same as what we get from the saved yes evolutions,
+    but we keep everything in memory.
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    time_span = pLAtYpus_parameters['time_span']
+    time_steps = pLAtYpus_parameters['time_steps']
+    percentage_time_span_end_average = pLAtYpus_parameters[
+        'percentage_time_span_end_average'
+    ]
+    run_duration = time_span[1] - time_span[0]
+    end_average_time_start = (
+        1 - percentage_time_span_end_average
+    ) * run_duration
+    system_amount = compiled_coefficients['system_amount']
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+
+    yes_solutions = spi.solve_ivp(
+        compiled_pLAtYpus_model,
+        t_span=time_span,
+        y0=initial_yes,
+        args=(compiled_coefficients,),
+        dense_output=True,
+        **get_solver_options(parameters, compiled_coefficients),
+    )
+
+    time_range = np.linspace(time_span[0], time_span[1], time_steps)
+    end_average_times = time_range[time_range >= end_average_time_start]
+    end_average_yes_values = np.reshape(
+        yes_solutions.sol(end_average_times).T,
+        (len(end_average_times), system_amount, stakeholder_amount),
+    )
+
+    return np.average(end_average_yes_values, axis=0)
+
+
+def get_long_term_average_values(
+    initial_yes, compiled_coefficients, parameters
+):
+    '''
+    Gets the long-term averages of the yes values (with a
+    (system, stakeholder) shape) of the stacked systems, with the
+    method given by long_term_average_method in the parameters file.
+    With the steady_state method, we use the stable equilibria
+    of the model (which is what the long-term averages tend to) and
+    only integrate the systems that do not have one.
+    '''
+    long_term_average_method = parameters['pLAtYpus'][
+        'long_term_average_method'
+    ]
+    if long_term_average_method == 'integration':
+        return get_integrated_long_term_averages(
+            initial_yes, compiled_coefficients, parameters
+        )
+
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    long_term_average_values, is_stable = get_steady_states(
+        initial_yes, compiled_coefficients, parameters
+    )
+    unstable_systems = np.flatnonzero(~is_stable)
+    if len(unstable_systems) > 0:
+        unstable_initial_yes = np.reshape(
+            initial_yes, (-1, stakeholder_amount)
+        )[unstable_systems].ravel()
+        long_term_average_values[
+            unstable_systems
+        ] = get_integrated_long_term_averages(
+            unstable_initial_yes,
+            scores.select_compiled_systems(
+                compiled_coefficients, unstable_systems
+            ),
+            parameters,
+        )
+
+    return long_term_average_values
+
+
+def get_slider_sensitivity_map(model_coefficients, compiled_coefficients):
+    '''
+    Gets what we need to compute the sensitivities of the yes values to
+    the sliders of the GRETA tool of a (product, country) system:
+    the slider names (initial yes values, then intention weights, and then
+    survey topics, named as in GRETA_tool.update_from_slider), the
+    positions of the weight sliders in the compiled category weights, and
+    how the weights (and survey topics) enter the compiled model.
+    When a weight slider moves, the other weights of the stakeholder
+    shift in proportion to their values (so that they still add up to
+    one), so each weight slider moves all the weights of its stakeholder.
+    '''
+    product = model_coefficients['product']
+    country = model_coefficients['country']
+    stakeholders = model_coefficients['stakeholders']
+    intention_categories = model_coefficients['intention_categories']
+    (
+        survey_score_keys,
+        survey_score_indices,
+        component_weights,
+    ) = scores.compile_intention_score_map(model_coefficients)
+    category_weights = compiled_coefficients['category_weights'][0]
+
+    slider_names = [
+        f'initial_yes__{product}__{stakeholder}__{country}'
+        for stakeholder in stakeholders
+    ]
+
+    weight_positions = []
+    for stakeholder_index, stakeholder in enumerate(stakeholders):
+        for category_index, category in enumerate(
+            intention_categories[stakeholder]
+        ):
+            slider_names.append(
+                f'intention_weight__{product}__{stakeholder}__{country}__'
+                f'{category}'
+            )
+            weight_positions.append((stakeholder_index, category_index))
+    weight_stakeholders, weight_categories = np.transpose(weight_positions)
+    # The weight shifts split the change of a weight over the others
+    # (with the weight of the slider's category set to zero for the split)
+    other_weights = category_weights[weight_stakeholders]
+    other_weights[np.arange(len(weight_positions)), weight_categories] = 0
+    weight_slider_derivatives = -other_weights / np.sum(
+        other_weights, axis=-1, keepdims=True
+    )
+    weight_slider_derivatives[
+        np.arange(len(weight_positions)), weight_categories
+    ] = 1
+
+    survey_topic_positions = []
+    for survey_score_index, (stakeholder, component, action) in enumerate(
+        survey_score_keys
+    ):
+        # The constant (one) components are not survey topics
+        if component == 'one':
+            continue
+        slider_names.append(
+            f'survey_topic__{product}__{stakeholder}__{country}__'
+            f'{component}__{action}'
+        )
+        survey_topic_positions.append(survey_score_index)
+    survey_topic_terms = (
+        survey_score_indices[..., np.newaxis] == survey_topic_positions
+    ) * component_weights[..., np.newaxis]
+
+    slider_sensitivity_map = {}
+    slider_sensitivity_map['slider_names'] = slider_names
+    slider_sensitivity_map['weight_stakeholders'] = weight_stakeholders
+    slider_sensitivity_map['weight_categories'] = weight_categories
+    slider_sensitivity_map[
+        'weight_slider_derivatives'
+    ] = weight_slider_derivatives
+    slider_sensitivity_map['survey_topic_terms'] = survey_topic_terms
+
+    return slider_sensitivity_map
+
+
+def compiled_intention_derivatives(yes_values, compiled_coefficients):
+    '''
+    Computes the derivatives of the pLAtYpus model with respect to the
+    intentions (of each action and stakeholder), for yes values with a
+    (system, stakeholder) shape.
+    Returns an array with (system, action, stakeholder) dimensions.
+    '''
+    adopt_index = compiled_coefficients['adopt_index']
+    leave_index = compiled_coefficients['leave_index']
+
+    attention, enable, intention = compiled_phase_values(
+        yes_values, compiled_coefficients
+    )
+    intention_derivatives = attention * enable
+    intention_derivatives[:, adopt_index] *= 1 - yes_values
+    intention_derivatives[:, leave_index] *= -yes_values
+
+    return intention_derivatives
+
+
+def compiled_weight_derivatives(yes_values, compiled_coefficients):
+    '''
+    Computes the derivatives of the pLAtYpus model with respect to the
+    category weights (before any normalisation), for yes values with a
+    (system, stakeholder) shape. The intentions are linear in the weights,
+    so these are the category values times the intention derivatives.
+    Returns an array with (system, stakeholder, category) dimensions
+    (the model of a stakeholder only depends on its own weights).
+    '''
+    intention_selectors = compiled_coefficients['intention_selectors']
+
+    yes_factors = np.concatenate(
+        (yes_values, 1 - yes_values, np.ones_like(yes_values)), axis=-1
+    )
+    category_values = np.sum(
+        compiled_coefficients['intention_scores']
+        * yes_factors[:, intention_selectors],
+        axis=-1,
+    )
+
+    return np.einsum(
+        'nas,nasc->nsc',
+        compiled_intention_derivatives(yes_values, compiled_coefficients),
+        category_values,
+    )
+
+
+def compiled_slider_derivatives(
+    yes_values, compiled_coefficients, slider_sensitivity_map
+):
+    '''
+    Computes the derivatives of the pLAtYpus model (for one system, so
+    the yes values are the ones of its stakeholders) with respect to the
+    sliders (see get_slider_sensitivity_map).
+    The sliders only change the intentions, which are linear in the
+    weights and in the survey topics, so the derivatives follow from
+    the category values and terms of the intentions.
+    The initial yes values do not appear in the model, so their
+    derivatives are zero.
+    Returns an array with (stakeholder, slider) dimensions.
+    '''
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    intention_selectors = compiled_coefficients['intention_selectors']
+    weight_stakeholders = slider_sensitivity_map['weight_stakeholders']
+    weight_slider_derivatives = slider_sensitivity_map[
+        'weight_slider_derivatives'
+    ]
+    survey_topic_terms = slider_sensitivity_map['survey_topic_terms']
+    weight_slider_amount = len(weight_stakeholders)
+
+    intention_derivatives = compiled_intention_derivatives(
+        yes_values[np.newaxis], compiled_coefficients
+    )[0]
+    weight_derivatives = compiled_weight_derivatives(
+        yes_values[np.newaxis], compiled_coefficients
+    )[0]
+
+    yes_factors = np.concatenate(
+        (yes_values, 1 - yes_values, np.ones_like(yes_values))
+    )
+    survey_topic_factors = (
+        compiled_coefficients['category_weights'][0][..., np.newaxis]
+        * yes_factors[intention_selectors]
+    )
+
+    slider_derivatives = np.zeros(
+        (
+            stakeholder_amount,
+            len(slider_sensitivity_map['slider_names']),
+        )
+    )
+    weight_sliders = np.arange(
+        stakeholder_amount, stakeholder_amount + weight_slider_amount
+    )
+    slider_derivatives[weight_stakeholders, weight_sliders] = np.sum(
+        weight_derivatives[weight_stakeholders] * weight_slider_derivatives,
+        axis=-1,
+    )
+    slider_derivatives[
+        :, stakeholder_amount + weight_slider_amount :
+    ] = np.einsum(
+        'as,asck,asckm->sm',
+        intention_derivatives,
+        survey_topic_factors,
+        survey_topic_terms,
+    )
+
+    return slider_derivatives
+
+
+def compiled_sensitivity_model(
+    time, augmented_yes, compiled_coefficients, slider_sensitivity_map
+):
+    '''
+    This is the pLAtYpus model of one system augmented with its forward
+    sensitivity equations: the state contains the yes values, followed by
+    their sensitivities to the sliders (with (stakeholder, slider)
+    dimensions). The sensitivities change with the Jacobian of the model
+    and its derivatives with respect to the sliders.
+    '''
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    yes_values = augmented_yes[:stakeholder_amount]
+    yes_sensitivities = np.reshape(
+        augmented_yes[stakeholder_amount:], (stakeholder_amount, -1)
+    )
+
+    yes_change = compiled_pLAtYpus_model(
+        time, yes_values, compiled_coefficients
+    )
+    jacobian = compiled_jacobian_blocks(
+        yes_values[np.newaxis], compiled_coefficients
+    )[0]
+    sensitivity_change = jacobian @ yes_sensitivities + (
+        compiled_slider_derivatives(
+            yes_values, compiled_coefficients, slider_sensitivity_map
+        )
+    )
+
+    return np.concatenate((yes_change, np.ravel(sensitivity_change)))
+
+
+def get_compiled_yes_sensitivities(
+    initial_yes,
+    compiled_coefficients,
+    slider_sensitivity_map,
+    time_range,
+    parameters,
+    threshold_events=False,
+):
+    '''
+    Integrates the yes values of one system together with their
+    sensitivities to the sliders (see compiled_sensitivity_model),
+    so that all the sensitivities come from a single integration.
+    The sensitivities to the initial yes values start at the identity
+    and the other ones at zero.
+    Returns the yes values (with (time, stakeholder) dimensions) and
+    their sensitivities (with (time, stakeholder, slider) dimensions) at
+    the times of the time range (and the times at which the yes values
+    cross the threshold levels if we look for threshold events,
+    see get_threshold_events).
+    '''
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    slider_amount = len(slider_sensitivity_map['slider_names'])
+
+    initial_sensitivities = np.zeros((stakeholder_amount, slider_amount))
+    initial_sensitivities[:, :stakeholder_amount] = np.eye(stakeholder_amount)
+
+    # The model Jacobian is not the one of the augmented system and the
+    # augmented model is not vectorized, so we leave these options out
+    solver_options = get_solver_options(parameters, compiled_coefficients)
+    solver_options.pop('jac', None)
+    solver_options['vectorized'] = False
+    if threshold_events:
+        solver_options['events'] = get_threshold_events(
+            stakeholder_amount, parameters
+        )
+
+    sensitivity_solutions = spi.solve_ivp(
+        compiled_sensitivity_model,
+        t_span=[time_range[0], time_range[-1]],
+        y0=np.concatenate((initial_yes, np.ravel(initial_sensitivities))),
+        args=(compiled_coefficients, slider_sensitivity_map),
+        dense_output=True,
+        **solver_options,
+    )
+    augmented_yes_values = sensitivity_solutions.sol(time_range).T
+
+    yes_values = augmented_yes_values[:, :stakeholder_amount]
+    yes_sensitivities = np.reshape(
+        augmented_yes_values[:, stakeholder_amount:],
+        (len(time_range), stakeholder_amount, slider_amount),
+    )
+
+    if threshold_events:
+        return yes_values, yes_sensitivities, sensitivity_solutions.t_events
+
+    return yes_values, yes_sensitivities
+
+
+def get_threshold_event(state_index, threshold_level):
+    '''
+    Makes an event function (for solve_ivp) that is zero when a yes value
+    of the state crosses a threshold level. The event is not terminal
+    and counts crossings in both directions.
+    '''
+
+    def threshold_event(time, yes, *model_arguments):
+        return yes[state_index] - threshold_level
+
+    return threshold_event
+
+
+def get_threshold_events(state_amount, parameters):
+    '''
+    Makes the threshold events of all the yes values of a state (for all
+    the stakeholders of its stacked systems) and all the threshold levels
+    of the parameters file. The events are ordered by state value and
+    then by threshold level.
+    '''
+    threshold_levels = parameters['pLAtYpus']['threshold_levels']
+
+    return [
+        get_threshold_event(state_index, threshold_level)
+        for state_index in range(state_amount)
+        for threshold_level in threshold_levels
+    ]
+
+
+def get_threshold_crossings(event_times, initial_yes, systems, parameters):
+    '''
+    Gets the threshold crossings of stacked (product, country) systems
+    from the event times of their solution (see get_threshold_events).
+    Returns a DataFrame with the product, country, stakeholder, and
+    threshold level as index, and the time of the first crossing, its
+    direction (one when the yes value goes above the threshold and
+    minus one when it goes below it), and the number of crossings
+    as columns. Thresholds that are never crossed have no
+    first crossing time and direction.
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    stakeholders = pLAtYpus_parameters['stakeholders']
+    threshold_levels = pLAtYpus_parameters['threshold_levels']
+
+    crossing_amounts = np.array(
+        [len(threshold_event_times) for threshold_event_times in event_times]
+    )
+    first_crossing_times = np.array(
+        [
+            threshold_event_times[0]
+            if len(threshold_event_times) > 0
+            else np.nan
+            for threshold_event_times in event_times
+        ]
+    )
+    # The first crossing goes up if the yes value starts below the threshold
+    first_crossing_directions = np.where(
+        np.repeat(initial_yes, len(threshold_levels))
+        < np.tile(threshold_levels, len(initial_yes)),
+        1.0,
+        -1.0,
+    )
+    first_crossing_directions[crossing_amounts == 0] = np.nan
+
+    threshold_crossings_index = pd.MultiIndex.from_tuples(
+        [
+            (product, country, stakeholder, threshold_level)
+            for (product, country) in systems
+            for stakeholder in stakeholders
+            for threshold_level in threshold_levels
+        ],
+        names=['Product', 'Country', 'Stakeholder', 'Threshold'],
+    )
+    threshold_crossings = pd.DataFrame(
+        {
+            'First crossing time': first_crossing_times,
+            'First crossing direction': first_crossing_directions,
+            'Crossing amount': crossing_amounts,
+        },
+        index=threshold_crossings_index,
+    )
+
+    return threshold_crossings
+
+
+def save_threshold_crossings(
+    threshold_crossings, parameters, model_store=None
+):
+    '''
+    Saves the threshold crossings of several systems (a list of
+    DataFrames from get_threshold_crossings) in one table.
+    '''
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    threshold_crossings_table_name = parameters['pLAtYpus'][
+        'threshold_crossings_table_name'
+    ]
+
+    model_store.save_dataframe(
+        pd.concat(threshold_crossings),
+        threshold_crossings_table_name,
+        groupfile_name,
+        output_folder,
+        parameters,
+    )
+
+
+def replace_threshold_crossings(
+    threshold_crossings, parameters, model_store=None
+):
+    '''
+    Replaces the rows of some systems in the threshold crossings table
+    with their new threshold crossings (a DataFrame from
+    get_threshold_crossings), for example when the GRETA tool
+    solves them again with other slider values.
+    The rows of the other systems stay as they are (and where they are).
+    '''
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    threshold_crossings_table_name = parameters['pLAtYpus'][
+        'threshold_crossings_table_name'
+    ]
+
+    if model_store.has_table(threshold_crossings_table_name):
+        stored_threshold_crossings = model_store.read_table(
+            threshold_crossings_table_name
+        ).set_index(threshold_crossings.index.names)
+        replaced_systems = threshold_crossings.index.droplevel(
+            ['Stakeholder', 'Threshold']
+        ).unique()
+        kept_threshold_crossings = stored_threshold_crossings[
+            ~stored_threshold_crossings.index.droplevel(
+                ['Stakeholder', 'Threshold']
+            ).isin(replaced_systems)
+        ]
+        threshold_crossings = pd.concat(
+            [kept_threshold_crossings, threshold_crossings]
+        )
+        # We keep the order of the table
+        threshold_crossings = threshold_crossings.reindex(
+            stored_threshold_crossings.index.append(threshold_crossings.index)
+            .unique()
+            .intersection(threshold_crossings.index, sort=False)
+        )
+
+    save_threshold_crossings([threshold_crossings], parameters, model_store)
+
+
 def get_yes_evolution(
-    initial_yes, model_coefficients, parameters, save_dataframe=True
+    initial_yes,
+    model_coefficients,
+    parameters,
+    save_dataframe=True,
+    forward_sensitivities=False,
+    threshold_crossings=False,
+    model_store=None,
 ):
     '''
     This function computes the yes values that result from given
@@ -66,6 +926,17 @@ def get_yes_evolution(
     on a dashboard).
     Saving the dataframe is optional (but turned on by default) because
     we might want to turn it off when playing with sliders on a dashboard.
+    With forward sensitivities, we integrate the sensitivities of the yes
+    values to all the sliders alongside them (see
+    get_compiled_yes_sensitivities) and also return the gradients of
+    the long-term averages (over the end of the time span, as in the maps)
+    to the sliders, in a DataFrame with the slider names as index
+    and the stakeholders as columns.
+    With threshold crossings, we also return the times at which the
+    yes values cross the threshold levels (see get_threshold_crossings),
+    which the solver finds as events.
+    A model store (see the model_store module) can be given to read the
+    solver configuration and save the dataframe.
     '''
 
     # We read the values from the dictionary.
@@ -85,32 +956,218 @@ def get_yes_evolution(
     yes_evolution_table_name = f'{product}_{country}'
     time_header = pLAtYpus_parameters['time_header']
 
-    yes_solutions = spi.solve_ivp(
-        pLAtYpus_model,
-        t_span=time_span,
-        y0=initial_yes,
-        args=(model_coefficients,),
-        # We need to pass the arguments as a tuple, with an empty
-        # second part to pass a dictionary as argument
-        dense_output=True,
+    # Each system can have its own solver configuration
+    parameters = get_system_solver_parameters(
+        product, country, parameters, model_store
+    )
+
+    # We compile the coefficients into arrays, so that the model
+    # does not need to look them up at every call
+    compiled_coefficients = scores.compile_model_coefficients(
+        model_coefficients
     )
 
     time_range = np.linspace(time_span[0], time_span[1], time_steps)
     stakeholders = pLAtYpus_parameters['stakeholders']
 
+    if forward_sensitivities:
+        slider_sensitivity_map = get_slider_sensitivity_map(
+            model_coefficients, compiled_coefficients
+        )
+        sensitivity_outputs = get_compiled_yes_sensitivities(
+            initial_yes,
+            compiled_coefficients,
+            slider_sensitivity_map,
+            time_range,
+            parameters,
+            threshold_events=threshold_crossings,
+        )
+        yes_values, yes_sensitivities = sensitivity_outputs[:2]
+        if threshold_crossings:
+            event_times = sensitivity_outputs[2]
+    else:
+        solver_options = get_solver_options(parameters, compiled_coefficients)
+        if threshold_crossings:
+            solver_options['events'] = get_threshold_events(
+                len(initial_yes), parameters
+            )
+        yes_solutions = spi.solve_ivp(
+            compiled_pLAtYpus_model,
+            t_span=time_span,
+            y0=initial_yes,
+            args=(compiled_coefficients,),
+            # We need to pass the arguments as a tuple, with an empty
+            # second part to pass a dictionary as argument
+            dense_output=True,
+            **solver_options,
+        )
+        yes_values = yes_solutions.sol(time_range).T
+        event_times = yes_solutions.t_events
+
     yes_evolution = pd.DataFrame(
-        yes_solutions.sol(time_range).T, index=time_range, columns=stakeholders
+        yes_values, index=time_range, columns=stakeholders
     )
 
     yes_evolution.index.name = time_header
     if save_dataframe:
-        cook.save_dataframe(
-            yes_evolution,
-            yes_evolution_table_name,
+        stored_table_name, stored_yes_evolution = get_stored_yes_evolution(
+            yes_evolution, product, country, parameters
+        )
+        model_store_module.get_model_store(
+            parameters, model_store
+        ).save_dataframe(
+            stored_yes_evolution,
+            stored_table_name,
             groupfile_name,
             output_folder,
             parameters,
         )
+        save_solve_keys({(product, country): None}, parameters, model_store)
+
+    if forward_sensitivities:
+        percentage_time_span_end_average = pLAtYpus_parameters[
+            'percentage_time_span_end_average'
+        ]
+        run_duration = time_span[1] - time_span[0]
+        end_average_time_start = (
+            1 - percentage_time_span_end_average
+        ) * run_duration
+        long_term_average_gradients = pd.DataFrame(
+            np.average(
+                yes_sensitivities[time_range >= end_average_time_start],
+                axis=0,
+            ).T,
+            index=slider_sensitivity_map['slider_names'],
+            columns=stakeholders,
+        )
+        long_term_average_gradients.index.name = 'Slider'
+
+    if forward_sensitivities and threshold_crossings:
+        return (
+            yes_evolution,
+            long_term_average_gradients,
+            get_threshold_crossings(
+                event_times, initial_yes, [(product, country)], parameters
+            ),
+        )
+    if forward_sensitivities:
+        return yes_evolution, long_term_average_gradients
+    if threshold_crossings:
+        return yes_evolution, get_threshold_crossings(
+            event_times, initial_yes, [(product, country)], parameters
+        )
+
+    return yes_evolution
+
+
+def get_yes_evolution_knots(yes_evolution, parameters):
+    '''
+    Selects the time steps of a yes evolution that we need to rebuild it
+    (with a cubic spline through them) within the interpolant tolerance
+    at all its time steps. We start from a coarse set of time steps and
+    add the midpoints of the intervals where the error is too large
+    until the spline is accurate enough (or until there are no
+    midpoints left to add, i.e. all the time steps are knots).
+    Returns the rows of the yes evolution at these time steps.
+    '''
+    interpolant_tolerance = parameters['pLAtYpus']['interpolant_tolerance']
+    if interpolant_tolerance <= 0:
+        raise ValueError(
+            f'The interpolant tolerance needs to be positive: '
+            f'{interpolant_tolerance}'
+        )
+    times = yes_evolution.index.values
+    yes_values = yes_evolution.values
+
+    knots = np.unique(np.linspace(0, len(times) - 1, 21).astype(int))
+    while True:
+        yes_spline = spin.CubicSpline(times[knots], yes_values[knots], axis=0)
+        spline_errors = np.max(np.abs(yes_spline(times) - yes_values), axis=1)
+        # The spline goes through the knots, so any error there is rounding
+        # (and it would not be in the inside of an interval)
+        spline_errors[knots] = 0
+        inaccurate_intervals = np.unique(
+            np.searchsorted(
+                knots, np.flatnonzero(spline_errors > interpolant_tolerance)
+            )
+        )
+        if len(inaccurate_intervals) == 0:
+            break
+        refined_knots = np.union1d(
+            knots,
+            (knots[inaccurate_intervals - 1] + knots[inaccurate_intervals])
+            // 2,
+        )
+        if len(refined_knots) == len(knots):
+            break
+        knots = refined_knots
+
+    return yes_evolution.iloc[knots]
+
+
+def get_stored_yes_evolution(yes_evolution, product, country, parameters):
+    '''
+    Gets the table name and DataFrame that we store for a yes evolution.
+    This is the full evolution, unless the trajectory storage
+    is set to interpolant, in which case we only store the knots
+    of the evolution (see get_yes_evolution_knots),
+    in a table with the interpolant suffix.
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    trajectory_storage = pLAtYpus_parameters['trajectory_storage']
+    interpolant_table_suffix = pLAtYpus_parameters['interpolant_table_suffix']
+
+    if trajectory_storage == 'interpolant':
+        return (
+            f'{product}_{country}_{interpolant_table_suffix}',
+            get_yes_evolution_knots(yes_evolution, parameters),
+        )
+
+    return f'{product}_{country}', yes_evolution
+
+
+def read_yes_evolution(
+    product, country, parameters, time_range=None, model_store=None
+):
+    '''
+    Reads the yes evolution of a given product and country from
+    the database. If the trajectory storage is set to interpolant,
+    we rebuild the evolution from its knots at the times of the time range
+    (which is by default the time range of the model, with the time span
+    and time steps of the parameters file).
+    Returns a DataFrame with the times as index (as in get_yes_evolution).
+    '''
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    time_span = pLAtYpus_parameters['time_span']
+    time_steps = pLAtYpus_parameters['time_steps']
+    time_header = pLAtYpus_parameters['time_header']
+    stakeholders = pLAtYpus_parameters['stakeholders']
+    trajectory_storage = pLAtYpus_parameters['trajectory_storage']
+    interpolant_table_suffix = pLAtYpus_parameters['interpolant_table_suffix']
+
+    if trajectory_storage == 'interpolant':
+        source_table = f'{product}_{country}_{interpolant_table_suffix}'
+    else:
+        source_table = f'{product}_{country}'
+    stored_yes_evolution = model_store.read_table(source_table).set_index(
+        time_header
+    )
+
+    if trajectory_storage != 'interpolant':
+        return stored_yes_evolution
+
+    if time_range is None:
+        time_range = np.linspace(time_span[0], time_span[1], time_steps)
+    yes_spline = spin.CubicSpline(
+        stored_yes_evolution.index.values,
+        stored_yes_evolution[stakeholders].values,
+        axis=0,
+    )
+    yes_evolution = pd.DataFrame(
+        yes_spline(time_range), index=time_range, columns=stakeholders
+    )
+    yes_evolution.index.name = time_header
 
     return yes_evolution
 
@@ -172,22 +1229,14 @@ def plot_evolution(product, country, yes_evolution, parameters):
     plt.close()
 
 
-def get_survey_scores(parameters):
+def get_survey_scores(parameters, model_store=None):
     file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
-    model_database = f'{output_folder}/{groupfile_name}.sqlite3'
     survey_topics_table_name = file_parameters['survey_topics_table_name']
-    survey_topics_query = cook.read_query_generator(
-        '*', survey_topics_table_name, '', '', ''
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    survey_scores_all = model_store.read_table(survey_topics_table_name)
+    survey_scores_all = survey_scores_all.set_index(
+        ['Country', 'Product', 'Stakeholder', 'Component']
     )
-    with sqlite3.connect(model_database) as database_connection:
-        survey_scores_all = pd.read_sql(
-            survey_topics_query, database_connection
-        )
-        survey_scores_all = survey_scores_all.set_index(
-            ['Country', 'Product', 'Stakeholder', 'Component']
-        )
     return survey_scores_all
 
 
@@ -387,10 +1436,16 @@ def intention_weights_plots(parameters):
     plt.savefig(f'{output_folder}/Intention Weights.svg', bbox_inches='tight')
 
 
-def get_evolutions_and_plots(product, country, parameters):
-    file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
+def get_model_coefficients(
+    product, country, parameters, survey_scores_all=None, model_store=None
+):
+    '''
+    Gets the model coefficients for a given product and country.
+    The survey scores of all countries and products can be given as an
+    argument, so that we do not need to read them for each
+    (product, country) system when we iterate over them.
+    '''
+    model_store = model_store_module.get_model_store(parameters, model_store)
     pLAtYpus_parameters = parameters['pLAtYpus']
     phases = pLAtYpus_parameters['phases']
 
@@ -401,15 +1456,10 @@ def get_evolutions_and_plots(product, country, parameters):
         for stakeholder in stakeholders
     }
 
-    model_database = f'{output_folder}/{groupfile_name}.sqlite3'
-
-    with sqlite3.connect(model_database) as database_connection:
-        weight_query = cook.read_query_generator(
-            '*', f'"Intention Weights {product}"', [], [], []
-        )
-        category_weights = pd.read_sql(weight_query, database_connection)
+    category_weights = model_store.read_table(f'Intention Weights {product}')
 
-    survey_scores_all = get_survey_scores(parameters)
+    if survey_scores_all is None:
+        survey_scores_all = get_survey_scores(parameters, model_store)
     attention_inputs = parameters['attention']
 
     survey_scores = survey_scores_all.loc[(country, product)]
@@ -454,39 +1504,483 @@ def get_evolutions_and_plots(product, country, parameters):
     model_coefficients['survey_scores_actions'] = survey_scores_actions
     model_coefficients['stakeholders'] = stakeholders
     model_coefficients['attention_inputs'] = attention_inputs
-    initial_yes_table_name = f'"Initial Yes {product}"'
-    initial_yes_query = cook.read_query_generator(
-        '*', initial_yes_table_name, ['Country'], ['='], [f'"{country}"']
-    )
-    source_database = f'{output_folder}/{groupfile_name}.sqlite3'
-    with sqlite3.connect(source_database) as database_connection:
-        initial_yes = (pd.read_sql(initial_yes_query, database_connection))[
-            stakeholders
-        ].values[0]
 
-    yes_evolution = get_yes_evolution(
-        initial_yes, model_coefficients, parameters
+    return model_coefficients
+
+
+def get_initial_yes(product, country, parameters, model_store=None):
+    '''
+    Reads the initial yes values of a given product and country
+    from the database.
+    '''
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    initial_yes = model_store.read_table(
+        f'Initial Yes {product}',
+        filter_quantities=['Country'],
+        filter_types=['='],
+        filter_values=[country],
+    )[stakeholders].values[0]
+
+    return initial_yes
+
+
+def get_evolutions_and_plots(
+    product, country, parameters, threshold_crossings=False, model_store=None
+):
+    model_coefficients = get_model_coefficients(
+        product, country, parameters, model_store=model_store
     )
+    initial_yes = get_initial_yes(product, country, parameters, model_store)
+
+    if threshold_crossings:
+        yes_evolution, system_threshold_crossings = get_yes_evolution(
+            initial_yes,
+            model_coefficients,
+            parameters,
+            threshold_crossings=True,
+            model_store=model_store,
+        )
+    else:
+        yes_evolution = get_yes_evolution(
+            initial_yes,
+            model_coefficients,
+            parameters,
+            model_store=model_store,
+        )
     plot_evolution(product, country, yes_evolution, parameters)
 
+    if threshold_crossings:
+        return system_threshold_crossings
+
+
+def get_compiled_yes_values(
+    initial_yes,
+    compiled_coefficients,
+    time_range,
+    parameters,
+    threshold_events=False,
+):
+    '''
+    Integrates the (stacked) systems of compiled coefficients over
+    a time range and returns their yes values at the times of that range,
+    in an array with (time, system, stakeholder) dimensions.
+    If we look for threshold events (see get_threshold_events), we also
+    return the times at which the yes values cross the threshold levels.
+    '''
+    solver_options = get_solver_options(parameters, compiled_coefficients)
+    if threshold_events:
+        solver_options['events'] = get_threshold_events(
+            len(initial_yes), parameters
+        )
+    yes_solutions = spi.solve_ivp(
+        compiled_pLAtYpus_model,
+        t_span=[time_range[0], time_range[-1]],
+        y0=initial_yes,
+        args=(compiled_coefficients,),
+        dense_output=True,
+        **solver_options,
+    )
+
+    yes_values = np.reshape(
+        yes_solutions.sol(time_range).T,
+        (
+            len(time_range),
+            compiled_coefficients['system_amount'],
+            compiled_coefficients['stakeholder_amount'],
+        ),
+    )
+
+    if threshold_events:
+        return yes_values, yes_solutions.t_events
 
-def get_all_evolutions(parameters):
+    return yes_values
+
+
+def get_batch_yes_evolutions(
+    systems_initial_yes,
+    systems_model_coefficients,
+    parameters,
+    threshold_crossings=False,
+):
+    '''
+    This function computes the yes evolutions of several (product, country)
+    systems at once. It stacks all the systems into one state, so that
+    we only need one integration (instead of one per system).
+    The arguments are dictionaries with (product, country) keys,
+    and the function returns a dictionary of yes evolution DataFrames with
+    the same keys (these DataFrames are the same as the ones
+    from get_yes_evolution).
+    Since the solver uses one error norm for the whole state, the
+    tolerances are divided by the square root of the number of systems
+    (see get_solver_options), so that each system meets the same
+    tolerances as when it is solved on its own.
+    With threshold crossings, we also return the threshold crossings
+    of all the systems (see get_threshold_crossings).
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    time_span = pLAtYpus_parameters['time_span']
+    time_steps = pLAtYpus_parameters['time_steps']
+    time_header = pLAtYpus_parameters['time_header']
+    stakeholders = pLAtYpus_parameters['stakeholders']
+
+    systems = list(systems_model_coefficients.keys())
+    compiled_coefficients = scores.stack_compiled_coefficients(
+        [
+            scores.compile_model_coefficients(
+                systems_model_coefficients[system]
+            )
+            for system in systems
+        ]
+    )
+    initial_yes = np.concatenate(
+        [systems_initial_yes[system] for system in systems]
+    )
+
+    time_range = np.linspace(time_span[0], time_span[1], time_steps)
+    if threshold_crossings:
+        yes_values, event_times = get_compiled_yes_values(
+            initial_yes,
+            compiled_coefficients,
+            time_range,
+            parameters,
+            threshold_events=True,
+        )
+    else:
+        yes_values = get_compiled_yes_values(
+            initial_yes, compiled_coefficients, time_range, parameters
+        )
+
+    yes_evolutions = {}
+    for system_index, system in enumerate(systems):
+        yes_evolution = pd.DataFrame(
+            yes_values[:, system_index],
+            index=time_range,
+            columns=stakeholders,
+        )
+        yes_evolution.index.name = time_header
+        yes_evolutions[system] = yes_evolution
+
+    if threshold_crossings:
+        return yes_evolutions, get_threshold_crossings(
+            event_times, initial_yes, systems, parameters
+        )
+
+    return yes_evolutions
+
+
+def save_yes_evolutions(yes_evolutions, parameters, model_store=None):
+    '''
+    Saves several yes evolutions (a dictionary of DataFrames with
+    (product, country) keys) at once.
+    The SQL tables are all written with the connection of the model store.
+    '''
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    model_store = model_store_module.get_model_store(parameters, model_store)
+
+    stored_yes_evolutions = [
+        get_stored_yes_evolution(yes_evolution, product, country, parameters)
+        for (product, country), yes_evolution in yes_evolutions.items()
+    ]
+
+    for stored_table_name, stored_yes_evolution in stored_yes_evolutions:
+        model_store.save_dataframe(
+            stored_yes_evolution,
+            stored_table_name,
+            groupfile_name,
+            output_folder,
+            parameters,
+        )
+    save_solve_keys(
+        {system: None for system in yes_evolutions}, parameters, model_store
+    )
+
+
+def save_solve_keys(solve_keys, parameters, model_store=None):
+    '''
+    Saves the solve keys (see GRETA_tool.get_solve_key) of the
+    yes evolutions that are in the database (and in the figures),
+    given as a dictionary with (product, country) keys.
+    A key of None means that the stored evolution has no known key,
+    which is the case when it is saved by other functions than
+    the GRETA tool (as we do in get_yes_evolution and
+    save_yes_evolutions), so that the tool writes it again.
+    '''
+    solve_keys_table_name = parameters['pLAtYpus']['solve_keys_table_name']
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    model_store.execute(
+        f'CREATE TABLE IF NOT EXISTS "{solve_keys_table_name}" '
+        '(Product TEXT, Country TEXT, Key TEXT, '
+        'PRIMARY KEY (Product, Country))'
+    )
+    model_store.executemany(
+        f'INSERT OR REPLACE INTO "{solve_keys_table_name}" VALUES (?, ?, ?)',
+        [
+            (product, country, solve_key)
+            for (product, country), solve_key in solve_keys.items()
+        ],
+    )
+
+
+def read_solve_key(product, country, parameters, model_store=None):
+    '''
+    Reads the solve key of the yes evolution of a given product and country
+    that is in the database (see save_solve_keys), or None if it has none.
+    '''
+    solve_keys_table_name = parameters['pLAtYpus']['solve_keys_table_name']
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    if not model_store.has_table(solve_keys_table_name):
+        return None
+    solve_key = model_store.read_table(
+        solve_keys_table_name,
+        quantities_to_display=['Key'],
+        filter_quantities=['Product', 'Country'],
+        filter_types=['=', '='],
+        filter_values=[product, country],
+    )
+    if len(solve_key) == 0:
+        return None
+
+    return solve_key['Key'].values[0]
+
+
+def get_job_amount(parameters, jobs=None):
+    '''
+    Gets the number of processes that we use to compute and plot the
+    evolutions. It is given as an argument or (if that is None)
+    by the jobs value in the parameters file. A value of zero
+    means that we use all the available cores.
+    '''
+    if jobs is None:
+        jobs = parameters['pLAtYpus']['jobs']
+    if jobs == 0:
+        jobs = os.cpu_count()
+
+    return jobs
+
+
+def get_all_systems_inputs(parameters, model_store=None):
+    '''
+    Gets the initial yes values and the model coefficients of all
+    (product, country) systems, in dictionaries with (product, country)
+    keys.
+    '''
+    countries = parameters['survey']['countries']
+    products = list(parameters['products'].keys())
+    survey_scores_all = get_survey_scores(parameters, model_store)
+
+    systems_model_coefficients = {}
+    systems_initial_yes = {}
+    for product in products:
+        for country in countries:
+            systems_model_coefficients[
+                (product, country)
+            ] = get_model_coefficients(
+                product, country, parameters, survey_scores_all, model_store
+            )
+            systems_initial_yes[(product, country)] = get_initial_yes(
+                product, country, parameters, model_store
+            )
+
+    return systems_initial_yes, systems_model_coefficients
+
+
+def get_system_yes_evolution(
+    system,
+    initial_yes,
+    model_coefficients,
+    parameters,
+    threshold_crossings=False,
+):
+    '''
+    Computes the yes evolution of one (product, country) system, without
+    saving it (this gives the same evolution as get_yes_evolution), and
+    its threshold crossings if we ask for them.
+    This is a function of the module so that processes can run it.
+    '''
+    # Each system can have its own solver configuration
+    parameters = get_system_solver_parameters(*system, parameters)
+
+    if threshold_crossings:
+        yes_evolutions, system_threshold_crossings = get_batch_yes_evolutions(
+            {system: initial_yes},
+            {system: model_coefficients},
+            parameters,
+            threshold_crossings=True,
+        )
+        return yes_evolutions[system], system_threshold_crossings
+
+    yes_evolutions = get_batch_yes_evolutions(
+        {system: initial_yes}, {system: model_coefficients}, parameters
+    )
+
+    return yes_evolutions[system]
+
+
+def plot_all_evolutions(yes_evolutions, parameters, jobs=1):
+    '''
+    Makes the plots of several yes evolutions (a dictionary of DataFrames
+    with (product, country) keys), spread over several processes
+    if jobs is larger than one.
+    '''
+    systems = list(yes_evolutions.keys())
+    products = [product for (product, country) in systems]
+    countries = [country for (product, country) in systems]
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs
+        ) as executor:
+            list(
+                executor.map(
+                    plot_evolution,
+                    products,
+                    countries,
+                    yes_evolutions.values(),
+                    itertools.repeat(parameters),
+                )
+            )
+    else:
+        for product, country, yes_evolution in zip(
+            products, countries, yes_evolutions.values()
+        ):
+            plot_evolution(product, country, yes_evolution, parameters)
+
+
+def get_all_batch_evolutions(parameters, jobs=1, model_store=None):
+    '''
+    Computes the evolutions of all (product, country) systems in one
+    integration, saves them (with their threshold crossings if we
+    detect them), and makes their plots.
+    '''
+    detect_threshold_crossings = parameters['pLAtYpus'][
+        'detect_threshold_crossings'
+    ]
+    systems_initial_yes, systems_model_coefficients = get_all_systems_inputs(
+        parameters, model_store
+    )
+
+    if detect_threshold_crossings:
+        yes_evolutions, threshold_crossings = get_batch_yes_evolutions(
+            systems_initial_yes,
+            systems_model_coefficients,
+            parameters,
+            threshold_crossings=True,
+        )
+        save_threshold_crossings(
+            [threshold_crossings], parameters, model_store
+        )
+    else:
+        yes_evolutions = get_batch_yes_evolutions(
+            systems_initial_yes, systems_model_coefficients, parameters
+        )
+    save_yes_evolutions(yes_evolutions, parameters, model_store)
+    plot_all_evolutions(yes_evolutions, parameters, jobs)
+
+
+def get_all_parallel_evolutions(parameters, jobs, model_store=None):
+    '''
+    Computes the evolutions of all (product, country) systems (one
+    integration per system) in a pool of processes, saves them, and makes
+    their plots (also in a pool of processes).
+    The processes only compute and return the evolutions, which we then
+    save all at once from this process, so that only one process
+    writes to the database.
+    The results come back in the order of the systems, so the
+    outputs are the same as with one process.
+    '''
+    detect_threshold_crossings = parameters['pLAtYpus'][
+        'detect_threshold_crossings'
+    ]
+    systems_initial_yes, systems_model_coefficients = get_all_systems_inputs(
+        parameters, model_store
+    )
+    systems = list(systems_model_coefficients.keys())
+
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs) as executor:
+        systems_yes_evolutions = list(
+            executor.map(
+                get_system_yes_evolution,
+                systems,
+                [systems_initial_yes[system] for system in systems],
+                [systems_model_coefficients[system] for system in systems],
+                itertools.repeat(parameters),
+                itertools.repeat(detect_threshold_crossings),
+            )
+        )
+    if detect_threshold_crossings:
+        systems_yes_evolutions, threshold_crossings = zip(
+            *systems_yes_evolutions
+        )
+        save_threshold_crossings(threshold_crossings, parameters, model_store)
+    yes_evolutions = dict(zip(systems, systems_yes_evolutions))
+
+    save_yes_evolutions(yes_evolutions, parameters, model_store)
+    plot_all_evolutions(yes_evolutions, parameters, jobs)
+
+
+def get_all_evolutions(parameters, jobs=None, model_store=None):
     countries = parameters['survey']['countries']
     products = list(parameters['products'].keys())
+    batch_solve = parameters['pLAtYpus']['batch_solve']
+    detect_threshold_crossings = parameters['pLAtYpus'][
+        'detect_threshold_crossings'
+    ]
+    jobs = get_job_amount(parameters, jobs)
 
+    if batch_solve:
+        get_all_batch_evolutions(parameters, jobs, model_store)
+        return
+
+    if jobs > 1:
+        get_all_parallel_evolutions(parameters, jobs, model_store)
+        return
+
+    threshold_crossings = []
     for product in products:
         print(product)
         for country in countries:
             print(country)
-            get_evolutions_and_plots(product, country, parameters)
+            threshold_crossings.append(
+                get_evolutions_and_plots(
+                    product,
+                    country,
+                    parameters,
+                    threshold_crossings=detect_threshold_crossings,
+                    model_store=model_store,
+                )
+            )
+    if detect_threshold_crossings:
+        save_threshold_crossings(threshold_crossings, parameters, model_store)
 
 
-def get_all_evolutions_and_plots(parameters):
-    get_all_evolutions(parameters)
+def get_all_evolutions_and_plots(parameters, jobs=None):
+    jobs = get_job_amount(parameters, jobs)
+    get_all_evolutions(parameters, jobs)
     do_plot_survey_scores = parameters['plots']['do_plot_survey_scores']
     do_plot_intention_weights = parameters['plots'][
         'do_plot_intention_weights'
     ]
+    if jobs > 1:
+        # These plots are independent, so we can make them
+        # at the same time
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs
+        ) as executor:
+            plot_futures = []
+            if do_plot_survey_scores:
+                plot_futures.append(
+                    executor.submit(plot_survey_scores, parameters)
+                )
+            if do_plot_intention_weights:
+                plot_futures.append(
+                    executor.submit(intention_weights_plots, parameters)
+                )
+            for plot_future in plot_futures:
+                plot_future.result()
+        return
+
     if do_plot_survey_scores:
         plot_survey_scores(parameters)
     if do_plot_intention_weights:
@@ -2,219 +2,451 @@ import pandas as pd
 import numpy as np
 import sqlite3
 from ETS_CookBook import ETS_CookBook as cook
-import math
 import shutil
 
+try:
+    from pLAtYpus_TNO import process_survey_data
+except ModuleNotFoundError:
+    import process_survey_data
 
-def get_component_values(stakeholder, component, product, country, parameters):
+try:
+    from pLAtYpus_TNO import model_store as model_store_module
+except ModuleNotFoundError:
+    import model_store as model_store_module
+
+try:
+    from pLAtYpus_TNO import GRETA_tool
+except ModuleNotFoundError:
+    import GRETA_tool
+
+
+def get_survey_counts(parameters):
     '''
-    Gets the values for a given componentfor a given product and country from
-    a survey by collecting
-    answers to the questions that are relevant to this component (and
-    taking the answers that would either push the stakeholder
-    to adopt or leave).
+    Reads all the question tables of the survey database at once into
+    an array of answer counts with (question, row, country) dimensions
+    (with the countries of the parameters file, and padded with zeros,
+    as the tables have different numbers of rows), so that we can compute
+    the component values without querying the database again.
+    Returns a dictionary with this array, the index of each survey code
+    (i.e. question table) in it, and the number of rows of each table.
+    The topics tables of the stakeholders and the ingestion keys table
+    (see process_survey_data.ingest_survey_data) have no country columns
+    and are not question tables, so we skip them.
+    With the long survey storage (see
+    process_survey_data.write_long_survey_data), we read all the answers
+    in one query instead.
     '''
-
     survey_parameters = parameters['survey']
-
+    countries = survey_parameters['countries']
+    survey_storage = survey_parameters['data']['output']['survey_storage']
+    if survey_storage == 'long':
+        return get_long_survey_counts(parameters)
     survey_data_folder = survey_parameters['data']['output']['output_folder']
     survey_data_file_name = survey_parameters['data']['output'][
         'database_file_name'
     ]
     survey_data_file = f'{survey_data_folder}/{survey_data_file_name}'
 
-    survey_component_parameters = survey_parameters['products'][stakeholder][
-        product
-    ][component]
-    top_answer_levels_list = survey_component_parameters['top_answer_levels']
-    bottom_answer_levels_list = survey_component_parameters[
-        'bottom_answer_levels'
-    ]
-    answer_lengths_list = survey_component_parameters['answer_lengths']
-    adopt_are_top_list = survey_component_parameters['adopt_are_top']
+    country_columns = ', '.join(f'"{country}"' for country in countries)
+    with sqlite3.connect(survey_data_file) as database_connection:
+        survey_codes = [
+            table_name
+            for (table_name,) in database_connection.execute(
+                "SELECT name FROM sqlite_master WHERE type='table'"
+            )
+            if not table_name.endswith('_Topics')
+            and table_name != 'ingestion_keys'
+        ]
+        question_tables = [
+            np.array(
+                database_connection.execute(
+                    f'SELECT {country_columns} FROM "{survey_code}"'
+                ).fetchall(),
+                dtype=float,
+            )
+            for survey_code in survey_codes
+        ]
+
+    row_amounts = np.array(
+        [len(question_table) for question_table in question_tables]
+    )
+    answer_counts = np.zeros(
+        (len(survey_codes), np.max(row_amounts), len(countries))
+    )
+    for question_index, question_table in enumerate(question_tables):
+        answer_counts[question_index, 0 : len(question_table)] = question_table
+
+    survey_counts = {}
+    survey_counts['answer_counts'] = answer_counts
+    survey_counts['survey_code_indices'] = {
+        survey_code: question_index
+        for question_index, survey_code in enumerate(survey_codes)
+    }
+    survey_counts['row_amounts'] = row_amounts
+
+    return survey_counts
+
+
+def get_long_survey_counts(parameters):
+    '''
+    Reads the answer counts of the long-format survey table into the
+    same dictionary as get_survey_counts.
+    '''
+    countries = parameters['survey']['countries']
+
+    survey_answers = process_survey_data.read_survey_answers(
+        parameters, countries=countries
+    )
+    survey_code_values, survey_codes = pd.factorize(
+        survey_answers['Stakeholder'] + '_' + survey_answers['Topic']
+    )
+    country_indices = survey_answers['Country'].map(
+        {
+            country: country_index
+            for country_index, country in enumerate(countries)
+        }
+    )
+    answer_indices = survey_answers['Answer_index'].values
+
+    row_amounts = np.zeros(len(survey_codes), dtype=int)
+    np.maximum.at(row_amounts, survey_code_values, answer_indices + 1)
+    answer_counts = np.zeros(
+        (len(survey_codes), np.max(row_amounts), len(countries))
+    )
+    answer_counts[
+        survey_code_values, answer_indices, country_indices.values
+    ] = survey_answers['Count'].values
+
+    survey_counts = {}
+    survey_counts['answer_counts'] = answer_counts
+    survey_counts['survey_code_indices'] = {
+        survey_code: question_index
+        for question_index, survey_code in enumerate(survey_codes)
+    }
+    survey_counts['row_amounts'] = row_amounts
+
+    return survey_counts
+
+
+def get_component_answer_count_arrays(
+    stakeholder, component, product, survey_counts, parameters
+):
+    '''
+    Gets the answer counts of the questions that are relevant to a given
+    component for a given product and all the countries, from the
+    answer counts of the survey (see get_survey_counts).
+    The questions, answer levels, and totals are given by the
+    prefixes, midfixes, and suffixes of the component and its
+    answer lengths, top and bottom answer levels, and total
+    shifts from bottom (in the parameters file).
+    Returns a dictionary with arrays (with one row per question):
+    the answer counts per answer level and country (padded with zeros,
+    as questions can have different numbers of answer levels),
+    which answer levels exist, the total answers per country,
+    and which answer levels push the stakeholder to adopt or to leave.
+    '''
+    survey_component_parameters = parameters['survey']['products'][
+        stakeholder
+    ][product][component]
     prefixes = survey_component_parameters['prefixes']
     midfixes = survey_component_parameters['midfixes']
     suffixes = survey_component_parameters['suffixes']
-    total_shifts_from_bottom_list = survey_component_parameters[
-        'total_shifts_from_bottom'
+
+    # We flatten the question parameters (which are lists of lists,
+    # with one list of suffixes per prefix and midfix)
+    question_parameters = {
+        question_parameter: np.concatenate(
+            survey_component_parameters[question_parameter]
+        ).astype(int)
+        for question_parameter in [
+            'top_answer_levels',
+            'bottom_answer_levels',
+            'answer_lengths',
+            'adopt_are_top',
+            'total_shifts_from_bottom',
+        ]
+    }
+    survey_code_indices = survey_counts['survey_code_indices']
+    question_indices = np.array(
+        [
+            survey_code_indices[f'{stakeholder}_{prefix}{midfix}{suffix}']
+            for prefix, midfix, suffix_list in zip(
+                prefixes, midfixes, suffixes
+            )
+            for suffix in suffix_list
+        ]
+    )
+    answer_lengths = question_parameters['answer_lengths']
+    level_amount = np.max(answer_lengths)
+    levels = np.arange(level_amount)
+
+    answer_levels = levels < answer_lengths[:, np.newaxis]
+    answer_counts = (
+        survey_counts['answer_counts'][question_indices, 0:level_amount]
+        * answer_levels[..., np.newaxis]
+    )
+    total_rows = (
+        survey_counts['row_amounts'][question_indices]
+        - 1
+        - question_parameters['total_shifts_from_bottom']
+    )
+    totals = survey_counts['answer_counts'][question_indices, total_rows]
+
+    bottom_levels = (
+        levels < question_parameters['bottom_answer_levels'][:, np.newaxis]
+    ) & answer_levels
+    top_levels = (
+        levels
+        >= (answer_lengths - question_parameters['top_answer_levels'])[
+            :, np.newaxis
+        ]
+    ) & answer_levels
+    adopt_are_top = question_parameters['adopt_are_top'][:, np.newaxis].astype(
+        bool
+    )
+
+    component_answer_counts = {}
+    component_answer_counts['answer_counts'] = answer_counts
+    component_answer_counts['answer_levels'] = answer_levels
+    component_answer_counts['totals'] = totals
+    component_answer_counts['adopt_levels'] = np.where(
+        adopt_are_top, top_levels, bottom_levels
+    )
+    component_answer_counts['leave_levels'] = np.where(
+        adopt_are_top, bottom_levels, top_levels
+    )
+
+    return component_answer_counts
+
+
+def get_component_answer_counts(
+    stakeholder, component, product, country, parameters, survey_counts=None
+):
+    '''
+    Gets the answer counts of the questions that are relevant to a given
+    component for a given product and country from the survey
+    (see get_component_answer_count_arrays, which does this for all
+    countries). The answer counts of the survey can be given
+    (see get_survey_counts), so that we do not read them again.
+    Returns a dictionary with arrays (with one row per question):
+    the answer counts per answer level (padded with zeros,
+    as questions can have different numbers of answer levels),
+    which answer levels exist, the total answers, and which answer levels
+    push the stakeholder to adopt or to leave.
+    '''
+    if survey_counts is None:
+        survey_counts = get_survey_counts(parameters)
+    country_index = parameters['survey']['countries'].index(country)
+
+    component_answer_counts = get_component_answer_count_arrays(
+        stakeholder, component, product, survey_counts, parameters
+    )
+    component_answer_counts['answer_counts'] = component_answer_counts[
+        'answer_counts'
+    ][..., country_index]
+    component_answer_counts['totals'] = component_answer_counts['totals'][
+        :, country_index
     ]
 
-    adopt_answers = 0
-    leave_answers = 0
-    total_answers = 0
+    return component_answer_counts
 
-    with sqlite3.connect(survey_data_file) as database_connection:
-        for (
-            prefix,
-            midfix,
-            suffix_list,
-            top_answer_levels,
-            bottom_answer_levels,
-            answer_lengths,
-            adopt_are_top,
-            total_shifts_from_bottom,
-        ) in zip(
-            prefixes,
-            midfixes,
-            suffixes,
-            top_answer_levels_list,
-            bottom_answer_levels_list,
-            answer_lengths_list,
-            adopt_are_top_list,
-            total_shifts_from_bottom_list,
-        ):
-            for (
-                suffix,
-                top_answer_level,
-                bottom_answer_level,
-                answer_length,
-                adopt_is_top,
-                total_shift_from_bottom,
-            ) in zip(
-                suffix_list,
-                top_answer_levels,
-                bottom_answer_levels,
-                answer_lengths,
-                adopt_are_top,
-                total_shifts_from_bottom,
-            ):
-                survey_code = f'{stakeholder}_{prefix}{midfix}{suffix}'
-                sql_query = cook.read_query_generator(
-                    country, survey_code, '', '', ''
-                )
 
-                parameter_data = pd.read_sql(
-                    sql_query, con=database_connection
-                )
-                bottom_answers = sum(
-                    parameter_data.values[0:bottom_answer_level]
-                )[0]
-                top_answers = sum(
-                    parameter_data.values[
-                        answer_length - top_answer_level : answer_length
-                    ]
-                )[0]
-                total_answers += parameter_data.values[
-                    -(1 + total_shift_from_bottom)
-                ][0]
+def get_all_component_values(
+    stakeholder, component, product, survey_counts, parameters
+):
+    '''
+    Gets the values of a given component for a given product and all
+    the countries (in the order of the parameters file) from the answer
+    counts of the survey (see get_survey_counts), by collecting
+    the answers to the questions that are relevant to this component
+    (and taking the answers that would either push the stakeholder
+    to adopt or leave).
+    Returns arrays of the adopt and leave values of the countries.
+    '''
+    component_answer_counts = get_component_answer_count_arrays(
+        stakeholder, component, product, survey_counts, parameters
+    )
+    answer_counts = component_answer_counts['answer_counts']
+
+    adopt_answers = np.sum(
+        answer_counts
+        * component_answer_counts['adopt_levels'][..., np.newaxis],
+        axis=(0, 1),
+    )
+    leave_answers = np.sum(
+        answer_counts
+        * component_answer_counts['leave_levels'][..., np.newaxis],
+        axis=(0, 1),
+    )
+    total_answers = np.sum(component_answer_counts['totals'], axis=0)
 
-                if adopt_is_top:
-                    adopt_answers += top_answers
-                    leave_answers += bottom_answers
-                else:
-                    adopt_answers += bottom_answers
-                    leave_answers += top_answers
+    adopt_values = adopt_answers / total_answers
+    leave_values = leave_answers / total_answers
 
-    adopt_value = adopt_answers / total_answers
-    leave_value = leave_answers / total_answers
+    return adopt_values, leave_values
 
-    return adopt_value, leave_value
 
+def get_component_values(
+    stakeholder, component, product, country, parameters, survey_counts=None
+):
+    '''
+    Gets the values for a given componentfor a given product and country from
+    a survey by collecting
+    answers to the questions that are relevant to this component (and
+    taking the answers that would either push the stakeholder
+    to adopt or leave).
+    The answer counts of the survey can be given (see get_survey_counts),
+    so that we do not read them again.
+    '''
+    if survey_counts is None:
+        survey_counts = get_survey_counts(parameters)
+    country_index = parameters['survey']['countries'].index(country)
+
+    adopt_values, leave_values = get_all_component_values(
+        stakeholder, component, product, survey_counts, parameters
+    )
+
+    return adopt_values[country_index], leave_values[country_index]
 
-def get_survey_product_values(parameters):
+
+def get_survey_product_values(parameters, model_store=None):
     '''
     Gets all product values (listed and defined in the parameters file)
     from the survey.
     '''
+    model_store = model_store_module.get_model_store(parameters, model_store)
 
     stakeholders = parameters['pLAtYpus']['stakeholders']
     countries = parameters['survey']['countries']
     products = list(parameters['products'].keys())
-    survey_index_tuples = [
-        (country, product, stakeholder, component)
-        for country in countries
-        for product in products
-        for stakeholder in stakeholders
-        for component in (
-            parameters['survey']['products'][stakeholder][product]
-        )
-    ]
-    survey_index = pd.MultiIndex.from_tuples(
-        survey_index_tuples,
-        names=['Country', 'Product', 'Stakeholder', 'Component'],
-    )
     survey_scores_actions = parameters['survey']['survey_scores_actions']
-    survey_dataframe = pd.DataFrame(
-        columns=survey_scores_actions, index=survey_index
-    )
-
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    survey_topics_table_name = file_parameters['survey_topics_table_name']
+    use_overlap = parameters['survey']['relation_definitions']['use_overlap']
+    overlap_column_header = parameters['survey']['relation_definitions'][
+        'overlap_columns'
+    ][0]
+
+    # We read the survey answers only once
+    survey_counts = get_survey_counts(parameters)
+
+    # For each stakeholder, we fill an array of the adopt and leave values
+    # with (country, product and component, action) dimensions, where
+    # the components of each product are the survey components, the
+    # relation scores with each partner, and a survey answer of 1
+    # (for social norm, where the score is given by the adoption of
+    # a given partner), which we only need if there are partners.
+    # This array has an object type, as the survey answers of 1 are integers.
+    survey_index_tuples = []
+    stakeholders_survey_values = []
     for stakeholder in stakeholders:
-        file_parameters = parameters['files']
-        output_folder = file_parameters['output_folder']
-        groupfile_name = file_parameters['groupfile_name']
-
-        survey_topics_table_name = file_parameters['survey_topics_table_name']
+        partners = parameters['survey']['relations'][stakeholder]['partners']
+        survey_components = {
+            product: list(
+                parameters['survey']['products'][stakeholder][product]
+            )
+            for product in products
+        }
+        relation_components = [
+            f'relation_score_{partner}' for partner in partners
+        ]
+        if len(partners) > 0:
+            relation_components.append('one')
+        product_components = [
+            (product, component)
+            for product in products
+            for component in (survey_components[product] + relation_components)
+        ]
+        survey_values = np.empty(
+            (len(countries), len(product_components), 2), dtype=object
+        )
+        component_positions = {
+            product_component: component_position
+            for component_position, product_component in enumerate(
+                product_components
+            )
+        }
 
-        components = {}
         for product in products:
-            components[product] = parameters['survey']['products'][
-                stakeholder
-            ][product]
-
-        for country in countries:
-            for product in products:
-                for component in components[product]:
-                    adopt_value, leave_value = get_component_values(
-                        stakeholder, component, product, country, parameters
-                    )
-                    survey_dataframe.loc[
-                        (country, product, stakeholder, component)
-                    ] = [adopt_value, leave_value]
+            for component in survey_components[product]:
+                adopt_values, leave_values = get_all_component_values(
+                    stakeholder, component, product, survey_counts, parameters
+                )
+                component_position = component_positions[(product, component)]
+                survey_values[:, component_position, 0] = adopt_values
+                survey_values[:, component_position, 1] = leave_values
 
-        get_relational_values_from_survey(stakeholder, parameters)
+        # We read the relations of the stakeholder only once
+        relation_shares, relation_names = get_relation_shares(
+            stakeholder, parameters
+        )
+        get_relational_values_from_survey(
+            stakeholder,
+            parameters,
+            relation_shares,
+            relation_names,
+            model_store,
+        )
 
         relations_deviations_dataframe = get_relationship_deviations(
-            stakeholder, parameters
+            stakeholder, parameters, relation_shares, model_store
         )
 
         relations_overlap_dataframe = get_relationship_overlap(
-            stakeholder, parameters
+            stakeholder, parameters, relation_shares, model_store
         )
 
-        use_overlap = parameters['survey']['relation_definitions'][
-            'use_overlap'
-        ]
-        overlap_column_header = parameters['survey']['relation_definitions'][
-            'overlap_columns'
-        ][0]
-        partners = parameters['survey']['relations'][stakeholder]['partners']
-        for country in countries:
-            for partner in partners:
-                for product in products:
-                    component = f'relation_score_{partner}'
-                    if use_overlap:
-                        adopt_value = relations_overlap_dataframe.loc[
-                            (country, product, partner)
-                        ][overlap_column_header]
-                    else:
-                        adopt_value = relations_deviations_dataframe.loc[
-                            (country, product, partner)
-                        ]['Relation score']
-                    leave_value = 1 - adopt_value
-                    survey_dataframe.at[
-                        (country, product, stakeholder, component), 'Adopt'
-                    ] = adopt_value
-                    survey_dataframe.at[
-                        (country, product, stakeholder, component), 'Leave'
-                    ] = leave_value
-
-                    # We also need a survey answer of 1 (for social norm, where
-                    # the score is given by the adoption of a given partner)
-                    survey_dataframe.at[
-                        (country, product, stakeholder, 'one'), 'Adopt'
-                    ] = 1
-                    survey_dataframe.at[
-                        (country, product, stakeholder, 'one'), 'Leave'
-                    ] = 1
+        if use_overlap:
+            relation_scores = relations_overlap_dataframe[
+                overlap_column_header
+            ]
+        else:
+            relation_scores = relations_deviations_dataframe['Relation score']
+        # We go to (country, product, partner) arrays
+        relation_scores = relation_scores.reindex(
+            pd.MultiIndex.from_product([countries, products, partners])
+        ).values.reshape(len(countries), len(products), len(partners))
+        for product_index, product in enumerate(products):
+            relation_positions = [
+                component_positions[(product, component)]
+                for component in relation_components
+            ]
+            if len(partners) > 0:
+                survey_values[
+                    :, relation_positions[0:-1], 0
+                ] = relation_scores[:, product_index]
+                survey_values[:, relation_positions[0:-1], 1] = (
+                    1 - relation_scores[:, product_index]
+                )
+                survey_values[:, relation_positions[-1]] = 1
+
+        survey_index_tuples.extend(
+            (country, product, stakeholder, component)
+            for country in countries
+            for product, component in product_components
+        )
+        stakeholders_survey_values.append(survey_values.reshape(-1, 2))
+
+    survey_index = pd.MultiIndex.from_tuples(
+        survey_index_tuples,
+        names=['Country', 'Product', 'Stakeholder', 'Component'],
+    )
+    survey_dataframe = pd.DataFrame(
+        np.concatenate(stakeholders_survey_values),
+        columns=survey_scores_actions,
+        index=survey_index,
+    )
     survey_dataframe = survey_dataframe.sort_index()
-    cook.save_dataframe(
+    model_store.save_dataframe(
         survey_dataframe,
         survey_topics_table_name,
         groupfile_name,
         output_folder,
         parameters,
     )
-    get_intention_weights(parameters)
+    get_intention_weights(parameters, model_store)
     pLAtYpus_parameters = parameters['pLAtYpus']
     common_initial_yes = pLAtYpus_parameters['initial_yes']
 
@@ -224,7 +456,7 @@ def get_survey_product_values(parameters):
         for country in countries:
             initial_yes.loc[country] = common_initial_yes
 
-        cook.save_dataframe(
+        model_store.save_dataframe(
             initial_yes,
             f'Initial Yes {product}',
             groupfile_name,
@@ -233,10 +465,10 @@ def get_survey_product_values(parameters):
         )
     # Now that we iterated over the stakeholders, we can get the
     # bidirectional and product relationship scores
-    get_bidirectional_relationship_deviations(parameters)
-    get_product_relation_deviations(parameters)
-    get_bidirectional_relationship_overlap(parameters)
-    get_product_relation_overlap(parameters)
+    get_bidirectional_relationship_deviations(parameters, model_store)
+    get_product_relation_deviations(parameters, model_store)
+    get_bidirectional_relationship_overlap(parameters, model_store)
+    get_product_relation_overlap(parameters, model_store)
     # Finally, we make a copy of the database for resets in the GREAT tool
     # This is a version with only the survey data
     groupfile_name_only_survey = file_parameters['groupfile_name_only_survey']
@@ -244,57 +476,132 @@ def get_survey_product_values(parameters):
     database_file_for_resets = (
         f'{output_folder}/{groupfile_name_only_survey}.sqlite3'
     )
+    # The write-ahead log needs to be in the database file before we copy it
+    model_store.checkpoint()
     shutil.copy(database_file, database_file_for_resets)
+    # The baseline of the GRETA tool resets (see GRETA_tool.save_baseline)
+    # no longer comes from this survey data, so we remove it
+    GRETA_tool.remove_baseline(parameters)
 
 
-def component_adopt_leave(component, product, country, parameters):
+def component_adopt_leave(
+    component, product, country, parameters, model_store=None
+):
     '''
     Reads the component adopt and leave values for a given product and country.
     '''
 
     file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
     survey_topics_table_name = file_parameters['survey_topics_table_name']
-    source_database = f'{output_folder}/{groupfile_name}.sqlite3'
-    with sqlite3.connect(source_database) as database_connection:
-        sql_query = cook.read_query_generator(
-            '*',
-            survey_topics_table_name,
-            ['Product', 'Country', 'Component'],
-            ['=', '='],
-            [f'"{product}"', f'"{country}"', f'"{component}"'],
-        )
-
-        adopt_leave_values = pd.read_sql(sql_query, con=database_connection)
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    adopt_leave_values = model_store.read_table(
+        survey_topics_table_name,
+        filter_quantities=['Product', 'Country', 'Component'],
+        filter_types=['=', '=', '='],
+        filter_values=[product, country, component],
+    )
     adopt = adopt_leave_values['Adopt'][0]
     leave = adopt_leave_values['Leave'][0]
 
     return adopt, leave
 
 
-def get_relational_values_from_survey(stakeholder, parameters):
+def get_relation_shares(stakeholder, parameters):
     '''
-    Gets perceived and desired relational models for various products/services
+    Reads the perceived and ideal relations of a stakeholder with its
+    partners (for all products) from the survey database at once, as
+    shares of the total answers of each country.
+    Returns an array with (product, partner, relation type, relation,
+    country) dimensions (padded with NaN values, as the questions can have
+    different numbers of relations), and a dictionary with the relation
+    names of each (product, partner) pair.
     '''
-
-    file_parameters = parameters['files']
-    output_folder = file_parameters['output_folder']
-    groupfile_name = file_parameters['groupfile_name']
     survey_parameters = parameters['survey']
     countries = survey_parameters['countries']
-
     survey_data_folder = survey_parameters['data']['output']['output_folder']
     survey_data_file_name = survey_parameters['data']['output'][
         'database_file_name'
     ]
     survey_data_file = f'{survey_data_folder}/{survey_data_file_name}'
+    products = list(parameters['products'].keys())
+    stakeholder_relations_parameters = survey_parameters['relations'][
+        stakeholder
+    ]
+    partners = stakeholder_relations_parameters['partners']
 
-    product_list = parameters['products']
+    relation_tables = {}
+    with sqlite3.connect(survey_data_file) as database_connection:
+        for product in products:
+            product_parameters = stakeholder_relations_parameters[product]
+            perceived_codes = product_parameters['perceived_codes']
+            ideal_codes = product_parameters['ideal_codes']
+            for partner, perceived_code, ideal_code in zip(
+                partners, perceived_codes, ideal_codes
+            ):
+                relation_tables[(product, partner)] = [
+                    pd.read_sql(
+                        f'SELECT * FROM "{stakeholder}_{survey_code}"',
+                        con=database_connection,
+                    )
+                    for survey_code in [perceived_code, ideal_code]
+                ]
+
+    # The last row of each table is the total
+    relation_amount = max(
+        len(perceived_table) - 1
+        for perceived_table, ideal_table in relation_tables.values()
+    )
+    relation_shares = np.full(
+        (len(products), len(partners), 2, relation_amount, len(countries)),
+        np.nan,
+    )
+    relation_names = {}
+    for (product, partner), relation_type_tables in relation_tables.items():
+        product_index = products.index(product)
+        partner_index = partners.index(partner)
+        # The relation names come from the perceived relations
+        relation_names[(product, partner)] = list(
+            relation_type_tables[0].iloc[:, 0][0:-1]
+        )
+        names_amount = len(relation_names[(product, partner)])
+        for relation_type_index, relation_type_table in enumerate(
+            relation_type_tables
+        ):
+            relation_counts = relation_type_table[countries].values
+            relation_shares[
+                product_index,
+                partner_index,
+                relation_type_index,
+                0:names_amount,
+            ] = (
+                relation_counts[0:names_amount] / relation_counts[-1]
+            )
+
+    return relation_shares, relation_names
+
+
+def get_relational_values_from_survey(
+    stakeholder,
+    parameters,
+    relation_shares=None,
+    relation_names=None,
+    model_store=None,
+):
+    '''
+    Gets perceived and desired relational models for various products/services
+    (from the relation shares, see get_relation_shares, which we read
+    if they are not given).
+    '''
+
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    model_store = model_store_module.get_model_store(parameters, model_store)
+    survey_parameters = parameters['survey']
+    countries = survey_parameters['countries']
+
+    products = list(parameters['products'].keys())
     relation_definition_parameters = survey_parameters['relation_definitions']
-    # relation_names = (
-    #     relation_definition_parameters['relation_names']
-    # )
     relation_types = relation_definition_parameters['relation_types']
     table_name_root = relation_definition_parameters['table_name']
 
@@ -303,6 +610,11 @@ def get_relational_values_from_survey(stakeholder, parameters):
     ]
     partners = stakeholder_relations_parameters['partners']
 
+    if relation_shares is None:
+        relation_shares, relation_names = get_relation_shares(
+            stakeholder, parameters
+        )
+
     relations_dataframe_index_tuples = [
         (country, relation_type)
         for country in countries
@@ -313,78 +625,43 @@ def get_relational_values_from_survey(stakeholder, parameters):
         relations_dataframe_index_tuples, names=['Country', 'Relation_type']
     )
 
-    with sqlite3.connect(survey_data_file) as database_connection:
-        for product in product_list:
-            product_parameters = survey_parameters['relations'][stakeholder][
-                product
-            ]
-            perceived_codes = product_parameters['perceived_codes']
-            ideal_codes = product_parameters['ideal_codes']
-            for partner, perceived_code, ideal_code in zip(
-                partners, perceived_codes, ideal_codes
-            ):
-                perceived_query = cook.read_query_generator(
-                    '*', f'{stakeholder}_{perceived_code}', '', '', ''
-                )
-                ideal_query = cook.read_query_generator(
-                    '*', f'{stakeholder}_{ideal_code}', '', '', ''
-                )
-                perceived_data_all = pd.read_sql(
-                    perceived_query, con=database_connection
-                )
-                ideal_data_all = pd.read_sql(
-                    ideal_query, con=database_connection
-                )
-                relation_names = list(perceived_data_all.iloc[:, 0][0:-1])
-                relations_dataframe = pd.DataFrame(
-                    columns=relation_names, index=relations_dataframe_index
-                )
-
-                for country in countries:
-                    ideal_data = ideal_data_all[country].values
-                    perceived_data = perceived_data_all[country].values
-
-                    perceived_percentages = [
-                        perceived_data[relation_index] / perceived_data[-1]
-                        for relation_index, relation in enumerate(
-                            relation_names
-                        )
-                    ]
-                    ideal_percentages = [
-                        ideal_data[relation_index] / ideal_data[-1]
-                        for relation_index, relation in enumerate(
-                            relation_names
-                        )
-                    ]
-                    percentage_values = [
-                        perceived_percentages,
-                        ideal_percentages,
-                    ]
-
-                    for percentages, relation_type in zip(
-                        percentage_values, relation_types
-                    ):
-                        relations_dataframe.loc[
-                            country, relation_type
-                        ] = percentages
-                table_name = (
-                    f'{stakeholder}_{table_name_root}_with_{partner}'
-                    f'_for_{product}'
-                )
+    for product_index, product in enumerate(products):
+        for partner_index, partner in enumerate(partners):
+            product_partner_relation_names = relation_names[(product, partner)]
+            # We go from (relation type, relation, country) to
+            # (country, relation type) rows and relation columns
+            product_partner_shares = relation_shares[
+                product_index,
+                partner_index,
+                :,
+                0 : len(product_partner_relation_names),
+            ].transpose(2, 0, 1)
+            relations_dataframe = pd.DataFrame(
+                product_partner_shares.reshape(
+                    -1, len(product_partner_relation_names)
+                ),
+                columns=product_partner_relation_names,
+                index=relations_dataframe_index,
+            )
+            table_name = (
+                f'{stakeholder}_{table_name_root}_with_{partner}'
+                f'_for_{product}'
+            )
 
-                cook.save_dataframe(
-                    relations_dataframe,
-                    table_name,
-                    groupfile_name,
-                    output_folder,
-                    parameters,
-                )
+            model_store.save_dataframe(
+                relations_dataframe,
+                table_name,
+                groupfile_name,
+                output_folder,
+                parameters,
+            )
 
 
-def get_intention_weights(parameters):
+def get_intention_weights(parameters, model_store=None):
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
+    model_store = model_store_module.get_model_store(parameters, model_store)
 
     products = list(parameters['products'].keys())
     pLAtYpus_parameters = parameters['pLAtYpus']
@@ -424,7 +701,7 @@ def get_intention_weights(parameters):
             intention_categories[stakeholder].keys()
         )
         intention_weights = intention_weights.set_index('Category')
-        cook.save_dataframe(
+        model_store.save_dataframe(
             intention_weights,
             f'Intention Weights {product}',
             groupfile_name,
@@ -433,25 +710,27 @@ def get_intention_weights(parameters):
         )
 
 
-def get_relationship_overlap(stakeholder, parameters):
+def get_relationship_overlap(
+    stakeholder, parameters, relation_shares=None, model_store=None
+):
     '''
     Gets the overlap between perceived and ideal relationships.
     For each, we look at the ratio between perceived and ideal..
     If ideal is higher than perceived, we invert the ratio
     (to get the overlap, the smaller of the two needs to be the numerator)
+    We do this for all countries, products, and partners at once,
+    from the relation shares (see get_relation_shares, which we read
+    if they are not given).
     '''
 
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    source_database = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     survey_parameters = parameters['survey']
     relation_definition_parameters = survey_parameters['relation_definitions']
     overlap_table_name = relation_definition_parameters['overlap_table']
     overlap_table_name = f'{stakeholder}_{overlap_table_name}'
-    filters_reading_relations_table = relation_definition_parameters[
-        'filters_reading_relations_table'
-    ]
     countries = survey_parameters['countries']
     product_list = parameters['products']
 
@@ -462,6 +741,11 @@ def get_relationship_overlap(stakeholder, parameters):
     ]
     partners = stakeholder_relations_parameters['partners']
 
+    if relation_shares is None:
+        relation_shares, relation_names = get_relation_shares(
+            stakeholder, parameters
+        )
+
     relations_overlap_dataframe_index_tuples = [
         (country, product, partner)
         for country in countries
@@ -474,71 +758,40 @@ def get_relationship_overlap(stakeholder, parameters):
         names=['Country', 'Product', 'Partner'],
     )
 
+    perceived_relations = relation_shares[:, :, 0]
+    ideal_relations = relation_shares[:, :, 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        overlaps = np.where(
+            ideal_relations != 0,
+            perceived_relations / ideal_relations,
+            0,  # To avoid divisions by zero
+        )
+        # If ideal is larger than perceived, we invert the
+        # fraction to get the actual overlap
+        overlaps = np.where(overlaps <= 1, overlaps, 1 / overlaps)
+    # We average over the relations (the padding values are NaN) and go
+    # from (product, partner, country) to (country, product, partner)
+    average_overlaps = np.nanmean(overlaps, axis=2).transpose(2, 0, 1)
+
     relations_overlap_dataframe = pd.DataFrame(
-        columns=overlap_columns, index=relations_overlap_dataframe_index
+        {
+            overlap_column: average_overlaps.reshape(-1)
+            for overlap_column in overlap_columns
+        },
+        index=relations_overlap_dataframe_index,
+    )
+    model_store.save_dataframe(
+        relations_overlap_dataframe,
+        overlap_table_name,
+        groupfile_name,
+        output_folder,
+        parameters,
     )
-
-    relations_table_name_root = relation_definition_parameters['table_name']
-    with sqlite3.connect(source_database) as database_connection:
-        for country in countries:
-            for product in product_list:
-                for partner in partners:
-                    relations_table_name = (
-                        f'{stakeholder}_{relations_table_name_root}'
-                        f'_with_{partner}_for_{product}'
-                    )
-                    relations_table_query = cook.read_query_generator(
-                        '*',
-                        relations_table_name,
-                        filters_reading_relations_table,
-                        ['='],
-                        [f'"{country}"'],
-                    )
-                    relations_values = pd.read_sql(
-                        relations_table_query, con=database_connection
-                    )
-                    relation_names = list(relations_values.columns[2:])
-
-                    perceived_relations = [
-                        relations_values[relation_name][0]
-                        for relation_name in relation_names
-                    ]
-                    ideal_relations = [
-                        relations_values[relation_name][1]
-                        for relation_name in relation_names
-                    ]
-
-                    overlaps = [
-                        perceived_relation / ideal_relation
-                        if ideal_relation != 0
-                        else 0  # To avoid divisions by zero
-                        for perceived_relation, ideal_relation in zip(
-                            perceived_relations, ideal_relations
-                        )
-                    ]
-                    # If ideal is larger than perceived, we invert the
-                    # fraction to get the actual overlap
-                    overlaps = [
-                        overlap if overlap <= 1 else 1 / overlap
-                        for overlap in overlaps
-                    ]
-
-                    average_overlap = np.average(overlaps)
-                    relations_overlap_dataframe.loc[
-                        country, product, partner
-                    ] = average_overlap
-        cook.save_dataframe(
-            relations_overlap_dataframe,
-            overlap_table_name,
-            groupfile_name,
-            output_folder,
-            parameters,
-        )
 
     return relations_overlap_dataframe
 
 
-def get_bidirectional_relationship_overlap(parameters):
+def get_bidirectional_relationship_overlap(parameters, model_store=None):
     '''
     This computes the bidirectional relation overlap, i.e. how
     good (or bad) the relation between two parties is.
@@ -547,7 +800,7 @@ def get_bidirectional_relationship_overlap(parameters):
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    source_database = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     survey_parameters = parameters['survey']
     relation_definition_parameters = survey_parameters['relation_definitions']
     overlap_table_name_root = relation_definition_parameters['overlap_table']
@@ -557,15 +810,11 @@ def get_bidirectional_relationship_overlap(parameters):
     overlap_tables = {}
     countries = survey_parameters['countries']
     product_list = parameters['products']
-    with sqlite3.connect(source_database) as database_connection:
-        for stakeholder in stakeholders:
-            overlap_table_name = f'{stakeholder}_{overlap_table_name_root}'
-            relations_table_query = cook.read_query_generator(
-                '*', overlap_table_name, [], [], []
-            )
-            overlap_tables[stakeholder] = pd.read_sql(
-                relations_table_query, database_connection
-            ).set_index(['Country', 'Product', 'Partner'])
+    for stakeholder in stakeholders:
+        overlap_table_name = f'{stakeholder}_{overlap_table_name_root}'
+        overlap_tables[stakeholder] = model_store.read_table(
+            overlap_table_name
+        ).set_index(['Country', 'Product', 'Partner'])
     stakeholder_pairs = []
     for stakeholder_index, stakeholder in enumerate(stakeholders):
         for partner in stakeholders[stakeholder_index + 1 :]:
@@ -581,27 +830,38 @@ def get_bidirectional_relationship_overlap(parameters):
         bidirectional_relationships_index_tuples,
         names=['Country', 'Product', 'Pair'],
     )
+    country_product_index = pd.MultiIndex.from_product(
+        [countries, product_list], names=['Country', 'Product']
+    )
+    overlap_columns = parameters['survey']['relation_definitions'][
+        'overlap_columns'
+    ]
+    # We get the average overlaps of each pair for all countries
+    # and products at once, in a (country and product, pair, column) array
+    pair_overlaps = np.stack(
+        [
+            (
+                (
+                    overlap_tables[stakeholder_pair[0]].xs(
+                        stakeholder_pair[1], level='Partner'
+                    )
+                    + overlap_tables[stakeholder_pair[1]].xs(
+                        stakeholder_pair[0], level='Partner'
+                    )
+                )
+                / 2
+            )
+            .reindex(country_product_index)[overlap_columns]
+            .values
+            for stakeholder_pair in stakeholder_pairs
+        ],
+        axis=1,
+    )
     bidirectional_relationship_overlap = pd.DataFrame(
-        columns=(
-            parameters['survey']['relation_definitions']['overlap_columns']
-        ),
+        pair_overlaps.reshape(-1, len(overlap_columns)),
+        columns=overlap_columns,
         index=bidirectional_relationships_index,
     )
-    for country in countries:
-        for product in product_list:
-            for stakeholder_pair in stakeholder_pairs:
-                average_overlap = (
-                    overlap_tables[stakeholder_pair[0]].loc[
-                        country, product, stakeholder_pair[1]
-                    ]
-                    + overlap_tables[stakeholder_pair[1]].loc[
-                        country, product, stakeholder_pair[0]
-                    ]
-                ) / 2
-
-                bidirectional_relationship_overlap.loc[
-                    country, product, stakeholder_pair
-                ] = average_overlap
 
     # sqlite3 does not support tuples, so we convert the pair names
     # to strings
@@ -611,7 +871,7 @@ def get_bidirectional_relationship_overlap(parameters):
     bidirectional_relationship_overlap[
         'Pair'
     ] = bidirectional_relationship_overlap['Pair'].astype('str')
-    cook.save_dataframe(
+    model_store.save_dataframe(
         bidirectional_relationship_overlap,
         bidirectional_overlap_table,
         groupfile_name,
@@ -620,7 +880,7 @@ def get_bidirectional_relationship_overlap(parameters):
     )
 
 
-def get_product_relation_overlap(parameters):
+def get_product_relation_overlap(parameters, model_store=None):
     '''
     This gets the relation overlap for a given product.
     We take the average overlap for that given product to get a general
@@ -630,7 +890,7 @@ def get_product_relation_overlap(parameters):
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    source_database = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     survey_parameters = parameters['survey']
     relation_definition_parameters = survey_parameters['relation_definitions']
     product_overlap_table = relation_definition_parameters[
@@ -640,15 +900,11 @@ def get_product_relation_overlap(parameters):
     overlap_tables = {}
     countries = survey_parameters['countries']
     product_list = parameters['products']
-    with sqlite3.connect(source_database) as database_connection:
-        for stakeholder in stakeholders:
-            overlap_table_name = f'{stakeholder}_{overlap_table_name_root}'
-            relations_table_query = cook.read_query_generator(
-                '*', overlap_table_name, [], [], []
-            )
-            overlap_tables[stakeholder] = pd.read_sql(
-                relations_table_query, database_connection
-            ).set_index(['Country', 'Product', 'Partner'])
+    for stakeholder in stakeholders:
+        overlap_table_name = f'{stakeholder}_{overlap_table_name_root}'
+        overlap_tables[stakeholder] = model_store.read_table(
+            overlap_table_name
+        ).set_index(['Country', 'Product', 'Partner'])
     product_relationships_index_tuples = [
         (country, product) for country in countries for product in product_list
     ]
@@ -658,30 +914,31 @@ def get_product_relation_overlap(parameters):
     overlap_columns = parameters['survey']['relation_definitions'][
         'overlap_columns'
     ]
+    # We sum the overlaps of all partners of all stakeholders
+    # for all countries and products at once
+    total_overlaps = sum(
+        overlap_tables[stakeholder][overlap_columns[0]]
+        .groupby(level=['Country', 'Product'], sort=False)
+        .sum()
+        .reindex(product_relationships_index)
+        .values
+        for stakeholder in stakeholders
+    )
+    average_overlaps = total_overlaps / (
+        len(stakeholders)
+        * (len(stakeholders) - 1)
+        # If you have a division by zero,
+        # that's because you only have one stakeholder,
+        # which would make this meaningless.
+    )
     product_relationship_overlap = pd.DataFrame(
-        columns=overlap_columns, index=product_relationships_index
-    )
-    for country in countries:
-        for product in product_list:
-            average_overlap = (
-                sum(
-                    sum(
-                        overlap_tables[stakeholder].loc[country, product][
-                            overlap_columns[0]
-                        ]
-                    )
-                    for stakeholder in stakeholders
-                )
-                / (len(stakeholders) * (len(stakeholders) - 1))
-                # If you have a division by zero,
-                # that's because you only have one stakeholder,
-                # which would make this meaningless.
-            )
-
-            product_relationship_overlap.loc[
-                country, product
-            ] = average_overlap
-    cook.save_dataframe(
+        {
+            overlap_column: average_overlaps
+            for overlap_column in overlap_columns
+        },
+        index=product_relationships_index,
+    )
+    model_store.save_dataframe(
         product_relationship_overlap,
         product_overlap_table,
         groupfile_name,
@@ -690,23 +947,24 @@ def get_product_relation_overlap(parameters):
     )
 
 
-def get_relationship_deviations(stakeholder, parameters):
+def get_relationship_deviations(
+    stakeholder, parameters, relation_shares=None, model_store=None
+):
     '''
     Gets the deviations between perceived and ideal relationships.
+    We do this for all countries, products, and partners at once,
+    from the relation shares (see get_relation_shares, which we read
+    if they are not given).
     '''
 
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    source_database = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     survey_parameters = parameters['survey']
     relation_definition_parameters = survey_parameters['relation_definitions']
-    # relation_names = relation_definition_parameters['relation_names']
     deviations_table_name = relation_definition_parameters['deviations_table']
     deviations_table_name = f'{stakeholder}_{deviations_table_name}'
-    filters_reading_relations_table = relation_definition_parameters[
-        'filters_reading_relations_table'
-    ]
     countries = survey_parameters['countries']
     product_list = parameters['products']
 
@@ -717,6 +975,11 @@ def get_relationship_deviations(stakeholder, parameters):
     ]
     partners = stakeholder_relations_parameters['partners']
 
+    if relation_shares is None:
+        relation_shares, relation_names = get_relation_shares(
+            stakeholder, parameters
+        )
+
     relations_deviations_dataframe_index_tuples = [
         (country, product, partner)
         for country in countries
@@ -729,59 +992,30 @@ def get_relationship_deviations(stakeholder, parameters):
         names=['Country', 'Product', 'Partner'],
     )
 
+    deviations_squared = (
+        relation_shares[:, :, 0] - relation_shares[:, :, 1]
+    ) ** 2
+    # We average over the relations (the padding values are NaN) and go
+    # from (product, partner, country) to (country, product, partner)
+    variances = np.nanmean(deviations_squared, axis=2).transpose(2, 0, 1)
+    standard_deviations = np.sqrt(variances).reshape(-1)
+
     relations_deviations_dataframe = pd.DataFrame(
-        columns=deviations_columns, index=relations_deviations_dataframe_index
+        np.column_stack((standard_deviations, 1 - standard_deviations)),
+        columns=deviations_columns,
+        index=relations_deviations_dataframe_index,
+    )
+    model_store.save_dataframe(
+        relations_deviations_dataframe,
+        deviations_table_name,
+        groupfile_name,
+        output_folder,
+        parameters,
     )
-
-    relations_table_name_root = relation_definition_parameters['table_name']
-
-    with sqlite3.connect(source_database) as database_connection:
-        for country in countries:
-            for product in product_list:
-                for partner in partners:
-                    relations_table_name = (
-                        f'{stakeholder}_{relations_table_name_root}'
-                        f'_with_{partner}_for_{product}'
-                    )
-                    relations_table_query = cook.read_query_generator(
-                        '*',
-                        relations_table_name,
-                        filters_reading_relations_table,
-                        ['='],
-                        [f'"{country}"'],
-                    )
-                    relations_values = pd.read_sql(
-                        relations_table_query, con=database_connection
-                    )
-                    relation_names = list(relations_values.columns[2:])
-
-                    deviations_squared = [
-                        (
-                            relations_values[relation_name][0]
-                            - relations_values[relation_name][1]
-                        )
-                        ** 2
-                        for relation_name in relation_names
-                    ]
-                    variance = sum(deviations_squared) / len(
-                        deviations_squared
-                    )
-                    standard_deviation = math.sqrt(variance)
-                    table_values = [standard_deviation, 1 - standard_deviation]
-                    relations_deviations_dataframe.loc[
-                        country, product, partner
-                    ] = table_values
-        cook.save_dataframe(
-            relations_deviations_dataframe,
-            deviations_table_name,
-            groupfile_name,
-            output_folder,
-            parameters,
-        )
     return relations_deviations_dataframe
 
 
-def get_bidirectional_relationship_deviations(parameters):
+def get_bidirectional_relationship_deviations(parameters, model_store=None):
     '''
     This computes the bidirectional relation deviations, i.e. how
     good (or bad) the relation between two parties is.
@@ -790,7 +1024,7 @@ def get_bidirectional_relationship_deviations(parameters):
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    source_database = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     survey_parameters = parameters['survey']
     relation_definition_parameters = survey_parameters['relation_definitions']
     deviations_table_name_root = relation_definition_parameters[
@@ -802,17 +1036,11 @@ def get_bidirectional_relationship_deviations(parameters):
     deviations_tables = {}
     countries = survey_parameters['countries']
     product_list = parameters['products']
-    with sqlite3.connect(source_database) as database_connection:
-        for stakeholder in stakeholders:
-            deviations_table_name = (
-                f'{stakeholder}_{deviations_table_name_root}'
-            )
-            relations_table_query = cook.read_query_generator(
-                '*', deviations_table_name, [], [], []
-            )
-            deviations_tables[stakeholder] = pd.read_sql(
-                relations_table_query, database_connection
-            ).set_index(['Country', 'Product', 'Partner'])
+    for stakeholder in stakeholders:
+        deviations_table_name = f'{stakeholder}_{deviations_table_name_root}'
+        deviations_tables[stakeholder] = model_store.read_table(
+            deviations_table_name
+        ).set_index(['Country', 'Product', 'Partner'])
     stakeholder_pairs = []
     for stakeholder_index, stakeholder in enumerate(stakeholders):
         for partner in stakeholders[stakeholder_index + 1 :]:
@@ -828,36 +1056,45 @@ def get_bidirectional_relationship_deviations(parameters):
         bidirectional_relationships_index_tuples,
         names=['Country', 'Product', 'Pair'],
     )
+    country_product_index = pd.MultiIndex.from_product(
+        [countries, product_list], names=['Country', 'Product']
+    )
+    # The variance is the sum of the squares of the two deviations
+    # corresponding to the pair, divided by two
+    # (we get it for all countries and products at once, in a
+    # (country and product, pair) array)
+    pair_variances = np.stack(
+        [
+            (
+                (
+                    deviations_tables[stakeholder_pair[0]].xs(
+                        stakeholder_pair[1], level='Partner'
+                    )['Standard deviation']
+                )
+                ** 2
+                + (
+                    deviations_tables[stakeholder_pair[1]].xs(
+                        stakeholder_pair[0], level='Partner'
+                    )['Standard deviation']
+                )
+                ** 2
+            )
+            .reindex(country_product_index)
+            .values
+            / 2
+            for stakeholder_pair in stakeholder_pairs
+        ],
+        axis=1,
+    )
+    standard_deviations = np.sqrt(pair_variances).reshape(-1)
+    relation_scores = 1 - standard_deviations
     bidirectional_relationship_deviations = pd.DataFrame(
+        np.column_stack((standard_deviations, relation_scores)),
         columns=(
             parameters['survey']['relation_definitions']['deviations_columns']
         ),
         index=bidirectional_relationships_index,
     )
-    for country in countries:
-        for product in product_list:
-            for stakeholder_pair in stakeholder_pairs:
-                # The variance is the sum of the squares of the two deviations
-                # corresponding to the pair, divided by two
-                variance = (
-                    (
-                        deviations_tables[stakeholder_pair[0]].loc[
-                            country, product, stakeholder_pair[1]
-                        ]['Standard deviation']
-                    )
-                    ** 2
-                    + (
-                        deviations_tables[stakeholder_pair[1]].loc[
-                            country, product, stakeholder_pair[0]
-                        ]['Standard deviation']
-                    )
-                    ** 2
-                ) / 2
-                standard_deviation = math.sqrt(variance)
-                relation_score = 1 - standard_deviation
-                bidirectional_relationship_deviations.loc[
-                    country, product, stakeholder_pair
-                ] = [standard_deviation, relation_score]
     # sqlite3 does not support tuples, so we convert the pair names
     # to strings
     bidirectional_relationship_deviations = (
@@ -866,7 +1103,7 @@ def get_bidirectional_relationship_deviations(parameters):
     bidirectional_relationship_deviations[
         'Pair'
     ] = bidirectional_relationship_deviations['Pair'].astype('str')
-    cook.save_dataframe(
+    model_store.save_dataframe(
         bidirectional_relationship_deviations,
         bidirectional_deviations_table,
         groupfile_name,
@@ -875,7 +1112,7 @@ def get_bidirectional_relationship_deviations(parameters):
     )
 
 
-def get_product_relation_deviations(parameters):
+def get_product_relation_deviations(parameters, model_store=None):
     '''
     This gets the relation deviations for a given product.
     We sum the squares of all deviations for a given product,
@@ -887,7 +1124,7 @@ def get_product_relation_deviations(parameters):
     file_parameters = parameters['files']
     output_folder = file_parameters['output_folder']
     groupfile_name = file_parameters['groupfile_name']
-    source_database = f'{output_folder}/{groupfile_name}.sqlite3'
+    model_store = model_store_module.get_model_store(parameters, model_store)
     survey_parameters = parameters['survey']
     relation_definition_parameters = survey_parameters['relation_definitions']
     product_deviations_table = relation_definition_parameters[
@@ -899,54 +1136,45 @@ def get_product_relation_deviations(parameters):
     deviations_tables = {}
     countries = survey_parameters['countries']
     product_list = parameters['products']
-    with sqlite3.connect(source_database) as database_connection:
-        for stakeholder in stakeholders:
-            deviations_table_name = (
-                f'{stakeholder}_{deviations_table_name_root}'
-            )
-            relations_table_query = cook.read_query_generator(
-                '*', deviations_table_name, [], [], []
-            )
-            deviations_tables[stakeholder] = pd.read_sql(
-                relations_table_query, database_connection
-            ).set_index(['Country', 'Product', 'Partner'])
+    for stakeholder in stakeholders:
+        deviations_table_name = f'{stakeholder}_{deviations_table_name_root}'
+        deviations_tables[stakeholder] = model_store.read_table(
+            deviations_table_name
+        ).set_index(['Country', 'Product', 'Partner'])
     product_relationships_index_tuples = [
         (country, product) for country in countries for product in product_list
     ]
     product_relationships_index = pd.MultiIndex.from_tuples(
         product_relationships_index_tuples, names=['Country', 'Product']
     )
+    # We sum the squared deviations of all partners of all stakeholders
+    # for all countries and products at once
+    total_deviations_squared = sum(
+        (deviations_tables[stakeholder]['Standard deviation'] ** 2)
+        .groupby(level=['Country', 'Product'], sort=False)
+        .sum()
+        .reindex(product_relationships_index)
+        .values
+        for stakeholder in stakeholders
+    )
+    variances = total_deviations_squared / (
+        len(stakeholders)
+        * (len(stakeholders) - 1)
+        # If you have a division by zero,
+        # that's because you only have one stakeholder,
+        # which would make this meaningless.
+    )
+
+    standard_deviations = np.sqrt(variances)
+    relation_scores = 1 - standard_deviations
     product_relationship_deviations = pd.DataFrame(
+        np.column_stack((standard_deviations, relation_scores)),
         columns=(
             parameters['survey']['relation_definitions']['deviations_columns']
         ),
         index=product_relationships_index,
     )
-    for country in countries:
-        for product in product_list:
-            total_deviations_squared = 0
-            for stakeholder in stakeholders:
-                total_deviations_squared += sum(
-                    deviations_tables[stakeholder]
-                    .loc[country, product]['Standard deviation']
-                    .values
-                    ** 2
-                )
-            variance = (
-                total_deviations_squared
-                / (len(stakeholders) * (len(stakeholders) - 1))
-                # If you have a division by zero,
-                # that's because you only have one stakeholder,
-                # which would make this meaningless.
-            )
-
-            standard_deviation = math.sqrt(variance)
-            relation_score = 1 - standard_deviation
-            product_relationship_deviations.loc[country, product] = [
-                standard_deviation,
-                relation_score,
-            ]
-    cook.save_dataframe(
+    model_store.save_dataframe(
         product_relationship_deviations,
         product_deviations_table,
         groupfile_name,
@@ -0,0 +1,406 @@
+'''
+This module runs scenario sweeps. A scenario is a dictionary of overrides,
+with slider names as keys (with the same structure as in the GRETA tool,
+see GRETA_tool.update_from_slider), such as:
+    initial_yes__autonomous_cars__citizens__Spain
+    intention_weight__autonomous_cars__citizens__EU__social_norm
+    survey_topic__autonomous_cars__citizens__Spain__emotions__Adopt
+and time_span (with a [start, end] value).
+The overrides are applied in memory (so the database does not change),
+all (product, country) systems of a scenario are solved in one
+integration, and the scenarios run in a pool of processes.
+The results go to one compressed and chunked HDF5 array (with PyTables),
+with (scenario, product, country, stakeholder, time) dimensions,
+which we read lazily as an xarray DataArray with open_sweep_results.
+The settings are in the [sweeps] section of the parameters file.
+'''
+
+import concurrent.futures
+import datetime
+import itertools
+import json
+
+import numpy as np
+import tables
+import xarray as xr
+from xarray.backends import BackendArray
+from xarray.core import indexing
+from ETS_CookBook import ETS_CookBook as cook
+
+try:
+    from pLAtYpus_TNO import solver
+except ModuleNotFoundError:
+    import solver
+
+try:
+    from pLAtYpus_TNO import scores
+except ModuleNotFoundError:
+    import scores
+
+
+def get_sweep_file(parameters):
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    sweep_file_name = parameters['sweeps']['sweep_file_name']
+    sweep_file = f'{output_folder}/{sweep_file_name}.h5'
+
+    return sweep_file
+
+
+def get_scenario_grid(override_values):
+    '''
+    Makes the scenarios of a grid of overrides. The argument is
+    a dictionary with override names as keys and lists of values,
+    and we return the list of all the combinations of these values
+    (as override dictionaries).
+    '''
+    override_names = list(override_values.keys())
+    scenarios = [
+        dict(zip(override_names, override_combination))
+        for override_combination in itertools.product(
+            *override_values.values()
+        )
+    ]
+
+    return scenarios
+
+
+def get_sweep_base_inputs(parameters):
+    '''
+    Gets the inputs that the scenarios change, for all (product, country)
+    systems: the initial yes values, the stacked compiled coefficients,
+    and the survey score values (with the map from survey scores to
+    intention scores, see scores.compile_intention_score_map).
+    '''
+    (
+        systems_initial_yes,
+        systems_model_coefficients,
+    ) = solver.get_all_systems_inputs(parameters)
+    systems = list(systems_model_coefficients.keys())
+    compiled_coefficients = scores.stack_compiled_coefficients(
+        [
+            scores.compile_model_coefficients(
+                systems_model_coefficients[system]
+            )
+            for system in systems
+        ]
+    )
+    # The map is the same for all systems, as it only depends on
+    # the intention categories
+    (
+        survey_score_keys,
+        survey_score_indices,
+        component_weights,
+    ) = scores.compile_intention_score_map(
+        systems_model_coefficients[systems[0]]
+    )
+    survey_score_values = np.array(
+        [
+            [
+                float(
+                    systems_model_coefficients[system]['survey_scores'].loc[
+                        stakeholder, component
+                    ][action]
+                )
+                for (stakeholder, component, action) in survey_score_keys
+            ]
+            for system in systems
+        ]
+    )
+
+    sweep_base_inputs = {}
+    sweep_base_inputs['systems'] = systems
+    sweep_base_inputs['initial_yes'] = np.array(
+        [systems_initial_yes[system] for system in systems], dtype=float
+    )
+    sweep_base_inputs['compiled_coefficients'] = compiled_coefficients
+    sweep_base_inputs['survey_score_keys'] = survey_score_keys
+    sweep_base_inputs['survey_score_indices'] = survey_score_indices
+    sweep_base_inputs['component_weights'] = component_weights
+    sweep_base_inputs['survey_score_values'] = survey_score_values
+    sweep_base_inputs['intention_categories'] = systems_model_coefficients[
+        systems[0]
+    ]['intention_categories']
+
+    return sweep_base_inputs
+
+
+def apply_scenario_overrides(
+    scenario_overrides, sweep_base_inputs, parameters
+):
+    '''
+    Applies the overrides of a scenario to (copies of) the base inputs.
+    As in the GRETA tool, the intention weights are pan-European
+    (so they change for all the countries of a product), and the other
+    weights of the stakeholder shift so that they still add up to one.
+    Returns the initial yes values, compiled coefficients,
+    and time span of the scenario.
+    '''
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    time_span = parameters['pLAtYpus']['time_span']
+    systems = sweep_base_inputs['systems']
+    survey_score_keys = sweep_base_inputs['survey_score_keys']
+    intention_categories = sweep_base_inputs['intention_categories']
+
+    initial_yes = sweep_base_inputs['initial_yes'].copy()
+    compiled_coefficients = dict(sweep_base_inputs['compiled_coefficients'])
+    category_weights = compiled_coefficients['category_weights'].copy()
+    survey_score_values = sweep_base_inputs['survey_score_values'].copy()
+
+    for override_name, override_value in scenario_overrides.items():
+        if override_name == 'time_span':
+            time_span = override_value
+            continue
+        override_split_values = override_name.split('__')
+        override_type = override_split_values[0]
+        override_product = override_split_values[1]
+        override_stakeholder = override_split_values[2]
+        override_country = override_split_values[3]
+        stakeholder_index = stakeholders.index(override_stakeholder)
+        if override_type == 'initial_yes':
+            initial_yes[
+                systems.index((override_product, override_country)),
+                stakeholder_index,
+            ] = override_value
+        elif override_type == 'intention_weight':
+            changed_intention_category = override_split_values[4]
+            category_index = list(
+                intention_categories[override_stakeholder]
+            ).index(changed_intention_category)
+            product_systems = [
+                system_index
+                for system_index, (product, country) in enumerate(systems)
+                if product == override_product
+            ]
+            category_weights[
+                product_systems, stakeholder_index
+            ] = scores.shift_category_weights(
+                category_weights[product_systems, stakeholder_index],
+                category_index,
+                override_value,
+            )
+        elif override_type == 'survey_topic':
+            override_topic = override_split_values[4]
+            override_adopt_leave = override_split_values[5]
+            survey_score_values[
+                systems.index((override_product, override_country)),
+                survey_score_keys.index(
+                    (
+                        override_stakeholder,
+                        override_topic,
+                        override_adopt_leave,
+                    )
+                ),
+            ] = override_value
+        else:
+            raise ValueError(f'Unknown override: {override_name}')
+
+    compiled_coefficients['category_weights'] = category_weights
+    compiled_coefficients['intention_scores'] = (
+        survey_score_values[:, sweep_base_inputs['survey_score_indices']]
+        * sweep_base_inputs['component_weights']
+    )
+
+    return initial_yes.ravel(), compiled_coefficients, time_span
+
+
+def get_scenario_yes_values(scenario_overrides, sweep_base_inputs, parameters):
+    '''
+    Computes the yes values of all (product, country) systems for
+    a scenario. This is a function of the module so that processes
+    can run it.
+    Returns the times and an array of yes values with
+    (product, country, stakeholder, time) dimensions.
+    '''
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    countries = parameters['survey']['countries']
+    products = list(parameters['products'].keys())
+    time_steps = parameters['sweeps']['time_steps']
+
+    initial_yes, compiled_coefficients, time_span = apply_scenario_overrides(
+        scenario_overrides, sweep_base_inputs, parameters
+    )
+    time_range = np.linspace(time_span[0], time_span[1], time_steps)
+    yes_values = solver.get_compiled_yes_values(
+        initial_yes, compiled_coefficients, time_range, parameters
+    )
+    # The systems are ordered by product and then by country
+    yes_values = np.reshape(
+        np.transpose(yes_values, (1, 2, 0)),
+        (len(products), len(countries), len(stakeholders), time_steps),
+    )
+
+    return time_range, yes_values
+
+
+def run_sweep(scenarios, parameters, jobs=None):
+    '''
+    Runs a sweep of scenarios (a list of override dictionaries, or
+    a dictionary of them with the scenario names as keys) and writes the
+    results to the sweep file. The scenarios run in a pool of processes
+    (see solver.get_job_amount), and this process writes their results
+    as they come (in the order of the scenarios).
+    Each chunk of the array holds one (scenario, product, country)
+    evolution, so that reading a slice only reads the chunks it needs.
+    '''
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    countries = parameters['survey']['countries']
+    products = list(parameters['products'].keys())
+    sweep_parameters = parameters['sweeps']
+    time_steps = sweep_parameters['time_steps']
+    compression_library = sweep_parameters['compression_library']
+    compression_level = sweep_parameters['compression_level']
+    jobs = solver.get_job_amount(parameters, jobs)
+
+    if isinstance(scenarios, dict):
+        scenario_names = list(scenarios.keys())
+        scenarios_overrides = list(scenarios.values())
+    else:
+        scenario_names = [
+            f'scenario_{scenario_index}'
+            for scenario_index in range(len(scenarios))
+        ]
+        scenarios_overrides = list(scenarios)
+
+    sweep_base_inputs = get_sweep_base_inputs(parameters)
+    scenarios_arguments = (
+        scenarios_overrides,
+        itertools.repeat(sweep_base_inputs),
+        itertools.repeat(parameters),
+    )
+
+    sweep_file = get_sweep_file(parameters)
+    cook.check_if_folder_exists(parameters['files']['output_folder'])
+    sweep_filters = tables.Filters(
+        complevel=compression_level, complib=compression_library
+    )
+    with tables.open_file(sweep_file, mode='w') as sweep_store:
+        yes_values_array = sweep_store.create_carray(
+            '/',
+            'yes_values',
+            atom=tables.Float64Atom(),
+            shape=(
+                len(scenario_names),
+                len(products),
+                len(countries),
+                len(stakeholders),
+                time_steps,
+            ),
+            chunkshape=(1, 1, 1, len(stakeholders), time_steps),
+            filters=sweep_filters,
+        )
+        times_array = sweep_store.create_carray(
+            '/',
+            'times',
+            atom=tables.Float64Atom(),
+            shape=(len(scenario_names), time_steps),
+            filters=sweep_filters,
+        )
+        yes_values_array.attrs.scenarios = scenario_names
+        yes_values_array.attrs.products = products
+        yes_values_array.attrs.countries = countries
+        yes_values_array.attrs.stakeholders = stakeholders
+        yes_values_array.attrs.overrides = [
+            json.dumps(scenario_overrides, default=float)
+            for scenario_overrides in scenarios_overrides
+        ]
+
+        if jobs > 1:
+            with concurrent.futures.ProcessPoolExecutor(
+                max_workers=jobs
+            ) as executor:
+                for scenario_index, (time_range, yes_values) in enumerate(
+                    executor.map(get_scenario_yes_values, *scenarios_arguments)
+                ):
+                    times_array[scenario_index] = time_range
+                    yes_values_array[scenario_index] = yes_values
+        else:
+            for scenario_index, (time_range, yes_values) in enumerate(
+                map(get_scenario_yes_values, *scenarios_arguments)
+            ):
+                times_array[scenario_index] = time_range
+                yes_values_array[scenario_index] = yes_values
+
+
+class SweepBackendArray(BackendArray):
+    '''
+    Gives xarray access to an array of the sweep file. We only read the
+    part of the array that is indexed (and the file is opened for each
+    read, so that we do not keep it open).
+    '''
+
+    def __init__(self, sweep_file, array_name, shape, dtype):
+        self.sweep_file = sweep_file
+        self.array_name = array_name
+        self.shape = shape
+        self.dtype = dtype
+
+    def __getitem__(self, key):
+        return indexing.explicit_indexing_adapter(
+            key,
+            self.shape,
+            indexing.IndexingSupport.BASIC,
+            self._raw_indexing_method,
+        )
+
+    def _raw_indexing_method(self, key):
+        with tables.open_file(self.sweep_file, mode='r') as sweep_store:
+            return sweep_store.get_node('/', self.array_name)[key]
+
+
+def open_sweep_results(parameters):
+    '''
+    Opens the results of a sweep as a lazy xarray DataArray, so that
+    selecting a scenario or country slice (for example with
+    .sel(scenario=..., country=...)) only reads that slice from
+    the file (when its values are used).
+    The times of each scenario are in a coordinate with
+    (scenario, time) dimensions, as scenarios can have
+    different time spans.
+    '''
+    time_header = parameters['pLAtYpus']['time_header']
+    sweep_file = get_sweep_file(parameters)
+    with tables.open_file(sweep_file, mode='r') as sweep_store:
+        yes_values_node = sweep_store.root.yes_values
+        scenario_names = yes_values_node.attrs.scenarios
+        products = yes_values_node.attrs.products
+        countries = yes_values_node.attrs.countries
+        stakeholders = yes_values_node.attrs.stakeholders
+        scenarios_overrides = yes_values_node.attrs.overrides
+        shape = yes_values_node.shape
+        dtype = yes_values_node.dtype
+        times = sweep_store.root.times[:]
+
+    sweep_results = xr.DataArray(
+        indexing.LazilyIndexedArray(
+            SweepBackendArray(sweep_file, 'yes_values', shape, dtype)
+        ),
+        dims=('scenario', 'product', 'country', 'stakeholder', 'time'),
+        coords={
+            'scenario': scenario_names,
+            'product': products,
+            'country': countries,
+            'stakeholder': stakeholders,
+            time_header: (('scenario', 'time'), times),
+            'overrides': ('scenario', scenarios_overrides),
+        },
+        name='yes_values',
+    )
+
+    return sweep_results
+
+
+if __name__ == '__main__':
+    start = datetime.datetime.now()
+    parameters_file_name = 'pLAtYpus.toml'
+    parameters = cook.parameters_from_TOML(parameters_file_name)
+    scenarios = get_scenario_grid(
+        {
+            'initial_yes__autonomous_cars__citizens__Spain': [0.06, 0.2],
+            'time_span': [[0, 42], [0, 84]],
+        }
+    )
+    run_sweep(scenarios, parameters)
+    print(open_sweep_results(parameters))
+    end = datetime.datetime.now()
+    print((end - start).total_seconds())
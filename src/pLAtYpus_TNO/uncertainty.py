@@ -0,0 +1,407 @@
+'''
+This module propagates the uncertainty of the survey answers to the
+engagement evolutions (with a Monte Carlo approach).
+The survey scores come from answer counts (see
+survey_to_pLAtYpus.get_component_values), so we resample these counts
+(with a bootstrap or a Dirichlet-multinomial draw), compute the yes
+evolutions of all the samples at once, and store quantile bands of
+the evolutions and of the long-term averages.
+The settings are in the [uncertainty] section of the parameters file.
+'''
+
+import concurrent.futures
+import datetime
+import itertools
+
+import numpy as np
+import pandas as pd
+from ETS_CookBook import ETS_CookBook as cook
+
+try:
+    from pLAtYpus_TNO import solver
+except ModuleNotFoundError:
+    import solver
+
+try:
+    from pLAtYpus_TNO import scores
+except ModuleNotFoundError:
+    import scores
+
+try:
+    from pLAtYpus_TNO import survey_to_pLAtYpus
+except ModuleNotFoundError:
+    import survey_to_pLAtYpus
+
+
+def resample_component_values(
+    component_answer_counts, parameters, random_generator
+):
+    '''
+    Draws samples of the adopt and leave values of a component by
+    resampling its answer counts (see
+    survey_to_pLAtYpus.get_component_answer_counts).
+    The bootstrap draws the answers of each question from a multinomial
+    distribution with the observed answer shares. The Dirichlet-multinomial
+    method first draws these shares from a Dirichlet distribution (with
+    the answer counts plus a prior as parameters), so that it also
+    accounts for the uncertainty of the shares themselves.
+    Answers that are in the total but not in the answer levels are
+    kept as an extra answer level, so that the total of each question
+    does not change.
+    '''
+    uncertainty_parameters = parameters['uncertainty']
+    sample_amount = uncertainty_parameters['sample_amount']
+    resampling_method = uncertainty_parameters['resampling_method']
+    dirichlet_prior = uncertainty_parameters['dirichlet_prior']
+
+    answer_counts = component_answer_counts['answer_counts']
+    answer_levels = component_answer_counts['answer_levels']
+    totals = component_answer_counts['totals']
+    other_answers = np.maximum(totals - np.sum(answer_counts, axis=1), 0)
+    all_answer_counts = np.column_stack((answer_counts, other_answers))
+    all_answer_levels = np.column_stack(
+        (answer_levels, np.ones(len(totals), dtype=bool))
+    )
+    adopt_levels = np.column_stack(
+        (
+            component_answer_counts['adopt_levels'],
+            np.zeros(len(totals), dtype=bool),
+        )
+    )
+    leave_levels = np.column_stack(
+        (
+            component_answer_counts['leave_levels'],
+            np.zeros(len(totals), dtype=bool),
+        )
+    )
+    question_totals = np.sum(all_answer_counts, axis=1)
+
+    # Questions without answers do not count (as for the survey values)
+    answered_questions = question_totals > 0
+    all_answer_counts = all_answer_counts[answered_questions]
+    all_answer_levels = all_answer_levels[answered_questions]
+    adopt_levels = adopt_levels[answered_questions]
+    leave_levels = leave_levels[answered_questions]
+    question_totals = question_totals[answered_questions]
+
+    samples_shape = (sample_amount,) + all_answer_counts.shape
+    if resampling_method == 'bootstrap':
+        answer_shares = np.broadcast_to(
+            all_answer_counts / question_totals[:, np.newaxis], samples_shape
+        )
+    elif resampling_method == 'dirichlet_multinomial':
+        # We draw the Dirichlet shares through normalized gamma draws
+        # (answer levels that do not exist have a zero parameter,
+        # so they get a zero share)
+        dirichlet_parameters = np.where(
+            all_answer_levels, all_answer_counts + dirichlet_prior, 0
+        )
+        answer_share_draws = random_generator.gamma(
+            dirichlet_parameters, size=samples_shape
+        )
+        answer_shares = answer_share_draws / np.sum(
+            answer_share_draws, axis=-1, keepdims=True
+        )
+    else:
+        raise ValueError(f'Unknown resampling method: {resampling_method}')
+
+    resampled_answer_counts = random_generator.multinomial(
+        np.rint(question_totals).astype(int), answer_shares
+    )
+
+    total_answers = np.sum(totals)
+    adopt_values = (
+        np.sum(resampled_answer_counts * adopt_levels, axis=(1, 2))
+        / total_answers
+    )
+    leave_values = (
+        np.sum(resampled_answer_counts * leave_levels, axis=(1, 2))
+        / total_answers
+    )
+
+    return adopt_values, leave_values
+
+
+def get_intention_score_samples(
+    product,
+    country,
+    model_coefficients,
+    parameters,
+    random_generator,
+    survey_counts=None,
+):
+    '''
+    Draws samples of the intention scores (as in the compiled
+    coefficients) of a given product and country.
+    We resample the survey scores that come from answer counts, and
+    keep the other ones (such as the relation scores) at their values.
+    The answer counts of the survey can be given (see
+    survey_to_pLAtYpus.get_survey_counts), so that we do not read them
+    again.
+    '''
+    survey_scores = model_coefficients['survey_scores']
+    survey_scores_actions = model_coefficients['survey_scores_actions']
+    sample_amount = parameters['uncertainty']['sample_amount']
+    (
+        survey_score_keys,
+        survey_score_indices,
+        component_weights,
+    ) = scores.compile_intention_score_map(model_coefficients)
+
+    survey_score_samples = np.zeros((sample_amount, len(survey_score_keys)))
+    for survey_score_index, (stakeholder, component, action) in enumerate(
+        survey_score_keys
+    ):
+        survey_score_samples[:, survey_score_index] = float(
+            survey_scores.loc[stakeholder, component][action]
+        )
+
+    resampled_components = {
+        (stakeholder, component)
+        for (stakeholder, component, action) in survey_score_keys
+        if component in parameters['survey']['products'][stakeholder][product]
+    }
+    if survey_counts is None:
+        survey_counts = survey_to_pLAtYpus.get_survey_counts(parameters)
+    # We go through the components in a fixed order, so that
+    # the samples only depend on the seed
+    for stakeholder, component in sorted(resampled_components):
+        component_answer_counts = (
+            survey_to_pLAtYpus.get_component_answer_counts(
+                stakeholder,
+                component,
+                product,
+                country,
+                parameters,
+                survey_counts=survey_counts,
+            )
+        )
+        action_values = dict(
+            zip(
+                ['Adopt', 'Leave'],
+                resample_component_values(
+                    component_answer_counts, parameters, random_generator
+                ),
+            )
+        )
+        for action in survey_scores_actions:
+            survey_score_key = (stakeholder, component, action)
+            if survey_score_key in survey_score_keys:
+                survey_score_samples[
+                    :, survey_score_keys.index(survey_score_key)
+                ] = action_values[action]
+
+    return survey_score_samples[:, survey_score_indices] * component_weights
+
+
+def get_yes_evolution_samples(
+    initial_yes, compiled_coefficients, intention_score_samples, parameters
+):
+    '''
+    Computes the yes evolutions of all the intention score samples.
+    We stack the samples into one state (as we do for batches of systems),
+    in chunks (so that the size of the state stays reasonable).
+    Returns an array with (sample, time, stakeholder) dimensions.
+    '''
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    time_span = pLAtYpus_parameters['time_span']
+    stakeholder_amount = compiled_coefficients['stakeholder_amount']
+    uncertainty_parameters = parameters['uncertainty']
+    chunk_size = uncertainty_parameters['chunk_size']
+    time_steps = uncertainty_parameters['time_steps']
+    time_range = np.linspace(time_span[0], time_span[1], time_steps)
+
+    sample_amount = len(intention_score_samples)
+    yes_evolution_samples = np.zeros(
+        (sample_amount, time_steps, stakeholder_amount)
+    )
+    for chunk_start in range(0, sample_amount, chunk_size):
+        chunk_samples = intention_score_samples[
+            chunk_start : chunk_start + chunk_size
+        ]
+        chunk_coefficients = scores.stack_compiled_coefficients(
+            [compiled_coefficients] * len(chunk_samples)
+        )
+        chunk_coefficients['intention_scores'] = chunk_samples
+
+        yes_evolution_samples[
+            chunk_start : chunk_start + chunk_size
+        ] = np.transpose(
+            solver.get_compiled_yes_values(
+                np.tile(initial_yes, len(chunk_samples)),
+                chunk_coefficients,
+                time_range,
+                parameters,
+            ),
+            (1, 0, 2),
+        )
+
+    return yes_evolution_samples
+
+
+def get_system_uncertainty(
+    system,
+    initial_yes,
+    model_coefficients,
+    seed_sequence,
+    parameters,
+    survey_counts=None,
+):
+    '''
+    Computes the quantile bands of the yes evolutions and long-term
+    averages of a (product, country) system.
+    The random numbers come from a seed sequence of the system, so the
+    results do not depend on the order in which we compute the systems.
+    The answer counts of the survey can be given (see
+    survey_to_pLAtYpus.get_survey_counts), so that we do not read them
+    for each system.
+    This is a function of the module so that processes can run it.
+    Returns a DataFrame of the evolution quantiles
+    (with quantile and time as index) and an array of the
+    long-term average quantiles (with quantile and stakeholder dimensions).
+    '''
+    product, country = system
+    pLAtYpus_parameters = parameters['pLAtYpus']
+    stakeholders = pLAtYpus_parameters['stakeholders']
+    time_span = pLAtYpus_parameters['time_span']
+    time_header = pLAtYpus_parameters['time_header']
+    percentage_time_span_end_average = pLAtYpus_parameters[
+        'percentage_time_span_end_average'
+    ]
+    run_duration = time_span[1] - time_span[0]
+    end_average_time_start = (
+        1 - percentage_time_span_end_average
+    ) * run_duration
+    uncertainty_parameters = parameters['uncertainty']
+    quantiles = uncertainty_parameters['quantiles']
+    time_steps = uncertainty_parameters['time_steps']
+    time_range = np.linspace(time_span[0], time_span[1], time_steps)
+
+    random_generator = np.random.default_rng(seed_sequence)
+    intention_score_samples = get_intention_score_samples(
+        product,
+        country,
+        model_coefficients,
+        parameters,
+        random_generator,
+        survey_counts=survey_counts,
+    )
+    compiled_coefficients = scores.compile_model_coefficients(
+        model_coefficients
+    )
+    yes_evolution_samples = get_yes_evolution_samples(
+        initial_yes, compiled_coefficients, intention_score_samples, parameters
+    )
+
+    yes_evolution_quantiles = np.quantile(
+        yes_evolution_samples, quantiles, axis=0
+    )
+    quantile_index = pd.MultiIndex.from_product(
+        [quantiles, time_range], names=['Quantile', time_header]
+    )
+    yes_evolution_bands = pd.DataFrame(
+        np.reshape(yes_evolution_quantiles, (-1, len(stakeholders))),
+        index=quantile_index,
+        columns=stakeholders,
+    )
+
+    long_term_average_samples = np.average(
+        yes_evolution_samples[:, time_range >= end_average_time_start],
+        axis=1,
+    )
+    long_term_average_quantiles = np.quantile(
+        long_term_average_samples, quantiles, axis=0
+    )
+
+    return yes_evolution_bands, long_term_average_quantiles
+
+
+def get_all_uncertainty_bands(parameters, jobs=None):
+    '''
+    Computes and saves the quantile bands of the yes evolutions
+    and long-term averages of all (product, country) systems.
+    The systems are spread over a pool of processes (see
+    solver.get_job_amount), and we save the results from this process.
+    '''
+    file_parameters = parameters['files']
+    output_folder = file_parameters['output_folder']
+    groupfile_name = file_parameters['groupfile_name']
+    stakeholders = parameters['pLAtYpus']['stakeholders']
+    countries = parameters['survey']['countries']
+    products = list(parameters['products'].keys())
+    uncertainty_parameters = parameters['uncertainty']
+    seed = uncertainty_parameters['seed']
+    quantiles = uncertainty_parameters['quantiles']
+    trajectory_table_suffix = uncertainty_parameters['trajectory_table_suffix']
+    long_term_averages_table_name_prefix = uncertainty_parameters[
+        'long_term_averages_table_name_prefix'
+    ]
+    jobs = solver.get_job_amount(parameters, jobs)
+
+    (
+        systems_initial_yes,
+        systems_model_coefficients,
+    ) = solver.get_all_systems_inputs(parameters)
+    systems = list(systems_model_coefficients.keys())
+    systems_seed_sequences = np.random.SeedSequence(seed).spawn(len(systems))
+    systems_arguments = (
+        systems,
+        [systems_initial_yes[system] for system in systems],
+        [systems_model_coefficients[system] for system in systems],
+        systems_seed_sequences,
+        itertools.repeat(parameters),
+        itertools.repeat(survey_to_pLAtYpus.get_survey_counts(parameters)),
+    )
+
+    if jobs > 1:
+        with concurrent.futures.ProcessPoolExecutor(
+            max_workers=jobs
+        ) as executor:
+            systems_uncertainty = list(
+                executor.map(get_system_uncertainty, *systems_arguments)
+            )
+    else:
+        systems_uncertainty = list(
+            map(get_system_uncertainty, *systems_arguments)
+        )
+    systems_uncertainty = dict(zip(systems, systems_uncertainty))
+
+    for product in products:
+        for country in countries:
+            yes_evolution_bands = systems_uncertainty[(product, country)][0]
+            cook.save_dataframe(
+                yes_evolution_bands,
+                f'{product}_{country}_{trajectory_table_suffix}',
+                groupfile_name,
+                output_folder,
+                parameters,
+            )
+        long_term_average_index = pd.MultiIndex.from_product(
+            [countries, quantiles], names=['Country', 'Quantile']
+        )
+        long_term_average_bands = pd.DataFrame(
+            np.concatenate(
+                [
+                    systems_uncertainty[(product, country)][1]
+                    for country in countries
+                ]
+            ),
+            index=long_term_average_index,
+            columns=stakeholders,
+        )
+        cook.save_dataframe(
+            long_term_average_bands,
+            f'{long_term_averages_table_name_prefix}_{product}',
+            groupfile_name,
+            output_folder,
+            parameters,
+        )
+
+
+if __name__ == '__main__':
+    start = datetime.datetime.now()
+    parameters_file_name = 'pLAtYpus.toml'
+    parameters = cook.parameters_from_TOML(parameters_file_name)
+    get_all_uncertainty_bands(parameters)
+    end = datetime.datetime.now()
+    print((end - start).total_seconds())